@@ -1,12 +1,13 @@
 import sys, os
 
 from splunklib.searchcommands import dispatch, StreamingCommand, Configuration, Option
-from splunklib.searchcommands.validators import Fieldname
-import pickle
+from splunklib.searchcommands.validators import Fieldname, Integer
 import splunk
 import logging, logging.handlers
 
-from scripts.model import MarkovModel
+from scripts.cache import LRUCache
+from scripts.metrics import Metrics
+from scripts.model import MarkovModel, load_model
 
 
 def setup_logging():
@@ -27,6 +28,38 @@ def setup_logging():
     return logger
 
 
+# Number of records scored at once by the model
+BATCH_SIZE = 10000
+# Number of models kept loaded in the process, the least recently used model is evicted first
+MODEL_CACHE_SIZE = 4
+# Number of scores of distinct values kept for each loaded model
+SCORE_MEMO_SIZE = 100000
+
+# Loaded models by path, with the modification time of their file and their score memo
+model_cache = LRUCache(MODEL_CACHE_SIZE)
+
+
+def get_model(model_path):
+    """
+    Return the model stored at model_path and its score memo, from the process cache when it was already loaded
+    and its file did not change since.
+    """
+    mtime = os.stat(model_path).st_mtime_ns
+    cached = model_cache.get(model_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1], cached[2]
+
+    model = load_model(model_path)
+    if isinstance(model, MarkovModel):
+        try:
+            model = model.freeze()
+        except ValueError:
+            pass
+    memo = LRUCache(SCORE_MEMO_SIZE)
+    model_cache.put(model_path, (mtime, model, memo))
+    return model, memo
+
+
 model_dump_field_dict = {
     "CommandLine": "model_cmdline.dump"
 }
@@ -48,34 +81,107 @@ class AnoMark(StreamingCommand):
 
     ''')
 
+    fieldnames = Option(doc='''
+    **Syntax:** **fieldnames=***<fieldname>,<fieldname>...*
+    **Description:** Fields scored in the same pass over the records, each with its model (see modelnames), written
+    to markov_score_<fieldname>, the lowest score of each record being written to markov_score
+
+    ''')
+
+    modelnames = Option(doc='''
+    **Syntax:** **modelnames=***<string>,<string>...*
+    **Description:** Names of the models of the fields of fieldnames, in the same order, in <AnoMark_APP>/bin/models
+    (default: the model of each field in model_dump_field_dict)
+
+    ''')
+
+    batchsize = Option(doc='''
+    **Syntax:** **batchsize=***<int>*
+    **Description:** Number of records scored at once (default: 10000)
+
+    ''', validate=Integer(minimum=1))
+
     def stream(self, records):
         logger = self.logger
-        fieldname = self.fieldname if self.fieldname else "CommandLine"
-        modelname = self.modelname
+        metrics = Metrics(logger)
+        if self.fieldnames:
+            fieldnames = [fieldname.strip() for fieldname in self.fieldnames.split(",")]
+            modelnames = [modelname.strip() for modelname in self.modelnames.split(",")] if self.modelnames \
+                else [None] * len(fieldnames)
+            if len(modelnames) != len(fieldnames):
+                self.write_error("modelnames must give one model for each field of fieldnames")
+                exit(1)
+        else:
+            fieldnames = [self.fieldname if self.fieldname else "CommandLine"]
+            modelnames = [self.modelname]
+
+        # choose the model to apply to each field
+        fields = []
+        for (fieldname, modelname) in zip(fieldnames, modelnames):
+            if modelname is None:
+                try:
+                    modelname = model_dump_field_dict[fieldname]
+                except KeyError:
+                    logger.error('no model found for field ' + fieldname)
+                    self.write_error("no model found for field {}".format(fieldname))
+                    exit(1)
+
+            model_path = sys.path[0] + '/models/' + modelname
 
-        # choose the model to apply
-        if modelname is None:
             try:
-                modelname = model_dump_field_dict[fieldname]
-            except KeyError:
-                logger.error('no model found for field ' + fieldname)
-                self.write_error("no model found for field {}".format(fieldname))
+                with metrics.stage("load_model"):
+                    model, memo = get_model(model_path)
+            except FileNotFoundError as e:
+                logger.error('{} : {}'.format(model_path, str(e)))
+                self.write_error('{} : {}'.format(model_path, str(e)))
                 exit(1)
+            score_field = "markov_score_" + fieldname if self.fieldnames else "markov_score"
+            fields.append((fieldname, modelname, model, memo, score_field))
+            metrics.add_stats("score_memo_" + fieldname if self.fieldnames else "score_memo", memo)
+        batch_size = self.batchsize if self.batchsize else BATCH_SIZE
 
-        model_path = sys.path[0] + '/models/' + modelname
-
-        try:
-            with open(model_path, "rb") as f:
-                model: MarkovModel = pickle.load(f)
-        except FileNotFoundError as e:
-            logger.error('{} : {}'.format(model_path, str(e)))
-            self.write_error('{} : {}'.format(model_path, str(e)))
-            exit(1)
-
-        order = model.order
+        # Records are buffered and scored by batches
+        batch = []
         for record in records:
-            record["markov_score"] = model.log_likelihood(order * "~" + str(record[fieldname]) + order * "~")
-            yield record
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield from self.score_batch(fields, batch, metrics, combine=bool(self.fieldnames))
+                batch = []
+        yield from self.score_batch(fields, batch, metrics, combine=bool(self.fieldnames))
+        for (_, modelname, _, memo, _) in fields:
+            logger.info('{} score memo: {}'.format(modelname, memo.report()))
+        metrics.log()
+
+    @staticmethod
+    def score_batch(fields, batch, metrics, combine=False):
+        # Scored before being yielded, so that the time Splunk spends on the records is not measured as scoring
+        with metrics.stage("scoring", len(batch)):
+            for (fieldname, _, model, memo, score_field) in fields:
+                AnoMark.score_records(model, memo, fieldname, batch, score_field)
+            if combine:
+                # Score of the most unusual field of each record
+                for record in batch:
+                    record["markov_score"] = min(record[score_field] for (*_, score_field) in fields)
+        return batch
+
+    @staticmethod
+    def score_records(model, memo, fieldname, batch, score_field="markov_score"):
+        # Each distinct value is scored once, values scored by previous batches or searches are taken from the memo
+        scores = {}
+        missing = []
+        for value in set(str(record[fieldname]) for record in batch):
+            score = memo.get(value)
+            if score is None:
+                missing.append(value)
+            else:
+                scores[value] = score
+        order = model.order
+        for (value, score) in zip(missing, model.score_batch(order * "~" + value + order * "~" for value in missing)):
+            scores[value] = float(score)
+            memo.put(value, scores[value])
+
+        for record in batch:
+            record[score_field] = scores[str(record[fieldname])]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,77 @@
+import os
+import pickle
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Bounded mapping which evicts the least recently used entries, and counts hits and misses of its lookups.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """ Return the value cached for key, or default. """
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """ Cache a value, evicting the least recently used entries if the cache is full. """
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
+
+    def stats(self):
+        return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hit_ratio}
+
+    def report(self):
+        return "{} hits, {} misses ({:.2%} hit ratio)".format(self.hits, self.misses, self.hit_ratio)
+
+    def save(self, path, tag=None):
+        """
+        Save the entries in a pickle file, to reload them in another run.
+        :param tag: picklable description of how the values were computed, checked by load
+        """
+        with open(path, "wb") as output:
+            pickle.dump({"tag": tag, "entries": list(self.entries.items())}, output, protocol=4)
+
+    @classmethod
+    def load(cls, path, max_size=100000, tag=None):
+        """
+        Load the entries saved by save, if the file exists and was saved with the same tag. Otherwise, the cache
+        is empty.
+        """
+        cache = cls(max_size)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                saved = pickle.load(f)
+            if saved["tag"] == tag:
+                for key, value in saved["entries"]:
+                    cache.put(key, value)
+        return cache
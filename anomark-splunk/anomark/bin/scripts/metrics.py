@@ -0,0 +1,182 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def current_rss():
+    """ Return the resident memory of the process in bytes, or None if it cannot be read. """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss():
+    """ Return the peak resident memory of the process in bytes, or None if it cannot be read. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def to_mb(size):
+    return None if size is None else size / 2 ** 20
+
+
+class Metrics:
+    """
+    Wall time, rows per second and memory change of the stages of a run, with statistics of the caches it used.
+    Stages measured several times under the same name, e.g. for each chunk of a streaming run, are accumulated.
+    """
+
+    def __init__(self, logger=None):
+        """
+        :param logger: optional logger the metrics are written to by log
+        """
+        self.logger = logger
+        self.start = time.perf_counter()
+        self.stages = OrderedDict()
+        self.sources = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """
+        Measure the code run in the context as a stage. The number of rows processed can be given, or set in the
+        "rows" entry of the dict returned by the context once it is known.
+        """
+        record = {"rows": rows}
+        rss = current_rss()
+        t0 = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - t0
+            new_rss = current_rss()
+            self.add_stage(name, seconds, record["rows"], None if rss is None or new_rss is None else new_rss - rss)
+
+    def add_stage(self, name, seconds, rows=None, rss_delta=None):
+        """ Accumulate a measure of a stage. """
+        stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0., "rows": None, "rss_delta": None})
+        stage["calls"] += 1
+        stage["seconds"] += seconds
+        if rows is not None:
+            stage["rows"] = (stage["rows"] or 0) + rows
+        if rss_delta is not None:
+            stage["rss_delta"] = (stage["rss_delta"] or 0) + rss_delta
+
+    def add_stats(self, name, source):
+        """ Report the statistics of an object with a stats method, e.g. an LRUCache, as they are at the end. """
+        self.sources[name] = source
+
+    def add_counts(self, name, counts):
+        """ Accumulate a dict of numbers, e.g. the time spent in each placeholder module of each chunk. """
+        total = self.counts.setdefault(name, {})
+        for key, value in counts.items():
+            total[key] = total.get(key, 0) + value
+
+    def to_dict(self):
+        stages = []
+        for name, stage in self.stages.items():
+            rows, seconds = stage["rows"], stage["seconds"]
+            stages.append({"name": name, "calls": stage["calls"], "seconds": seconds, "rows": rows,
+                           "rows_per_second": rows / seconds if rows is not None and seconds else None,
+                           "rss_delta_mb": to_mb(stage["rss_delta"])})
+        stats = {name: source.stats() for name, source in self.sources.items()}
+        stats.update(self.counts)
+        return {"total_seconds": time.perf_counter() - self.start, "rss_mb": to_mb(current_rss()),
+                "peak_rss_mb": to_mb(peak_rss()), "stages": stages, "stats": stats}
+
+    def save(self, path):
+        """ Save the metrics to a JSON file. """
+        with open(path, "w") as output:
+            json.dump(self.to_dict(), output, indent=2)
+
+    def log(self):
+        """ Write the metrics to the logger as a single JSON line. """
+        if self.logger is not None:
+            self.logger.info("metrics: {}".format(json.dumps(self.to_dict())))
+
+    def report(self):
+        """ Return a table of the stages, one per line. """
+        metrics = self.to_dict()
+        lines = ["{:<18} {:>6} {:>10} {:>12} {:>12} {:>10}".format("stage", "calls", "seconds", "rows", "rows/s",
+                                                                      "memory MB")]
+        for stage in metrics["stages"]:
+            lines.append("{:<18} {:>6} {:>10.2f} {:>12} {:>12} {:>10}".format(
+                stage["name"], stage["calls"], stage["seconds"], "" if stage["rows"] is None else stage["rows"],
+                "" if stage["rows_per_second"] is None else "{:.0f}".format(stage["rows_per_second"]),
+                "" if stage["rss_delta_mb"] is None else "{:+.1f}".format(stage["rss_delta_mb"])))
+        lines.append("Total {:.2f}s, peak memory {} MB".format(
+            metrics["total_seconds"], "?" if metrics["peak_rss_mb"] is None else round(metrics["peak_rss_mb"], 1)))
+        for name, stats in metrics["stats"].items():
+            lines.append("{}: {}".format(name, json.dumps(stats)))
+        return "\n".join(lines)
+
+
+def measure(metrics, name, rows=None):
+    """ Measure a stage in metrics, or nothing if metrics is None, see Metrics.stage. """
+    return metrics.stage(name, rows) if metrics is not None else nullcontext({"rows": rows})
+
+
+@contextmanager
+def profile(path, nb_lines=25):
+    """
+    Profile the code run in the context with cProfile and tracemalloc, which slow it down. The cProfile statistics
+    are dumped to path (to be read with pstats or snakeviz), and the lines which allocated the most memory still in
+    use at the end to path + ".memory.txt". Only the current process is profiled, not the worker processes.
+    :param nb_lines: number of functions printed by cumulative time, and of lines written by memory
+    """
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.dump_stats(path)
+        with open(path + ".memory.txt", "w") as output:
+            output.write("Peak traced memory: {:.1f} MB\n".format(to_mb(peak)))
+            for stat in snapshot.statistics("lineno")[:nb_lines]:
+                output.write("{}\n".format(stat))
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats("cumulative").print_stats(nb_lines)
+        print("Saved the profile in: {} and the memory allocations in: {}.memory.txt".format(path, path))
+
+
+@contextmanager
+def instrument(metrics_path=None, profile_path=None):
+    """
+    Instrument a command: the context returns the Metrics of the command, printed and saved to metrics_path when it
+    ends, even on error, or None without metrics_path. The command is also profiled if profile_path is given, see
+    profile.
+    """
+    metrics = Metrics() if metrics_path else None
+    with profile(profile_path) if profile_path else nullcontext():
+        try:
+            yield metrics
+        except SystemExit as e:
+            # Exiting with an error status, e.g. on invalid arguments, leaves nothing to report
+            if e.code:
+                metrics = None
+            raise
+        finally:
+            if metrics is not None:
+                print(metrics.report())
+                metrics.save(metrics_path)
+                print("Saved the metrics in: {}".format(metrics_path))
@@ -1,5 +1,61 @@
-from random import choice, random
+import heapq
+import json
+import os
+import pickle
+import struct
+import tempfile
+import time
+from bisect import bisect_right
+from contextlib import contextmanager
 from math import log
+from random import choice, random, randrange
+
+try:
+    import numpy as np
+except ImportError:
+    # The Splunk app runs on Python distributions without numpy: pickled models are then scored one transition at a
+    # time, and binary models cannot be opened
+    np = None
+
+# Number of sequences encoded at once by the batch scoring engine, to bound the size of intermediate arrays
+SCORING_BATCH_SIZE = 100000
+# Number of sequences generated at once by the sampling engine
+SAMPLING_BATCH_SIZE = 100000
+
+# Binary model file format: magic, format version, header length, JSON header, then flat arrays. Version 2 adds the
+# out-of-vocabulary bucket of bounded symbol tables, models without it are still saved in version 1.
+MODEL_FILE_EXTENSION = ".amk"
+MODEL_FILE_MAGIC = b"ANOMARK\x00"
+MODEL_FILE_VERSION = 2
+MODEL_FILE_ALIGNMENT = 64
+MODEL_FILE_ARRAYS = ["context_keys", "offsets", "next_symbols", "counts", "log_probabilities", "entry_keys"]
+
+# Letter standing for the symbols outside a bounded symbol table, when ngrams of the bucket are decoded
+OOV_SYMBOL = "\ufffd"
+
+# Weight of new counts above which decayed counts are rescaled, before floats lose precision
+MAX_COUNT_WEIGHT = 1e100
+
+
+@contextmanager
+def atomic_write(path):
+    """
+    Open a temporary file in the folder of path for writing in binary mode, which replaces path once written. Other
+    processes reading or memory-mapping path keep the old file, and only ever open the old or the complete new one.
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    descriptor, temporary_path = tempfile.mkstemp(dir=folder, prefix=".{}.".format(os.path.basename(path)),
+                                                  suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "wb") as f:
+            # Temporary files are only readable by their owner, the new file keeps the permissions of the old one
+            os.chmod(temporary_path, os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644)
+            yield f
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
 
 
 def normalize_transition_matrix(matrix: dict):
@@ -13,7 +69,626 @@ def normalize_transition_matrix(matrix: dict):
     return output
 
 
+def encode_sequences(sequences, symbol_codepoints):
+    """
+    Encode a list of strings into a flat array of integer symbol codes.
+
+    Args:
+        sequences (list): The strings to encode
+        symbol_codepoints (np.ndarray): Sorted code points of the known symbols
+    Returns:
+        (np.ndarray, np.ndarray): The concatenated symbol codes and the length of each string. Characters missing
+                                  from the symbol table are given the out-of-vocabulary code len(symbol_codepoints).
+    """
+    lengths = np.fromiter((len(sequence) for sequence in sequences), dtype=np.int64, count=len(sequences))
+    codepoints = np.frombuffer("".join(sequences).encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+    nb_symbols = len(symbol_codepoints)
+    if not nb_symbols:
+        return np.zeros(len(codepoints), dtype=np.int64), lengths
+    codes = np.searchsorted(symbol_codepoints, codepoints)
+    unknown = symbol_codepoints[np.minimum(codes, nb_symbols - 1)] != codepoints
+    codes[unknown] = nb_symbols
+    return codes, lengths
+
+
+def transition_positions(lengths, order):
+    """
+    Locate every (ngram, next letter) transition of a batch of concatenated strings.
+
+    Returns:
+        (np.ndarray, np.ndarray): The position of each ngram start in the concatenated codes,
+                                  and the number of transitions of each string.
+    """
+    nb_transitions = np.maximum(lengths - order, 0)
+    starts = np.cumsum(lengths) - lengths
+    first_transition = np.cumsum(nb_transitions) - nb_transitions
+    positions = np.arange(nb_transitions.sum(), dtype=np.int64)
+    positions += np.repeat(starts - first_transition, nb_transitions)
+    return positions, nb_transitions
+
+
+def pack_windows(codes, positions, width, base):
+    """ Pack the `width` symbol codes starting at each position into a single integer, in base `base`. """
+    nb_windows = max(len(codes) - width + 1, 0)
+    keys = np.zeros(nb_windows, dtype=np.int64)
+    for j in range(width):
+        keys *= base
+        keys += codes[j:j + nb_windows]
+    return keys[positions]
+
+
+def code_dtype(nb_codes):
+    """ Return the smallest unsigned integer dtype holding codes from 0 to nb_codes - 1. """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if nb_codes <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.uint64
+
+
+def key_dtype(max_key):
+    """ Return the integer dtype of packed keys below max_key: 32 bits if they fit, so that searches read less. """
+    return np.int32 if max_key < 2 ** 31 else np.int64
+
+
+def bound_symbol_table(nb_symbols, ngram_codes, next_codes, row_lengths, weights, max_symbols):
+    """
+    Select the max_symbols most frequent symbols of a transition table, the other ones being merged into a single
+    out-of-vocabulary code. The frequency of a symbol is the weight of the transitions it is the next letter of,
+    plus the weight of the ngrams it appears in.
+
+    Args:
+        nb_symbols (int): The number of symbols, whose codes are 0 to nb_symbols - 1
+        ngram_codes (np.ndarray): The codes of the ngram of each row, one row per ngram
+        next_codes (np.ndarray): The code of the next letter of each transition, row after row
+        row_lengths (np.ndarray): The number of transitions of each row
+        weights (np.ndarray): The weight of each transition
+        max_symbols (int): The number of symbols kept
+    Returns:
+        (np.ndarray, np.ndarray): The sorted codes of the symbols kept, and the new code of each symbol, the
+                                  symbols not kept being given the out-of-vocabulary code max_symbols
+    """
+    frequencies = np.bincount(next_codes, weights=weights, minlength=nb_symbols)
+    row_weights = np.add.reduceat(weights, np.cumsum(row_lengths) - row_lengths) if len(weights) else weights
+    frequencies += np.bincount(ngram_codes.ravel(), weights=np.repeat(row_weights, ngram_codes.shape[1]),
+                               minlength=nb_symbols)
+    # Stable sort, ties are broken by code point
+    kept = np.sort(np.argsort(-frequencies, kind="stable")[:max_symbols])
+    code_map = np.full(nb_symbols, len(kept), dtype=np.int64)
+    code_map[kept] = np.arange(len(kept))
+    return kept, code_map
+
+
+def pack_ngrams(ngram_codes, base):
+    """ Pack each row of symbol codes into a single integer, in base `base`. """
+    keys = np.zeros(len(ngram_codes), dtype=np.int64)
+    for j in range(ngram_codes.shape[1]):
+        keys = keys * base + ngram_codes[:, j]
+    return keys
+
+
+def alias_tables(probabilities, offsets):
+    """
+    Build the alias tables of the distributions of the rows of a CSR transition table, to draw from any of them in
+    constant time: the k-th transition of a row of n transitions is drawn with probability 1 / n, then kept with
+    probability keep[k], or replaced by its alias otherwise.
+
+    The entries of each row are sorted by probability, and the columns are filled from both ends at once (the
+    smallest probability and the remainder of the largest one), one column of every row at each step.
+
+    Args:
+        probabilities (np.ndarray): The probability of each transition, summing to 1 over each row
+        offsets (np.ndarray): The transitions of the i-th row are the entries offsets[i]:offsets[i + 1]
+    Returns:
+        (np.ndarray, np.ndarray): The probability of keeping each entry, and its alias entry
+    """
+    row_lengths = np.diff(offsets)
+    nb_rows = len(row_lengths)
+    row_of_entries = np.repeat(np.arange(nb_rows, dtype=np.int64), row_lengths)
+    # Probabilities scaled by the row length, so that each column holds a mass of 1
+    scaled = probabilities * row_lengths[row_of_entries]
+    ascending = np.lexsort((scaled, row_of_entries))
+    keep = np.ones(len(probabilities), dtype=np.float64)
+    alias = np.arange(len(probabilities), dtype=np.int64)
+
+    rows = np.flatnonzero(row_lengths > 1)
+    small = offsets[rows].astype(np.int64)
+    large = offsets[rows + 1].astype(np.int64) - 1
+    remainder = scaled[ascending[large]]
+    while len(rows):
+        # Rows whose largest entry has less than a column left give it to the column of that entry, the others
+        # fill the column of their smallest entry
+        exhausted = remainder < 1
+        column = np.where(exhausted, large, small)
+        donor = np.where(exhausted, large - 1, large)
+        keep[ascending[column]] = np.minimum(np.where(exhausted, remainder, scaled[ascending[small]]), 1.)
+        alias[ascending[column]] = ascending[donor]
+        remainder = np.where(exhausted, scaled[ascending[donor]] - (1. - remainder),
+                             remainder - (1. - scaled[ascending[small]]))
+        small += ~exhausted
+        large -= exhausted
+        active = small < large
+        rows, small, large, remainder = rows[active], small[active], large[active], remainder[active]
+    return keep, alias
+
+
+class FrozenMarkovModel:
+    """
+    Compact read-only version of a trained MarkovModel.
+
+    The alphabet is mapped to integer codes and the transition table is stored in CSR layout: context_keys holds
+    the sorted integer-packed ngrams, and the transitions of the i-th ngram are the entries
+    offsets[i]:offsets[i + 1] of next_symbols, counts and log_probabilities, sorted by next symbol.
+    entry_keys packs (row, next symbol) of every transition so that they can be searched in a single pass.
+
+    Letters missing from symbols are given the out-of-vocabulary code len(symbols). With a bounded symbol table
+    (oov), the rare letters of the training data share that code, and its transitions are in the table.
+    """
+    # Whether the symbol table is bounded, see from_model
+    oov = False
+
+    def __init__(self, order, prior, symbols, context_keys, offsets, next_symbols, counts, log_probabilities,
+                 entry_keys=None, oov=False):
+        self.order = order
+        self.prior = prior
+        self.symbols = symbols
+        self.oov = oov
+        self.context_keys = context_keys
+        self.offsets = offsets
+        self.next_symbols = next_symbols
+        self.counts = counts
+        self.log_probabilities = log_probabilities
+
+        self.log_prior = log(prior)
+        self.symbol_codepoints = np.array([ord(symbol) for symbol in symbols], dtype=np.uint32)
+        self.base = len(symbols) + 1
+        if entry_keys is None:
+            # Transitions are globally sorted by (row, next symbol), searching them needs a single integer key
+            row_lengths = np.diff(offsets)
+            entry_keys = (np.repeat(np.arange(len(row_lengths), dtype=np.int64) * self.base, row_lengths)
+                          + next_symbols).astype(key_dtype(len(row_lengths) * self.base))
+        self.entry_keys = entry_keys
+        # Path of the file the arrays are memory-mapped from, if any
+        self.path = None
+        # Tables of the sampling engine and distributions of the ngrams simulated, computed when first needed
+        self._sampling_tables = None
+        self._distributions = None
+
+    @staticmethod
+    def fits(order, nb_symbols):
+        """ Whether ngrams of the given order can be packed in a signed 64-bit integer. """
+        return (nb_symbols + 1) ** order < 2 ** 63
+
+    @classmethod
+    def from_model(cls, model, max_symbols=None):
+        """
+        Compile a trained MarkovModel.
+
+        Args:
+            model (MarkovModel): The trained model
+            max_symbols (int): If the model has more symbols, only the max_symbols most frequent ones are kept, see
+                               bound_symbol_table. The transitions of the other ones are merged into those of the
+                               out-of-vocabulary code, and their probabilities computed again from the counts.
+        Raises:
+            ValueError: if the model has too many symbols to pack its ngrams in integers
+        """
+        model.check_if_trained()
+        if np is None:
+            raise ValueError("numpy is required to freeze a model")
+        order = model.order
+        symbols = "".join(sorted(set(model.alphabet) | set("".join(model.normed_chain))))
+        oov = max_symbols is not None and len(symbols) > max_symbols
+        nb_symbols = max_symbols if oov else len(symbols)
+        if not cls.fits(order, nb_symbols):
+            raise ValueError("Too many symbols ({}) to freeze a model of order {}".format(nb_symbols, order))
+        symbol_codepoints = np.array([ord(symbol) for symbol in symbols], dtype=np.uint32)
+
+        ngrams = list(model.normed_chain.keys())
+        row_lengths = np.array([len(model.normed_chain[ngram]) for ngram in ngrams], dtype=np.int64)
+        next_letters, counts, probabilities = [], [], []
+        for ngram in ngrams:
+            distribution = model.normed_chain[ngram]
+            ngram_counts = model.markov_chain.get(ngram, {})
+            next_letters.extend(distribution.keys())
+            probabilities.extend(distribution.values())
+            counts.extend(ngram_counts.get(next_letter, 0) for next_letter in distribution)
+        counts = np.array(counts, dtype=np.float64)
+        probabilities = np.array(probabilities, dtype=np.float64)
+        if model.count_weight != 1:
+            counts /= model.count_weight
+
+        ngram_codes, _ = encode_sequences(ngrams, symbol_codepoints)
+        ngram_codes = ngram_codes.reshape(len(ngrams), order)
+        next_codes, _ = encode_sequences(next_letters, symbol_codepoints)
+        # Transitions are weighted by their counts, or by their probabilities for models without counts
+        weights = counts if (counts > 0).all() else probabilities
+        if oov:
+            kept, code_map = bound_symbol_table(len(symbols), ngram_codes, next_codes, row_lengths, weights,
+                                                max_symbols)
+            symbols = "".join(symbols[code] for code in kept.tolist())
+            ngram_codes, next_codes = code_map[ngram_codes], code_map[next_codes]
+        ngram_keys = pack_ngrams(ngram_codes, len(symbols) + 1)
+
+        # Sorting the transitions by ngram key, then by next symbol
+        entry_ngram_keys = np.repeat(ngram_keys, row_lengths)
+        entry_order = np.lexsort((next_codes, entry_ngram_keys))
+        entry_ngram_keys, next_codes = entry_ngram_keys[entry_order], next_codes[entry_order]
+        counts, probabilities, weights = counts[entry_order], probabilities[entry_order], weights[entry_order]
+        if oov:
+            # Transitions merged into the out-of-vocabulary code are summed, and the distributions of the ngrams
+            # computed again
+            starts = np.flatnonzero(np.concatenate(([True], (entry_ngram_keys[1:] != entry_ngram_keys[:-1])
+                                                    | (next_codes[1:] != next_codes[:-1]))))
+            entry_ngram_keys, next_codes = entry_ngram_keys[starts], next_codes[starts]
+            counts, weights = np.add.reduceat(counts, starts), np.add.reduceat(weights, starts)
+        row_starts = np.flatnonzero(np.concatenate(([True], entry_ngram_keys[1:] != entry_ngram_keys[:-1])))
+        # An empty table has no rows
+        row_starts = row_starts[:len(entry_ngram_keys)]
+        offsets = np.append(row_starts, len(entry_ngram_keys))
+        if oov:
+            probabilities = weights / np.repeat(np.add.reduceat(weights, row_starts), np.diff(offsets))
+        # Arrays are stored in the smallest dtypes holding their values exactly
+        if (counts.astype(np.float32) == counts).all():
+            counts = counts.astype(np.float32)
+
+        return cls(
+            order=order,
+            prior=model.prior,
+            symbols=symbols,
+            context_keys=entry_ngram_keys[row_starts].astype(key_dtype((len(symbols) + 1) ** order)),
+            offsets=offsets.astype(key_dtype(len(next_codes) + 1)),
+            next_symbols=next_codes.astype(code_dtype(len(symbols) + 1)),
+            counts=counts,
+            log_probabilities=np.log(probabilities),
+            oov=oov,
+        )
+
+    def save(self, path):
+        """
+        Save the model in the binary model format, which can be memory-mapped by FrozenMarkovModel.load. The file is
+        replaced atomically, so that processes which mapped the previous version keep reading it.
+        """
+        arrays = {}
+        position = 0
+        for name in MODEL_FILE_ARRAYS:
+            array = np.ascontiguousarray(getattr(self, name))
+            arrays[name] = {"dtype": array.dtype.str, "offset": position, "length": len(array)}
+            position += -(-array.nbytes // MODEL_FILE_ALIGNMENT) * MODEL_FILE_ALIGNMENT
+        header = {"order": self.order, "prior": self.prior, "symbols": self.symbols, "arrays": arrays}
+        if self.oov:
+            header["oov"] = True
+        header = json.dumps(header).encode("utf-8")
+        # Arrays offsets are relative to the end of the header, which is aligned as well
+        header_size = len(MODEL_FILE_MAGIC) + 8 + len(header)
+        header += b" " * (-header_size % MODEL_FILE_ALIGNMENT)
+
+        with atomic_write(path) as f:
+            f.write(MODEL_FILE_MAGIC)
+            f.write(struct.pack("<II", MODEL_FILE_VERSION if self.oov else 1, len(header)))
+            f.write(header)
+            for name in MODEL_FILE_ARRAYS:
+                array = np.ascontiguousarray(getattr(self, name))
+                f.write(array.tobytes())
+                f.write(b"\x00" * (-array.nbytes % MODEL_FILE_ALIGNMENT))
+
+    @classmethod
+    def load(cls, path, memory_map=True):
+        """
+        Open a model saved with FrozenMarkovModel.save. With memory_map, the arrays are mapped from the file
+        instead of being read: no deserialization is needed and processes using the same file share its pages.
+        """
+        if np is None:
+            raise ValueError("numpy is required to open the binary model {}".format(path))
+        with open(path, "rb") as f:
+            if f.read(len(MODEL_FILE_MAGIC)) != MODEL_FILE_MAGIC:
+                raise ValueError("{} is not an AnoMark model file".format(path))
+            version, header_length = struct.unpack("<II", f.read(8))
+            if not 1 <= version <= MODEL_FILE_VERSION:
+                raise ValueError("Unsupported model file version {} in {}".format(version, path))
+            header = json.loads(f.read(header_length).decode("utf-8"))
+            data_start = len(MODEL_FILE_MAGIC) + 8 + header_length
+            if memory_map:
+                data = np.memmap(f, dtype=np.uint8, mode="r", offset=data_start)
+            else:
+                data = np.frombuffer(f.read(), dtype=np.uint8)
+
+        arrays = {}
+        for (name, description) in header["arrays"].items():
+            dtype = np.dtype(description["dtype"])
+            start = description["offset"]
+            arrays[name] = data[start:start + description["length"] * dtype.itemsize].view(dtype)
+        model = cls(order=header["order"], prior=header["prior"], symbols=header["symbols"],
+                    oov=header.get("oov", False), **arrays)
+        if memory_map:
+            model.path = path
+        return model
+
+    def __reduce_ex__(self, protocol):
+        if self.path is not None:
+            # Memory-mapped models are pickled as their path, and mapped again instead of being copied
+            return FrozenMarkovModel.load, (self.path,)
+        return super().__reduce_ex__(protocol)
+
+    def __getstate__(self):
+        # The sampling tables are derived from the probabilities, they are computed again when needed
+        state = self.__dict__.copy()
+        state["_sampling_tables"] = state["_distributions"] = None
+        return state
+
+    def thaw(self):
+        """
+        Rebuild a trainable MarkovModel from the transition counts.
+
+        Raises:
+            ValueError: if the symbol table is bounded, as the letters merged into its out-of-vocabulary code are lost
+        """
+        if self.oov:
+            raise ValueError("A model with a bounded symbol table cannot be trained again")
+        model = MarkovModel(self.order)
+        model.prior = self.prior
+        offsets = self.offsets.tolist()
+        next_letters = [self.symbols[code] for code in self.next_symbols.tolist()]
+        counts = [int(count) if count.is_integer() else count for count in self.counts.tolist()]
+        for (row, key) in enumerate(self.context_keys.tolist()):
+            start, end = offsets[row], offsets[row + 1]
+            model.markov_chain[self.decode_ngram(key)] = dict(zip(next_letters[start:end], counts[start:end]))
+        model.alphabet = self.alphabet
+        return model
+
+    @property
+    def alphabet(self):
+        letters = self.letters
+        return [letters[code] for code in np.unique(self.next_symbols)]
+
+    @property
+    def letters(self):
+        """ The letter of each code, out-of-vocabulary code included. """
+        return self.symbols + OOV_SYMBOL
+
+    def check_if_trained(self):
+        return True
+
+    def decode_ngram(self, key):
+        """ Return the ngram packed in an integer key. """
+        letters = self.letters
+        ngram = ""
+        for _ in range(self.order):
+            ngram = letters[key % self.base] + ngram
+            key //= self.base
+        return ngram
+
+    def find_contexts(self, keys):
+        """ Return the row of each packed ngram in the transition table, or -1 for unseen ngrams. """
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(self.context_keys):
+            # Searching keys of another dtype would convert the whole table
+            keys = keys.astype(self.context_keys.dtype, copy=False)
+            index = np.minimum(np.searchsorted(self.context_keys, keys), len(self.context_keys) - 1)
+            found = self.context_keys[index] == keys
+            rows[found] = index[found]
+        return rows
+
+    def find_transitions(self, rows, next_codes):
+        """ Return the entry of each (row, next symbol) transition, or -1 for unseen transitions. """
+        entries = np.full(len(rows), -1, dtype=np.int64)
+        if len(self.entry_keys):
+            keys = (rows * self.base + next_codes).astype(self.entry_keys.dtype, copy=False)
+            index = np.minimum(np.searchsorted(self.entry_keys, keys), len(self.entry_keys) - 1)
+            found = (rows >= 0) & (self.entry_keys[index] == keys)
+            entries[found] = index[found]
+        return entries
+
+    def transition_log_likelihoods(self, sequences):
+        """
+        Compute the log probability of every transition of a batch of sequences.
+
+        Returns:
+            (np.ndarray, np.ndarray): The log probabilities of all transitions, sequence after sequence,
+                                      and the number of transitions of each sequence.
+        """
+        codes, lengths = encode_sequences(sequences, self.symbol_codepoints)
+        positions, nb_transitions = transition_positions(lengths, self.order)
+
+        keys = pack_windows(codes, positions, self.order, self.base)
+        # Looking transitions up in ascending order keeps the binary searches cache-friendly
+        search_order = np.argsort(keys)
+        rows = self.find_contexts(keys[search_order])
+        entries = self.find_transitions(rows, codes[positions + self.order][search_order])
+
+        log_likelihoods = np.full(len(positions), self.log_prior)
+        found = entries >= 0
+        log_likelihoods[search_order[found]] = self.log_probabilities[entries[found]]
+        return log_likelihoods, nb_transitions
+
+    def score_batch(self, sequences):
+        """
+        Compute the log likelihood of many test sequences at once.
+
+        Args:
+            sequences (iterable): The sequences of interest
+        Returns:
+            (np.ndarray): The computed average log likelihood of each sequence.
+        """
+        sequences = [str(sequence) for sequence in sequences]
+        scores = []
+        for i in range(0, len(sequences), SCORING_BATCH_SIZE):
+            batch = sequences[i:i + SCORING_BATCH_SIZE]
+            log_likelihoods, nb_transitions = self.transition_log_likelihoods(batch)
+            sums = np.bincount(np.repeat(np.arange(len(batch)), nb_transitions), weights=log_likelihoods,
+                               minlength=len(batch))
+            batch_scores = np.full(len(batch), self.log_prior)
+            has_transitions = nb_transitions > 0
+            batch_scores[has_transitions] = 1 / nb_transitions[has_transitions].astype(np.float64) \
+                * sums[has_transitions]
+            scores.append(batch_scores)
+        return np.concatenate(scores) if scores else np.array([], dtype=np.float64)
+
+    def transition_log_probabilities(self, sequences):
+        """
+        Compute the log probability of each transition of each sequence, in one pass over the batch.
+
+        Args:
+            sequences (iterable): The sequences of interest
+        Returns:
+            (list): For each sequence, the np.ndarray of the log probabilities of the letters following its first
+                    order letters.
+        """
+        sequences = [str(sequence) for sequence in sequences]
+        log_probabilities = []
+        for i in range(0, len(sequences), SCORING_BATCH_SIZE):
+            log_likelihoods, nb_transitions = self.transition_log_likelihoods(sequences[i:i + SCORING_BATCH_SIZE])
+            log_probabilities.extend(np.split(log_likelihoods, np.cumsum(nb_transitions)[:-1]))
+        return log_probabilities
+
+    def log_likelihood(self, sequence):
+        """ Compute the average log likelihood of a test sequence, see MarkovModel.log_likelihood. """
+        return float(self.score_batch([sequence])[0])
+
+    def sampling_tables(self):
+        """
+        Return the tables of the sampling engine: the alias tables of the rows (see alias_tables), the row of the
+        ngram following each transition (-1 if that ngram was never seen), and the codes of the alphabet, drawn
+        uniformly after unseen ngrams.
+        """
+        if getattr(self, "_sampling_tables", None) is None:
+            row_lengths = np.diff(self.offsets)
+            row_of_entries = np.repeat(np.arange(len(row_lengths), dtype=np.int64), row_lengths)
+            probabilities = np.exp(self.log_probabilities)
+            # Normalizing again, so that rounding errors do not change the sum of a row
+            totals = np.add.reduceat(probabilities, self.offsets[:-1][row_lengths > 0])
+            probabilities /= np.repeat(totals, row_lengths[row_lengths > 0])
+            keep, alias = alias_tables(probabilities, self.offsets)
+            next_keys = self.context_keys[row_of_entries] % self.base ** max(self.order - 1, 0) * self.base \
+                + self.next_symbols if self.order else np.zeros(len(row_of_entries), dtype=np.int64)
+            self._sampling_tables = keep, alias, self.find_contexts(next_keys), \
+                np.unique(self.next_symbols).astype(np.int64)
+        return self._sampling_tables
+
+    def simulate(self, length, start=None):
+        """ Generate a new sequence drawn from the model, see MarkovModel.simulate. """
+        if start is None:
+            simulation = self.decode_ngram(int(self.context_keys[randrange(len(self.context_keys))]))
+        else:
+            simulation = start
+        length = max(0, length - len(simulation))
+
+        letters = list(simulation)
+        for i in range(length):
+            letters.append(self.generate_letter("".join(letters[len(letters) - self.order:])))
+        return "".join(letters)
+
+    def generate_letter(self, ngram):
+        """ Return a random letter from a ngram. """
+        distributions = getattr(self, "_distributions", None)
+        if distributions is None:
+            distributions = self._distributions = {}
+        distribution = distributions.get(ngram)
+        if distribution is None:
+            # Letters following the ngram with their cumulative probabilities, kept for the next letters
+            codes, _ = encode_sequences([ngram], self.symbol_codepoints)
+            row = self.find_contexts(pack_ngrams(codes.reshape(1, -1), self.base))[0] if len(ngram) == self.order \
+                else -1
+            if row < 0:
+                distribution = self.alphabet, None
+            else:
+                start, end = self.offsets[row], self.offsets[row + 1]
+                cumulative = np.cumsum(np.exp(self.log_probabilities[start:end]))
+                letters = self.letters
+                distribution = [letters[code] for code in self.next_symbols[start:end].tolist()], \
+                    (cumulative / cumulative[-1]).tolist()
+            distributions[ngram] = distribution
+        letters, cumulative = distribution
+        if cumulative is None:
+            return choice(letters)
+        return letters[min(bisect_right(cumulative, random()), len(letters) - 1)]
+
+    def sample(self, nb_sequences, length, start=None, seed=None):
+        """
+        Generate many sequences drawn from the model at once, each step drawing the next letter of all the
+        sequences together from the alias tables of their ngrams, see sampling_tables.
+
+        Args:
+            nb_sequences (int): The number of sequences to generate
+            length (int): The length of the sequences, start included
+            start (str): A starting portion of text shared by all the sequences. By default, each sequence starts
+                         from a ngram of the model drawn uniformly, as in simulate
+            seed (int or np.random.Generator): Seed of the random generator, the same seed always gives the same
+                                               sequences
+        Returns:
+            (list): The generated sequences
+        """
+        rng = np.random.default_rng(seed)
+        sequences = []
+        for i in range(0, nb_sequences, SAMPLING_BATCH_SIZE):
+            sequences.extend(self._sample_batch(min(nb_sequences - i, SAMPLING_BATCH_SIZE), length, start, rng))
+        return sequences
+
+    def _sample_batch(self, nb_sequences, length, start, rng):
+        order, base = self.order, self.base
+        keep, alias, next_rows, alphabet_codes = self.sampling_tables()
+        row_lengths = np.diff(self.offsets)
+        if start is None:
+            rows = rng.integers(len(self.context_keys), size=nb_sequences)
+            keys = self.context_keys[rows]
+            # Codes of the starting ngrams, from their packed keys
+            codes = np.empty((nb_sequences, max(length, order)), dtype=np.int64)
+            remaining = keys.copy()
+            for j in range(order - 1, -1, -1):
+                codes[:, j] = remaining % base
+                remaining //= base
+            nb_known = order
+        else:
+            start_codes, _ = encode_sequences([start[max(len(start) - order, 0):]], self.symbol_codepoints)
+            keys = np.full(nb_sequences, pack_ngrams(start_codes.reshape(1, -1), base)[0], dtype=np.int64)
+            # Ngrams shorter than the order, at the beginning of a short start, are unseen
+            rows = self.find_contexts(keys) if len(start) >= order else np.full(nb_sequences, -1, dtype=np.int64)
+            codes = np.empty((nb_sequences, max(length - len(start), 0)), dtype=np.int64)
+            nb_known = len(start)
+        first = codes.shape[1] - max(length - nb_known, 0)
+        modulus = base ** max(order - 1, 0)
+
+        for position in range(first, codes.shape[1]):
+            unseen = np.flatnonzero(rows < 0)
+            rows[unseen] = 0
+            # The integer part of the scaled uniform number picks a column of the alias table of the row, and its
+            # fractional part whether the column's entry or its alias is drawn
+            uniforms = rng.random(nb_sequences) * row_lengths[rows]
+            columns = np.minimum(uniforms.astype(np.int64), row_lengths[rows] - 1)
+            entries = self.offsets[rows] + columns
+            entries = np.where(uniforms - columns < keep[entries], entries, alias[entries])
+            next_codes = self.next_symbols[entries].astype(np.int64)
+            rows = next_rows[entries]
+            if len(unseen):
+                next_codes[unseen] = alphabet_codes[rng.integers(len(alphabet_codes), size=len(unseen))]
+            codes[:, position] = next_codes
+            if order:
+                keys = keys % modulus * base + next_codes
+            if len(unseen):
+                # Following an unseen ngram, the row of the new ngram is searched from its key
+                rows[unseen] = self.find_contexts(keys[unseen]) if nb_known + position - first + 1 >= order else -1
+
+        sequences = self.decode_codes(codes)
+        return [start + sequence for sequence in sequences] if start else sequences
+
+    def decode_codes(self, codes):
+        """ Return the string of each row of a matrix of symbol codes. """
+        width = codes.shape[1]
+        if not width:
+            return [""] * len(codes)
+        codepoints = np.append(self.symbol_codepoints, ord(OOV_SYMBOL)) if self.oov else self.symbol_codepoints
+        # Decoding all the rows as a single string, then slicing it, is much faster than building each string
+        if codepoints.max(initial=0) < 256:
+            text = codepoints.astype(np.uint8)[codes].tobytes().decode("latin-1")
+        else:
+            text = codepoints.astype("<u4")[codes].tobytes().decode("utf-32-le", "surrogatepass")
+        return [text[i:i + width] for i in range(0, len(text), width)]
+
+
 class MarkovModel:
+    # Counts of markov_chain are stored relative to the weight of a new occurrence, which grows as older counts are
+    # decayed by update: the actual count of a transition is its stored count divided by count_weight.
+    count_weight = 1.
+    # Time of the last update, to decay counts according to the time elapsed since
+    last_update_time = None
 
     def __init__(self, order):
         self.order = order
@@ -27,6 +702,10 @@ class MarkovModel:
         Parse input data to update Markov transition matrix. Could be called multiple times.
         """
 
+        known_letters = set(self.alphabet)
+        if self.count_weight != 1:
+            count = count * self.count_weight
+
         # Update transition matrix
         for i in range(len(training_data) - self.order):
             current_ngram = training_data[i: i + self.order]
@@ -34,10 +713,318 @@ class MarkovModel:
 
             self.markov_chain[current_ngram] = self.markov_chain.get(current_ngram, {})
             self.markov_chain[current_ngram][next_letter] = self.markov_chain[current_ngram].get(next_letter, 0) + count
-            if next_letter not in self.alphabet:
+            if next_letter not in known_letters:
+                known_letters.add(next_letter)
                 self.alphabet.append(next_letter)
 
+    def train_batch(self, training_data, counts=None):
+        """
+        Update the Markov transition matrix with many training sequences at once, with the same result as calling
+        train on each of them. Sequences are encoded to integers, and (ngram, next letter) transitions are counted
+        with array operations before being added to the transition matrix.
+
+        Args:
+            training_data (iterable): The training sequences
+            counts (iterable): The number of occurrences of each sequence (default: 1 for each)
+        """
+        self.add_transitions(*self.count_transitions(training_data, counts))
+
+    def count_transitions(self, training_data, counts=None):
+        """
+        Count the (ngram, next letter) transitions of training sequences.
+
+        Args:
+            training_data (iterable): The training sequences
+            counts (iterable): The number of occurrences of each sequence (default: 1 for each)
+        Returns:
+            (list, list): The distinct transitions, as strings of order + 1 letters in order of first occurrence,
+                          and their total count.
+        """
+        training_data = [str(sequence) for sequence in training_data]
+        counts = np.ones(len(training_data), dtype=np.int64) if counts is None else np.asarray(counts)
+        symbols = sorted(set("".join(training_data)))
+        base = max(len(symbols), 1)
+        if base ** (self.order + 1) >= 2 ** 63 or "\x00" in symbols:
+            # Too many symbols to pack transitions in integers, or null characters that numpy strings cannot hold
+            totals = {}
+            for (sequence, count) in zip(training_data, counts.tolist()):
+                for i in range(len(sequence) - self.order):
+                    transition = sequence[i:i + self.order + 1]
+                    totals[transition] = totals.get(transition, 0) + count
+            return list(totals), list(totals.values())
+
+        codes, lengths = encode_sequences(training_data, np.array([ord(symbol) for symbol in symbols],
+                                                                  dtype=np.uint32))
+        positions, nb_transitions = transition_positions(lengths, self.order)
+        if not len(positions):
+            return [], []
+        keys = pack_windows(codes, positions, self.order + 1, base)
+
+        # Summing the counts of each distinct transition
+        sort_index = np.argsort(keys)
+        sorted_keys = keys[sort_index]
+        starts = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+        totals = np.add.reduceat(np.repeat(counts, nb_transitions)[sort_index], starts)
+        # Transitions are added in order of first occurrence, as train does
+        fold_order = np.argsort(np.minimum.reduceat(sort_index, starts))
+        unique_keys, totals = sorted_keys[starts][fold_order], totals[fold_order]
+
+        digits = np.empty((len(unique_keys), self.order + 1), dtype=np.int64)
+        for j in range(self.order, -1, -1):
+            digits[:, j] = unique_keys % base
+            unique_keys = unique_keys // base
+        transitions = np.array(symbols)[digits].view("<U{}".format(self.order + 1)).ravel().tolist()
+        return transitions, totals.tolist()
+
+    def add_transitions(self, transitions, counts):
+        """
+        Add transition counts to the transition matrix.
+
+        Args:
+            transitions (list): Transitions as strings of order + 1 letters, see count_transitions
+            counts (list): The count of each transition
+        Returns:
+            (set): The ngrams whose distribution changed
+        """
+        known_letters = set(self.alphabet)
+        weight = self.count_weight
+        ngrams = set()
+        for (transition, count) in zip(transitions, counts):
+            current_ngram, next_letter = transition[:-1], transition[-1]
+            if weight != 1:
+                count = count * weight
+            ngrams.add(current_ngram)
+            distribution = self.markov_chain.get(current_ngram)
+            if distribution is None:
+                self.markov_chain[current_ngram] = {next_letter: count}
+            else:
+                distribution[next_letter] = distribution.get(next_letter, 0) + count
+            if next_letter not in known_letters:
+                known_letters.add(next_letter)
+                self.alphabet.append(next_letter)
+        return ngrams
+
+    def update(self, training_data, counts=None, decay=1., half_life=None, timestamp=None):
+        """
+        Update a trained model with new sequences, keeping it normalized: only the distributions of the ngrams
+        seen in the new sequences are normalized again, and the prior is maintained from the minimum probability
+        of each distribution, so that the cost of an update depends on the new data and not on the model size.
+
+        Existing counts can be decayed before adding the new ones, so that the model follows recent data. Decay is
+        applied by increasing the weight of new counts rather than by multiplying every count, see count_weight,
+        which leaves the normalized distributions unchanged.
+
+        Args:
+            training_data (iterable): The new sequences
+            counts (iterable): The number of occurrences of each sequence (default: 1 for each)
+            decay (float): Factor applied to the existing counts, between 0 (excluded) and 1
+            half_life (float): If given, existing counts are also decayed by half every half_life seconds elapsed
+                               since the previous update
+            timestamp (float): Time of the update for half_life, in seconds (default: now)
+        Returns:
+            (MarkovModel): This model, updated
+        """
+        if not 0 < decay <= 1:
+            raise ValueError("decay must be in ]0, 1], got {}".format(decay))
+        if half_life is not None:
+            timestamp = time.time() if timestamp is None else timestamp
+            if self.last_update_time is not None and timestamp > self.last_update_time:
+                decay *= 0.5 ** ((timestamp - self.last_update_time) / half_life)
+            self.last_update_time = timestamp
+        if not self.normed_chain:
+            if not self.markov_chain:
+                # Nothing to decay or update incrementally yet
+                self.train_batch(training_data, counts)
+                if self.markov_chain:
+                    self.normalize_model_and_compute_prior()
+                return self
+            # Trained but never normalized: normalizing it first so that its counts are decayed as well
+            self.normalize_model_and_compute_prior()
+
+        if decay != 1:
+            self.count_weight /= decay
+            # The counts of the frozen model are not decayed, only its probabilities are kept up to date
+            self._frozen_decayed = True
+            if self.count_weight > MAX_COUNT_WEIGHT:
+                self.rescale_counts()
+        ngrams = self.add_transitions(*self.count_transitions(training_data, counts))
+        if not ngrams:
+            return self
+
+        minimums = self._minimum_probabilities()
+        for ngram in ngrams:
+            distribution = self.markov_chain[ngram]
+            total = float(sum(distribution.values()))
+            self.normed_chain[ngram] = {key: count / total for (key, count) in distribution.items()}
+            minimum = min(distribution.values()) / total
+            if minimums.get(ngram) != minimum:
+                minimums[ngram] = minimum
+                heapq.heappush(self._minimum_heap, (minimum, ngram))
+        # Dropping the outdated minimums of updated distributions from the top of the heap
+        heap = self._minimum_heap
+        while minimums[heap[0][1]] != heap[0][0]:
+            heapq.heappop(heap)
+        if len(heap) > 2 * len(minimums):
+            self._minimum_heap = [(minimum, ngram) for (ngram, minimum) in minimums.items()]
+            heapq.heapify(self._minimum_heap)
+        prior_changed = self.prior != .01 * heap[0][0]
+        self.prior = .01 * heap[0][0]
+        self.alphabet = sorted(self.alphabet)
+        self._patch_frozen(ngrams, prior_changed)
+        return self
+
+    @property
+    def nb_transitions(self):
+        """ Number of distinct (ngram, next letter) transitions counted, which drives the memory used by the model. """
+        return sum(len(distribution) for distribution in self.markov_chain.values())
+
+    def prune(self, min_count=None, top_n=None, max_contexts=None, max_transitions=None):
+        """
+        Remove rare transitions from the transition matrix, to bound the size of the model. Removed transitions are
+        scored with the prior, like unseen ones, and the model is normalized again when needed.
+
+        Args:
+            min_count (float): Remove the transitions counted less than min_count times
+            top_n (int): Only keep the top_n most frequent next letters of each ngram
+            max_contexts (int): Only keep the max_contexts most frequent ngrams
+            max_transitions (int): Only keep the max_transitions most frequent transitions
+        Returns:
+            (int): The number of removed transitions
+        """
+        nb_transitions = self.nb_transitions
+        chain = self.markov_chain
+        if min_count is not None:
+            threshold = min_count * self.count_weight
+            chain = {ngram: {letter: count for (letter, count) in distribution.items() if count >= threshold}
+                     for (ngram, distribution) in chain.items()}
+        if top_n is not None:
+            chain = {ngram: distribution if len(distribution) <= top_n else
+                     {letter: distribution[letter] for letter in sorted(distribution, key=distribution.get,
+                                                                        reverse=True)[:top_n]}
+                     for (ngram, distribution) in chain.items()}
+        chain = {ngram: distribution for (ngram, distribution) in chain.items() if distribution}
+        if max_contexts is not None and len(chain) > max_contexts:
+            totals = np.fromiter((sum(distribution.values()) for distribution in chain.values()), dtype=np.float64,
+                                 count=len(chain))
+            # Stable sort, so that ties are broken in favor of the ngrams seen first
+            kept = np.zeros(len(chain), dtype=bool)
+            kept[np.argsort(-totals, kind="stable")[:max_contexts]] = True
+            chain = {ngram: distribution for (ngram, distribution), keep in zip(chain.items(), kept.tolist()) if keep}
+        if max_transitions is not None:
+            lengths = [len(distribution) for distribution in chain.values()]
+            if sum(lengths) > max_transitions:
+                counts = np.fromiter((count for distribution in chain.values() for count in distribution.values()),
+                                     dtype=np.float64, count=sum(lengths))
+                kept = np.zeros(len(counts), dtype=bool)
+                kept[np.argsort(-counts, kind="stable")[:max_transitions]] = True
+                kept = iter(kept.tolist())
+                chain = {ngram: {letter: count for (letter, count) in distribution.items() if next(kept)}
+                         for (ngram, distribution) in chain.items()}
+                chain = {ngram: distribution for (ngram, distribution) in chain.items() if distribution}
+
+        self.markov_chain = chain
+        # The normalized chain is computed again when needed
+        self.normed_chain = {}
+        self._frozen = None
+        self._minimums = None
+        return nb_transitions - self.nb_transitions
+
+    def rescale_counts(self):
+        """ Divide the stored counts by count_weight, so that they are the actual counts again. """
+        weight = self.count_weight
+        if weight != 1:
+            for distribution in self.markov_chain.values():
+                for key in distribution:
+                    distribution[key] /= weight
+            self.count_weight = 1.
+
+    def _minimum_probabilities(self):
+        """ Return the minimum probability of each distribution, which are kept in a heap as well. """
+        if getattr(self, "_minimums", None) is None:
+            self._minimums = {ngram: min(distribution.values()) for (ngram, distribution) in self.normed_chain.items()}
+            self._minimum_heap = [(minimum, ngram) for (ngram, minimum) in self._minimums.items()]
+            heapq.heapify(self._minimum_heap)
+        return self._minimums
+
+    def _patch_frozen(self, ngrams, prior_changed):
+        """
+        Update the rows of the frozen model cached for scoring after an update, when the updated ngrams have no new
+        transitions. Otherwise, the frozen model is dropped and compiled again when needed.
+        """
+        frozen = getattr(self, "_frozen", None)
+        if frozen is None:
+            return
+        ngrams = list(ngrams)
+        next_letters, probabilities, counts, row_lengths = [], [], [], []
+        for ngram in ngrams:
+            distribution = self.normed_chain[ngram]
+            next_letters.extend(distribution.keys())
+            probabilities.extend(distribution.values())
+            counts.extend(self.markov_chain[ngram].values())
+            row_lengths.append(len(distribution))
+        ngram_codes, _ = encode_sequences(ngrams, frozen.symbol_codepoints)
+        next_codes, _ = encode_sequences(next_letters, frozen.symbol_codepoints)
+        rows = frozen.find_contexts(pack_ngrams(ngram_codes.reshape(len(ngrams), self.order), frozen.base))
+        entries = frozen.find_transitions(np.repeat(rows, row_lengths), next_codes)
+        # Transitions are never removed, so the rows are unchanged if all their transitions are found. Unknown
+        # symbols are given a code which is in no transition.
+        if (entries < 0).any():
+            self._frozen = None
+            return
+        counts = np.array(counts, dtype=np.float64) / self.count_weight
+        if (counts.astype(frozen.counts.dtype) != counts).any():
+            # Decayed counts do not fit in compact dtypes
+            frozen.counts = frozen.counts.astype(np.float64)
+        frozen.log_probabilities[entries] = np.log(np.array(probabilities, dtype=np.float64))
+        frozen.counts[entries] = counts
+        frozen._sampling_tables = None
+        frozen._distributions = None
+        if prior_changed:
+            frozen.prior = self.prior
+            frozen.log_prior = log(self.prior)
+
+    def merge(self, other):
+        """
+        Add the transition counts of another model of the same order, as if this model had also been trained on
+        the training data of the other one.
+
+        Args:
+            other (MarkovModel): A model of the same order
+        Returns:
+            (MarkovModel): This model, updated
+        """
+        if other.order != self.order:
+            raise ValueError("Cannot merge a model of order {} into a model of order {}".format(other.order,
+                                                                                               self.order))
+        # Counts of both models are stored relative to their own weight
+        weight = self.count_weight / other.count_weight
+        for (ngram, counts) in other.markov_chain.items():
+            if weight != 1:
+                counts = {next_letter: count * weight for (next_letter, count) in counts.items()}
+            distribution = self.markov_chain.get(ngram)
+            if distribution is None:
+                self.markov_chain[ngram] = dict(counts)
+            else:
+                for (next_letter, count) in counts.items():
+                    distribution[next_letter] = distribution.get(next_letter, 0) + count
+        known_letters = set(self.alphabet)
+        self.alphabet.extend(letter for letter in other.alphabet if letter not in known_letters)
+        # The normalized chain is computed again when needed
+        self.normed_chain = {}
+        self._frozen = None
+        return self
+
+    def __getstate__(self):
+        # The frozen model and minimum probabilities are caches derived from the normalized chain, they are not
+        # saved with the model
+        state = self.__dict__.copy()
+        for cache in ("_frozen", "_frozen_decayed", "_minimums", "_minimum_heap"):
+            state.pop(cache, None)
+        return state
+
     def normalize_model_and_compute_prior(self):
+        self._frozen = None
+        self._minimums = None
         self.normed_chain = normalize_transition_matrix(self.markov_chain)
         self.alphabet = sorted(self.alphabet)
         # Computing the minimum probability as the prior of the model
@@ -57,6 +1044,11 @@ class MarkovModel:
                      drawn from the trained Markov model
         """
         self.check_if_trained()
+        try:
+            # The frozen model draws each letter by a binary search in precomputed cumulative probabilities
+            return self.freeze(exact_counts=False).simulate(length, start)
+        except ValueError:
+            pass
 
         if start is None:
             simulation = choice(list(self.normed_chain.keys()))
@@ -65,10 +1057,27 @@ class MarkovModel:
         length = max(0, length - len(simulation))
 
         # Random walk simulation
+        letters = list(simulation)
         for i in range(length):
-            ngram = simulation[-self.order:]
-            simulation += self.generate_letter(ngram)
-        return simulation
+            ngram = "".join(letters[-self.order:])
+            letters.append(self.generate_letter(ngram))
+        return "".join(letters)
+
+    def sample(self, nb_sequences, length, start=None, seed=None):
+        """
+        Generate many sequences drawn from the trained Markov model at once, see FrozenMarkovModel.sample.
+
+        Args:
+            nb_sequences (int): The number of sequences to generate
+            length (int): The length of the sequences, start included
+            start (str): A starting portion of text shared by all the sequences
+            seed (int or np.random.Generator): Seed of the random generator, for reproducible sequences
+        Returns:
+            (list): The generated sequences
+        Raises:
+            ValueError: if the model has too many symbols to be frozen
+        """
+        return self.freeze(exact_counts=False).sample(nb_sequences, length, start, seed)
 
     def generate_letter(self, ngram):
         """ Return a random letter from a ngram.  """
@@ -110,6 +1119,65 @@ class MarkovModel:
         # Averaging log likelihoods
         return 1 / float(len(log_likelihoods)) * sum(log_likelihoods)
 
+    def score_batch(self, sequences):
+        """
+        Compute the log likelihood of many test sequences at once, with the same result as log_likelihood.
+
+        Args:
+            sequences (iterable): The sequences of interest
+        Returns:
+            (np.ndarray): The computed average log likelihood of each sequence.
+        """
+        self.check_if_trained()
+        try:
+            frozen = self.freeze(exact_counts=False)
+        except ValueError:
+            # Too many symbols to pack ngrams in integers, or no numpy, scoring one sequence at a time
+            scores = [self.log_likelihood(str(sequence)) for sequence in sequences]
+            return np.array(scores, dtype=np.float64) if np is not None else scores
+        return frozen.score_batch(sequences)
+
+    def transition_log_probabilities(self, sequences):
+        """
+        Compute the log probability of each transition of each sequence, see FrozenMarkovModel.
+
+        Args:
+            sequences (iterable): The sequences of interest
+        Returns:
+            (list): For each sequence, the np.ndarray of the log probabilities of the letters following its first
+                    order letters.
+        """
+        self.check_if_trained()
+        try:
+            frozen = self.freeze(exact_counts=False)
+        except ValueError:
+            # Too many symbols to pack ngrams in integers, scoring one transition at a time
+            return [np.log(np.array([self.normed_chain.get(sequence[i:i + self.order], {}).get(
+                sequence[i + self.order], self.prior) for i in range(len(sequence) - self.order)], dtype=np.float64))
+                for sequence in map(str, sequences)]
+        return frozen.transition_log_probabilities(sequences)
+
+    def freeze(self, exact_counts=True, max_symbols=None):
+        """
+        Compile the normalized chain into a compact read-only FrozenMarkovModel. The result is cached until the
+        model is normalized again, and kept up to date by update.
+
+        Args:
+            exact_counts (bool): If False, the cached frozen model is returned even if its counts were not decayed
+                                 by update since it was compiled, which does not change its probabilities
+            max_symbols (int): Bound of the symbol table, see FrozenMarkovModel.from_model. Bounded models are not
+                               cached.
+        Raises:
+            ValueError: if the model has too many symbols to pack its ngrams in integers
+        """
+        self.check_if_trained()
+        if max_symbols is not None:
+            return FrozenMarkovModel.from_model(self, max_symbols)
+        if getattr(self, "_frozen", None) is None or (exact_counts and getattr(self, "_frozen_decayed", False)):
+            self._frozen = FrozenMarkovModel.from_model(self)
+            self._frozen_decayed = False
+        return self._frozen
+
     def check_if_trained(self):
         if not self.normed_chain:
             if not self.markov_chain:
@@ -118,3 +1186,262 @@ class MarkovModel:
                 self.normalize_model_and_compute_prior()
         else:
             return True
+
+
+class BackoffMarkovModel:
+    """
+    Variable-order Markov model, counting the transitions of every order from 0 to order in a single suffix trie:
+    a context is a path from the root following its letters from right to left, so that all the orders of a position
+    are looked up in a single walk, and contexts sharing their last letters share their nodes.
+
+    To keep the trie compact, each node is a single dict: next letters map to their count, the code points of the
+    letters extending the context on the left map to the child nodes, and None maps to the total count of the node.
+
+    Transitions whose context of the highest order was never seen back off to shorter contexts ("stupid backoff"):
+    the relative frequency of the letter after the longest context it was seen after is discounted by a factor
+    backoff for each letter of context dropped. Letters never seen at all get the prior.
+    """
+
+    def __init__(self, order, backoff=.4):
+        """
+        Args:
+            order (int): The longest context length
+            backoff (float): The discount applied for each order backed off, between 0 and 1
+        """
+        self.order = order
+        self.backoff = backoff
+        self.root = {None: 0}
+        self.prior = .001
+        self.alphabet = []
+        self.normalized = False
+
+    def train(self, training_data=None, count=1):
+        """
+        Parse input data to update the transition counts of every order. Could be called multiple times. The
+        transitions are the ones counted by a MarkovModel of the same order: letters following order letters.
+        """
+        self.train_batch([training_data], [count])
+
+    def train_batch(self, training_data, counts=None):
+        """
+        Update the transition counts with many training sequences at once. The transitions of each order are counted
+        with MarkovModel.count_transitions, and only distinct transitions are added to the trie.
+
+        Args:
+            training_data (iterable): The training sequences
+            counts (iterable): The number of occurrences of each sequence (default: 1 for each)
+        """
+        training_data = [str(sequence) for sequence in training_data]
+        known_letters = set(self.alphabet)
+        order = self.order
+        for j in range(order + 1):
+            # Only counting the letters following the first order letters, whatever the order of their context
+            transitions, totals = MarkovModel(j).count_transitions([sequence[order - j:] for sequence in training_data],
+                                                                   counts)
+            for (transition, count) in zip(transitions, totals):
+                node = self.root
+                # The nodes of the shorter contexts were added with the previous orders
+                for letter in transition[j - 1:0:-1]:
+                    node = node[ord(letter)]
+                if j:
+                    parent, code = node, ord(transition[0])
+                    node = parent.get(code)
+                    if node is None:
+                        node = parent[code] = {None: 0}
+                next_letter = transition[-1]
+                node[next_letter] = node.get(next_letter, 0) + count
+                node[None] += count
+                if not j and next_letter not in known_letters:
+                    known_letters.add(next_letter)
+                    self.alphabet.append(next_letter)
+        self.normalized = False
+
+    def merge(self, other):
+        """
+        Add the transition counts of another model of the same order, see MarkovModel.merge.
+
+        Returns:
+            (BackoffMarkovModel): This model, updated
+        """
+        if other.order != self.order:
+            raise ValueError("Cannot merge a model of order {} into a model of order {}".format(other.order,
+                                                                                               self.order))
+        nodes = [(self.root, other.root)]
+        while nodes:
+            node, other_node = nodes.pop()
+            for (key, value) in other_node.items():
+                if isinstance(key, int):
+                    child = node.get(key)
+                    if child is None:
+                        child = node[key] = {None: 0}
+                    nodes.append((child, value))
+                else:
+                    node[key] = node.get(key, 0) + value
+        known_letters = set(self.alphabet)
+        self.alphabet.extend(letter for letter in other.alphabet if letter not in known_letters)
+        self.normalized = False
+        return self
+
+    def nodes(self):
+        """ Iterate over the nodes of the trie, one per distinct context of every order. """
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            yield node
+            nodes.extend(value for (key, value) in node.items() if isinstance(key, int))
+
+    @property
+    def nb_contexts(self):
+        return sum(1 for _ in self.nodes())
+
+    def normalize_model_and_compute_prior(self):
+        """
+        Compute the prior from the lowest probability a seen letter can get: the minimum relative frequency after
+        any context, fully backed off.
+        """
+        minimum = min(min(count for (key, count) in node.items() if isinstance(key, str)) / node[None]
+                      for node in self.nodes())
+        self.alphabet = sorted(self.alphabet)
+        self.prior = .01 * minimum * self.backoff ** self.order
+        self.normalized = True
+
+    def check_if_trained(self):
+        if not self.normalized:
+            if not self.root[None]:
+                raise ValueError("Must train model before simulating new sequences")
+            self.normalize_model_and_compute_prior()
+        return True
+
+    def transition_probabilities(self, sequence):
+        """
+        Compute the probability of each transition of a sequence, and of each order, in a single walk of the trie
+        per transition.
+
+        Args:
+            sequence (str): A sequence of interest
+        Returns:
+            (list, list): The backed-off probability of the letters following the first order letters, and for each
+                          of them the list of its probabilities after its contexts of order 1 to order, or None
+                          where the letter was never seen after the context.
+        """
+        self.check_if_trained()
+        order, backoff, root = self.order, self.backoff, self.root
+        codes = [ord(letter) for letter in sequence]
+        probabilities, probabilities_by_order = [], []
+        for i in range(order, len(sequence)):
+            next_letter = sequence[i]
+            count = root.get(next_letter)
+            probability = count / root[None] * backoff ** order if count else self.prior
+            by_order = []
+            node = root
+            for j in range(1, order + 1):
+                node = node.get(codes[i - j]) if node is not None else None
+                count = node.get(next_letter) if node is not None else None
+                if count:
+                    by_order.append(count / node[None])
+                    probability = by_order[-1] * backoff ** (order - j)
+                else:
+                    by_order.append(None)
+            probabilities.append(probability)
+            probabilities_by_order.append(by_order)
+        return probabilities, probabilities_by_order
+
+    def log_likelihood(self, sequence):
+        """
+        Compute the average log likelihood of a test sequence, backing off to shorter contexts, see
+        MarkovModel.log_likelihood.
+        """
+        probabilities, _ = self.transition_probabilities(sequence)
+        if not probabilities:
+            return log(self.prior)
+        return sum(log(probability) for probability in probabilities) / len(probabilities)
+
+    def score_batch(self, sequences):
+        """
+        Compute the log likelihood of many test sequences, see log_likelihood.
+
+        Returns:
+            (np.ndarray): The computed average log likelihood of each sequence.
+        """
+        return np.array([self.log_likelihood(str(sequence)) for sequence in sequences], dtype=np.float64)
+
+    def score_orders(self, sequences):
+        """
+        Compute, in a single pass over each sequence, the log likelihood under every context length from 1 to order,
+        without backing off. Each column scores the same transitions, the letters following the first order letters
+        of the sequence, with the relative frequencies of the contexts of that length, and transitions unseen at that
+        length get the prior of this model. These are not the scores of fixed-order models trained separately, which
+        score every letter following their own first letters and have their own priors.
+
+        Returns:
+            (np.ndarray): The average log likelihood of each sequence (rows) for each order from 1 to order (columns).
+        """
+        self.check_if_trained()
+        log_prior = log(self.prior)
+        scores = []
+        for sequence in map(str, sequences):
+            _, probabilities_by_order = self.transition_probabilities(sequence)
+            if not probabilities_by_order:
+                scores.append([log_prior] * self.order)
+                continue
+            log_likelihoods = np.array([[log_prior if probability is None else log(probability)
+                                         for probability in by_order] for by_order in probabilities_by_order])
+            scores.append(log_likelihoods.mean(axis=0))
+        return np.array(scores, dtype=np.float64).reshape(-1, self.order)
+
+    def transition_log_probabilities(self, sequences):
+        """
+        Compute the log probability of each transition of each sequence, see MarkovModel.
+
+        Returns:
+            (list): For each sequence, the np.ndarray of the log probabilities of the letters following its first
+                    order letters.
+        """
+        return [np.log(np.array(self.transition_probabilities(sequence)[0], dtype=np.float64))
+                for sequence in map(str, sequences)]
+
+    def simulate(self, length, start=None):
+        """
+        Generate a new sequence drawn from the model, see MarkovModel.simulate. Without start, the simulation starts
+        from order letters drawn from the alphabet.
+        """
+        self.check_if_trained()
+        simulation = "".join(choice(self.alphabet) for _ in range(self.order)) if start is None else start
+        length = max(0, length - len(simulation))
+
+        for i in range(length):
+            simulation += self.generate_letter(simulation[-self.order:])
+        return simulation
+
+    def generate_letter(self, ngram):
+        """ Return a random letter following a ngram, drawn after the longest context of the ngram ever seen. """
+        self.check_if_trained()
+        node = self.root
+        for letter in reversed(ngram[-self.order:] if self.order else ""):
+            child = node.get(ord(letter))
+            if child is None:
+                break
+            node = child
+        r = random() * node[None]
+        for (letter, count) in node.items():
+            if isinstance(letter, str):
+                r -= count
+                if r <= 0:
+                    return letter
+        return choice(self.alphabet)
+
+
+def is_model_file(path):
+    """ Whether the file is saved in the binary model format rather than as a MarkovModel pickle. """
+    with open(path, "rb") as f:
+        return f.read(len(MODEL_FILE_MAGIC)) == MODEL_FILE_MAGIC
+
+
+def load_model(path, memory_map=True):
+    """
+    Load a model from a binary model file (as a FrozenMarkovModel) or from a MarkovModel pickle.
+    """
+    if is_model_file(path):
+        return FrozenMarkovModel.load(path, memory_map=memory_map)
+    with open(path, "rb") as f:
+        return pickle.load(f)
@@ -0,0 +1,99 @@
+import argparse
+
+from anomark.model_handler import MARKOV_SCORE, MarkovModelHandler as mmh
+from anomark.service import MAX_BATCH_SIZE, RELOAD_INTERVAL, model_name, serve
+from anomark.stream import BATCH_SIZE, MAX_BATCH_DELAY, QUEUE_SIZE, stream
+
+
+def parse_model_paths(parser, models):
+    """ Parse the name=path (or path) arguments of the models to serve. """
+    model_paths = {}
+    for model in models:
+        name, separator, path = model.partition("=")
+        if not separator:
+            name, path = model_name(model), model
+        if name in model_paths:
+            parser.error("Two models are named {}, name them with name=path".format(name))
+        model_paths[name] = path
+    return model_paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="anomark")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Serve models for batch scoring over HTTP or a Unix socket")
+    serve_parser.add_argument("-m", "--model", required=True, action="append",
+                              help="Model to serve, as name=path or path (named after its file). Can be repeated")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    serve_parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    serve_parser.add_argument("--unix-socket", help="Listen on this Unix socket instead of host:port")
+    serve_parser.add_argument("--concurrency", type=int, default=1, help="Number of scoring threads")
+    serve_parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE,
+                              help="Maximum number of values of concurrent requests scored at once")
+    serve_parser.add_argument("--max-delay", type=float, default=0.,
+                              help="Time in milliseconds a scoring thread waits for more requests to fill its batch")
+    serve_parser.add_argument("--threshold-percent", type=float, default=95,
+                              help="Percentage of the log prior under which a score is flagged as anomalous")
+    serve_parser.add_argument("--reload-interval", type=float, default=RELOAD_INTERVAL,
+                              help="Minimum time in seconds between two checks of the model files for hot reload")
+    serve_parser.add_argument("--verbose", action="store_true", help="Log every request")
+
+    stream_parser = subparsers.add_parser("stream", help="Score a stream of NDJSON records or raw lines from stdin "
+                                                         "or a named pipe, and write them with their score to stdout")
+    stream_parser.add_argument("-m", "--model", required=True, help="Path to the model to use")
+    stream_parser.add_argument("-f", "--field",
+                               help="Field of the NDJSON records to score, nested fields being separated by dots "
+                                    "(e.g. process.CommandLine). For raw lines, field the line is written to "
+                                    "(default: value)")
+    stream_parser.add_argument("-i", "--input", help="File or named pipe to read instead of stdin")
+    stream_parser.add_argument("--format", choices=["ndjson", "raw"], default="ndjson",
+                               help="One JSON record or one raw value per line")
+    stream_parser.add_argument("--score-field", default=MARKOV_SCORE, help="Field the score is written to")
+    stream_parser.add_argument("--anomalous-field", default="markovAnomalous",
+                               help="Field telling if the score is below the threshold (empty to leave it out)")
+    stream_parser.add_argument("--threshold-percent", type=float, default=95,
+                               help="Percentage of the log prior under which a score is flagged as anomalous")
+    stream_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Number of records scored at once")
+    stream_parser.add_argument("--max-delay", type=float, default=MAX_BATCH_DELAY * 1000,
+                               help="Time in milliseconds waited for more records to fill a batch")
+    stream_parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                               help="Number of records waiting to be scored or written before reading pauses")
+    stream_parser.add_argument("--memo-size", type=int, default=100000,
+                               help="Number of scores of distinct values kept in memory (0 to disable)")
+    stream_parser.add_argument("--placeholder", action="store_true",
+                               help="Apply GUID, SID, username, and hash replacement by placeholder")
+    stream_parser.add_argument("--filepath-placeholder", action="store_true", help="Apply filepath replacement")
+    stream_parser.add_argument("--placeholder-cache-size", type=int, default=100000,
+                               help="Number of normalized distinct values kept in memory (0 to disable)")
+    stream_parser.add_argument("--report-interval", type=float, default=10.,
+                               help="Time in seconds between two reports of the throughput and queue depths on "
+                                    "stderr (0 to disable)")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        if args.concurrency < 1 or args.max_batch_size < 1:
+            parser.error("--concurrency and --max-batch-size must be positive")
+        serve(parse_model_paths(parser, args.model), host=args.host, port=args.port, unix_socket=args.unix_socket,
+              concurrency=args.concurrency, max_batch_size=args.max_batch_size, max_delay=args.max_delay / 1000,
+              threshold_percent=args.threshold_percent, reload_interval=args.reload_interval, verbose=args.verbose)
+    elif args.command == "stream":
+        if args.format == "ndjson" and not args.field:
+            parser.error("--field is required for NDJSON records")
+        if args.batch_size < 1 or args.queue_size < 1:
+            parser.error("--batch-size and --queue-size must be positive")
+        try:
+            stream(mmh.load_model(args.model), path=args.input, field=args.field, input_format=args.format,
+                   score_field=args.score_field, anomalous_field=args.anomalous_field,
+                   threshold_percent=args.threshold_percent, batch_size=args.batch_size,
+                   max_delay=args.max_delay / 1000, queue_size=args.queue_size, memo_size=args.memo_size,
+                   apply_placeholder=args.placeholder,
+                   apply_filepath_placeholder=args.filepath_placeholder,
+                   placeholder_cache_size=args.placeholder_cache_size, report_interval=args.report_interval)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
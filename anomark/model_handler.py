@@ -1,57 +1,377 @@
 import datetime
+import json
+import os
 import pickle
 import sys
 import time
+from contextlib import nullcontext
+from functools import partial
 
 import numpy as np
 import pandas as pd
 
 # custom script for Markov Chains model
-from anomark.model import MarkovModel
-from anomark.utils.data_handler import apply_modules_to_df
+from anomark.model import MODEL_FILE_EXTENSION, BackoffMarkovModel, FrozenMarkovModel, MarkovModel, atomic_write
+from anomark.model import load_model as load_model_file
+from anomark.utils.aggregation import StreamingAggregator, aggregate_by_value, top_rows
+from anomark.utils.cache import LRUCache
+from anomark.utils.data_handler import PlaceholderEngine, apply_modules_to_df, apply_modules_to_str
+from anomark.utils.metrics import measure
+from anomark.utils.parallel import WorkerPool
 from pandas.errors import ParserError
 from tqdm import tqdm
 
 tqdm.pandas()
 
 MARKOV_SCORE = "markovScore"
+# Functions combining the scores of the columns of a line, scored by MarkovModelHandler.run_multi
+SCORE_COMBINATIONS = {"min": np.min, "mean": np.mean}
+# Number of lines counted at once by the vectorized training
+TRAINING_BATCH_SIZE = 100000
+# Number of characters of a text counted at once when the size of the model is bounded
+TRAINING_BLOCK_SIZE = 2 ** 22
+# Models over their budget during training are pruned down to this fraction of it, so that pruning is not repeated
+# at every batch
+PRUNING_TARGET = .75
 
 
-class MarkovModelHandler:
+def _score_values(model, values):
+    return model.score_batch("~" * int(model.order) + value for value in values)
 
-    @staticmethod
-    def run(model_path, data_path, col_name, store_bool=False, output="", nb_lines=50, color_output=False,
-            score_col_name=MARKOV_SCORE, verbose=True, apply_placeholder=False, show_percentage=False,
-            apply_filepath_placeholder=False):
 
-        with open(model_path, "rb") as f:
-            model: MarkovModel = pickle.load(f)
+def _score_field_values(models, values, field):
+    return _score_values(models[field], values)
 
-        df = MarkovModelHandler.load_data(data_path, col_name)
-        df[col_name] = df[col_name].astype(str)
 
-        if apply_placeholder:
-            print("Applying placeholder transformation...")
-            df = apply_modules_to_df(df, col_name, apply_filepath_placeholder)
+def field_score_column(column):
+    """ Name of the column holding the scores of a column, in the results of MarkovModelHandler.run_multi. """
+    return "{}_{}".format(MARKOV_SCORE, column)
+
+
+def _apply_placeholders(_, values, apply_filepath_placeholder=False):
+    engine = PlaceholderEngine(apply_filepath_placeholder)
+    return engine.apply_modules_to_list(values), engine.timings
+
+
+def _new_model(model):
+    """ Return an untrained model of the same kind and order as a model. """
+    if isinstance(model, BackoffMarkovModel):
+        return BackoffMarkovModel(model.order, backoff=model.backoff)
+    return MarkovModel(model.order)
+
+
+def _train_on_rows(template, rows):
+    model = _new_model(template)
+    for start in range(0, len(rows), TRAINING_BATCH_SIZE):
+        batch = rows[start:start + TRAINING_BATCH_SIZE]
+        model.train_batch(training_data=[row[0] for row in batch], counts=[row[1] for row in batch])
+    return model
 
-        result_grouped = MarkovModelHandler.execute_on_df(df, model, col_name, score_col_name)
+
+def _train_on_text(template, training_data):
+    model = _new_model(template)
+    model.train(training_data=training_data)
+    return model
+
+
+def _measure_chunks(chunks, metrics, name="load_data"):
+    """ Iterate over chunks of data, measuring the time spent reading each one as a stage of metrics. """
+    chunks = iter(chunks)
+    while True:
+        with measure(metrics, name) as record:
+            chunk = next(chunks, None)
+            record["rows"] = 0 if chunk is None else len(chunk)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def _add_cache_stats(metrics, **caches):
+    """ Report the statistics of the caches given in metrics, if any. """
+    if metrics is not None:
+        for name, cache in caches.items():
+            if cache is not None:
+                metrics.add_stats(name, cache)
+
+
+class MarkovModelHandler:
+
+    @staticmethod
+    def run(model_path, data_path, col_name, store_bool=False, output="", nb_lines=50, color_output=False,
+            score_col_name=MARKOV_SCORE, verbose=True, apply_placeholder=False, show_percentage=False,
+            apply_filepath_placeholder=False, memo=None, workers=1, placeholder_cache=None, explain=False,
+            max_values=None, top=None, metrics=None):
+        """
+        Score a dataset and aggregate it by distinct value of col_name.
+        :param top: if given, only the top values with the lowest scores are selected (without sorting all the
+        results), colored, formatted and saved. Otherwise, all the results are sorted by score and saved.
+        :param metrics: optional Metrics measuring each stage of the run
+        :return: the results sorted by score
+        """
+        _add_cache_stats(metrics, score_memo=memo, placeholder_cache=placeholder_cache)
+        with measure(metrics, "load_model"):
+            model = MarkovModelHandler.load_model(model_path)
+
+        with measure(metrics, "load_data") as record:
+            df = MarkovModelHandler.load_data(data_path, col_name)
+            df[col_name] = df[col_name].astype(str)
+            record["rows"] = len(df)
+
+        with MarkovModelHandler.worker_pool(model, workers) as pool:
+            if apply_placeholder:
+                print("Applying placeholder transformation...")
+                df = MarkovModelHandler.apply_placeholders(df, col_name, apply_filepath_placeholder, pool,
+                                                           placeholder_cache, metrics)
+
+            result_grouped = MarkovModelHandler.execute_on_df(df, model, col_name, score_col_name, memo=memo,
+                                                              pool=pool, max_values=max_values, sort=top is None,
+                                                              metrics=metrics)
+        if top is not None:
+            with measure(metrics, "top", len(result_grouped)):
+                result_grouped = top_rows(result_grouped, score_col_name, top)
         threshold = MarkovModelHandler.compute_threshold(model, percent=95)
 
         # Storing the results in a file if requested
         if store_bool or output:
-            if color_output:
-                result_grouped = MarkovModelHandler.add_color_column(result_grouped, model, threshold, col_name)
+            with measure(metrics, "colouring", len(result_grouped)):
+                result_grouped = MarkovModelHandler.add_letter_columns(result_grouped, model, threshold, col_name,
+                                                                       color=color_output, explain=explain)
 
-            if show_percentage:
-                result_grouped = MarkovModelHandler.add_percentage_column(result_grouped, model.prior, MARKOV_SCORE)
+                if show_percentage:
+                    result_grouped = MarkovModelHandler.add_percentage_column(result_grouped, model.prior,
+                                                                              MARKOV_SCORE)
 
-            MarkovModelHandler.save_execution_results(result_grouped, output)
+            with measure(metrics, "save", len(result_grouped)):
+                MarkovModelHandler.save_execution_results(result_grouped, output)
 
         # Displaying results in the terminal
         if verbose:
-            MarkovModelHandler.display_top(result_grouped, model, col_name, threshold, nb_lines, color_output, show_percentage)
+            with measure(metrics, "display"):
+                MarkovModelHandler.display_top(result_grouped, model, col_name, threshold, nb_lines, color_output,
+                                               show_percentage)
         return result_grouped
 
+    @staticmethod
+    def run_streaming(model_path, data_path, col_name, chunksize=100000, store_bool=False, output="", nb_lines=50,
+                      color_output=False, score_col_name=MARKOV_SCORE, verbose=True, apply_placeholder=False,
+                      show_percentage=False, apply_filepath_placeholder=False, max_groups=100000, max_values=100,
+                      memo=None, workers=1, placeholder_cache=None, explain=False, top=None, metrics=None):
+        """
+        Streaming version of run for inputs larger than memory: the data is read, scored and aggregated by chunks
+        of chunksize lines, and results are written as they leave the bounded aggregation (see
+        StreamingAggregator), so a value may appear on several lines of the output.
+        A memo (LRUCache) avoids scoring again the values already seen in previous chunks, and a placeholder_cache
+        avoids normalizing them again.
+        :param top: if given, only the top results with the lowest scores are kept aside during the aggregation and
+        saved at the end, instead of saving all the results
+        :param metrics: optional Metrics measuring each stage of the run, summed over the chunks
+        :return: the nb_lines results with the lowest scores, or the top results if top is given
+        """
+        _add_cache_stats(metrics, score_memo=memo, placeholder_cache=placeholder_cache)
+        with measure(metrics, "load_model"):
+            model = MarkovModelHandler.load_model(model_path)
+        threshold = MarkovModelHandler.compute_threshold(model, percent=95)
+        output_path = MarkovModelHandler.results_path(output) if store_bool or output else None
+
+        with open(output_path, "w", newline="") if output_path else nullcontext() as output_file, \
+                MarkovModelHandler.worker_pool(model, workers) as pool:
+            def write_results(result_grouped):
+                with measure(metrics, "colouring", len(result_grouped)):
+                    result_grouped = MarkovModelHandler.add_letter_columns(result_grouped, model, threshold,
+                                                                           col_name, color=color_output,
+                                                                           explain=explain)
+                    if show_percentage:
+                        result_grouped = MarkovModelHandler.add_percentage_column(result_grouped, model.prior,
+                                                                                  MARKOV_SCORE)
+                with measure(metrics, "save", len(result_grouped)):
+                    result_grouped.to_csv(output_file, header=output_file.tell() == 0, index=False)
+
+            aggregator = StreamingAggregator(col_name, score_col_name, max_groups=max_groups, max_values=max_values,
+                                             nb_top=nb_lines if top is None else top,
+                                             on_emit=write_results if output_path and top is None else None)
+            print("Applying model to data by chunks of {} lines".format(chunksize))
+            chunks = _measure_chunks(MarkovModelHandler.load_data_chunks(data_path, col_name, chunksize), metrics)
+            for df in tqdm(chunks, unit="chunk"):
+                df[col_name] = df[col_name].astype(str)
+                if apply_placeholder:
+                    df = MarkovModelHandler.apply_placeholders(df, col_name, apply_filepath_placeholder, pool,
+                                                               placeholder_cache, metrics)
+                with measure(metrics, "scoring", len(df)):
+                    df[score_col_name] = MarkovModelHandler.score_series(df[col_name], model, memo, pool)
+                with measure(metrics, "groupby", len(df)):
+                    aggregator.update(df)
+            with measure(metrics, "groupby"):
+                aggregator.flush()
+                result_top = aggregator.top_frame()
+            if output_path and top is not None:
+                write_results(result_top.copy())
+        if memo is not None:
+            print("Score memo: {}".format(memo.report()))
+
+        if output_path:
+            print("Successfully saved results in: {}".format(output_path))
+        if verbose:
+            with measure(metrics, "display"):
+                MarkovModelHandler.display_top(result_top, model, col_name, threshold, nb_lines, color_output,
+                                               show_percentage)
+        return result_top
+
+    @staticmethod
+    def run_multi(model_paths, data_path, chunksize=None, store_bool=False, output="", nb_lines=50,
+                  color_output=False, verbose=True, apply_placeholder=False, apply_filepath_placeholder=False,
+                  combine=None, memo_size=100000, workers=1, placeholder_cache=None, explain=False, top=None,
+                  metrics=None):
+        """
+        Score several columns of a dataset, each with its own model, in a single pass over the data. Lines are not
+        aggregated by value: each line is saved with the score of each column (see field_score_column), and their
+        combined score in MARKOV_SCORE if combine is given.
+        :param model_paths: dict of the path of the model of each column, a model used for several columns is
+        loaded once
+        :param chunksize: if given, the data is read, scored and saved by chunks of this number of lines, to keep
+        memory constant whatever the size of the input
+        :param combine: name of the function of SCORE_COMBINATIONS combining the scores of a line, "min" being the
+        score of its most unusual column
+        :param memo_size: number of scores of distinct values kept for each column (0 to disable)
+        :param top: if given, only the top lines with the lowest scores are saved, instead of all the lines in order
+        :param metrics: optional Metrics measuring each stage of the run
+        :return: the nb_lines lines with the lowest scores (combined, or of the first column), or the top lines
+        """
+        columns = list(model_paths)
+        score_columns = [field_score_column(column) for column in columns]
+        sort_column = MARKOV_SCORE if combine else score_columns[0]
+        with measure(metrics, "load_model"):
+            models_by_path = {path: MarkovModelHandler.load_model(path) for path in set(model_paths.values())}
+        models = {column: models_by_path[path] for (column, path) in model_paths.items()}
+        thresholds = {column: MarkovModelHandler.compute_threshold(model, percent=95)
+                      for (column, model) in models.items()}
+        # Scores depend on the model, each column has its own memo
+        memos = {column: LRUCache(memo_size) if memo_size > 0 else None for column in columns}
+        _add_cache_stats(metrics, placeholder_cache=placeholder_cache,
+                         **{"score_memo_{}".format(column): memo for (column, memo) in memos.items()})
+        output_path = MarkovModelHandler.results_path(output) if store_bool or output else None
+
+        def write_results(df):
+            with measure(metrics, "colouring", len(df)):
+                for column in columns:
+                    df = MarkovModelHandler.add_letter_columns(df, models[column], thresholds[column], column,
+                                                               color=color_output, explain=explain)
+            with measure(metrics, "save", len(df)):
+                df.to_csv(output_file, header=output_file.tell() == 0, index=False)
+
+        if chunksize:
+            chunks = MarkovModelHandler.load_data_chunks(data_path, columns[0], chunksize)
+        else:
+            chunks = [MarkovModelHandler.load_data(data_path, columns[0])]
+        result_top = None
+        with open(output_path, "w", newline="") if output_path else nullcontext() as output_file, \
+                MarkovModelHandler.worker_pool(models, workers) as pool:
+            for df in tqdm(_measure_chunks(chunks, metrics), unit="chunk", disable=not chunksize):
+                missing = [column for column in columns if column not in df.columns]
+                if missing:
+                    raise ValueError("Columns not found in {}: {}".format(data_path, ", ".join(missing)))
+                for column in columns:
+                    df[column] = df[column].astype(str)
+                    if apply_placeholder:
+                        df = MarkovModelHandler.apply_placeholders(df, column, apply_filepath_placeholder, pool,
+                                                                   placeholder_cache, metrics)
+                    with measure(metrics, "scoring", len(df)):
+                        df[field_score_column(column)] = MarkovModelHandler.score_series(
+                            df[column], models[column], memos[column], pool, field=column)
+                if combine:
+                    df[MARKOV_SCORE] = SCORE_COMBINATIONS[combine](df[score_columns].to_numpy(), axis=1)
+                with measure(metrics, "top", len(df)):
+                    result_top = top_rows(df if result_top is None else pd.concat([result_top, df]), sort_column,
+                                          nb_lines if top is None else top)
+                if output_path and top is None:
+                    write_results(df)
+            if output_path and top is not None:
+                write_results(result_top.copy())
+        for (column, memo) in memos.items():
+            if memo is not None:
+                print("Score memo of {}: {}".format(column, memo.report()))
+
+        if output_path:
+            print("Successfully saved results in: {}".format(output_path))
+        if verbose:
+            with measure(metrics, "display"):
+                MarkovModelHandler.display_top_fields(result_top, models, thresholds, sort_column, nb_lines,
+                                                      color_output)
+        return result_top
+
+    @staticmethod
+    def load_model_paths(config_path):
+        """
+        Load the path of the model of each column from a JSON config file, e.g. {"CommandLine": "cmdline.amk"}.
+        Relative paths are relative to the folder of the config file.
+        """
+        with open(config_path) as f:
+            model_paths = json.load(f)
+        if not isinstance(model_paths, dict) or not all(isinstance(path, str) for path in model_paths.values()):
+            raise ValueError("{} must map each column to the path of its model".format(config_path))
+        folder = os.path.dirname(os.path.abspath(config_path))
+        return {column: os.path.join(folder, path) for (column, path) in model_paths.items()}
+
+    @staticmethod
+    def load_model(model_path, trainable=False):
+        """
+        Load a model saved in the binary model format or as a MarkovModel pickle.
+        :param model_path: path of the model file
+        :param trainable: if True, returns a MarkovModel that can resume training. Otherwise the compact
+        FrozenMarkovModel is returned whenever possible, as it is faster to score with.
+        :return: the model
+        """
+        model = load_model_file(model_path)
+        if isinstance(model, BackoffMarkovModel):
+            # Backoff models are pickled before their prior is computed, and thresholds are computed from the prior
+            model.check_if_trained()
+        if trainable:
+            if isinstance(model, FrozenMarkovModel):
+                model = model.thaw()
+        elif isinstance(model, MarkovModel):
+            try:
+                model = model.freeze()
+            except ValueError:
+                pass
+        return model
+
+    @staticmethod
+    def worker_pool(model, workers):
+        """
+        Return a pool of worker processes sharing the model, or a null context if workers <= 1.
+        """
+        if workers and workers > 1:
+            return WorkerPool(workers, shared=model)
+        return nullcontext()
+
+    @staticmethod
+    def apply_placeholders(df: pd.DataFrame, col_name, apply_filepath_placeholder=False, pool=None, cache=None,
+                           metrics=None):
+        """
+        Apply the placeholders to a column, in the workers of the pool if one is given.
+        :param cache: LRUCache of normalized strings (see load_placeholder_cache), shared across calls
+        :param metrics: optional Metrics measuring the placeholder stage and the time spent in each module
+        """
+        engine = PlaceholderEngine(apply_filepath_placeholder, cache=cache)
+        with measure(metrics, "placeholder", len(df)):
+            if pool is None:
+                df = apply_modules_to_df(df, col_name, apply_filepath_placeholder, engine)
+            else:
+                def apply_modules(values):
+                    parts = pool.map(partial(_apply_placeholders,
+                                             apply_filepath_placeholder=apply_filepath_placeholder), values)
+                    # Summing the time spent by the workers in each module
+                    for (_, timings) in parts:
+                        engine.add_timings(timings)
+                    return [value for (part, _) in parts for value in part]
+
+                df[col_name] = engine.apply_to_list(df[col_name], apply_modules=apply_modules)
+        print(engine.report())
+        if metrics is not None:
+            metrics.add_counts("placeholder_module_seconds", engine.timings)
+            metrics.add_counts("placeholder_strings", {"strings": engine.nb_strings,
+                                                       "normalized": engine.nb_normalized})
+        return df
+
     @staticmethod
     def load_data(path, col_name):
         if path[-4:] == ".csv":
@@ -68,40 +388,141 @@ class MarkovModelHandler:
         return df
 
     @staticmethod
-    def colored_results(st: str, model: MarkovModel, threshold: float):
-        st = "~" * model.order + st
-        res = ""
+    def load_holdout(path, col_name, apply_placeholder=False, apply_filepath_placeholder=False):
+        """
+        Load held-out values from a column of a CSV file, or from the lines of a TXT file, see load_data.
+        :return: the list of values, with the placeholders applied if asked to
+        """
+        df = MarkovModelHandler.load_data(path, col_name).dropna(subset=[col_name])
+        df[col_name] = df[col_name].astype(str)
+        if apply_placeholder:
+            df = MarkovModelHandler.apply_placeholders(df, col_name, apply_filepath_placeholder)
+        return df[col_name].tolist()
+
+    @staticmethod
+    def load_data_chunks(path, col_name, chunksize):
+        """
+        Iterate over the data by dataframes of at most chunksize lines, see load_data.
+        """
+        if path[-4:] == ".txt":
+            with open(path, 'r') as f:
+                lines = []
+                for line in f:
+                    lines.append(line.rstrip("\n"))
+                    if len(lines) == chunksize:
+                        yield pd.DataFrame(lines, columns=[col_name])
+                        lines = []
+                if lines:
+                    yield pd.DataFrame(lines, columns=[col_name])
+        else:
+            try:
+                yield from pd.read_csv(path, chunksize=chunksize)
+            except ParserError:
+                raise ValueError("The path you provided leads to an unsupported data type. Prefer csv file")
+
+    @staticmethod
+    def transition_log_probabilities(values, model: MarkovModel):
+        """
+        Compute in one pass the log probability of each letter of each value, padded as for scoring.
+        :return: list of np.ndarray, one log probability per letter of each value
+        """
+        return model.transition_log_probabilities("~" * model.order + value for value in values)
+
+    @staticmethod
+    def colored_results(st: str, model: MarkovModel, threshold: float, log_probabilities=None):
+        """
+        Color in red the letters of st whose log probability is below the threshold.
+        :param log_probabilities: log probabilities of the letters of st, computed if not given
+        """
+        if log_probabilities is None:
+            log_probabilities = MarkovModelHandler.transition_log_probabilities([st], model)[0]
         begin_token = "\x1b[91m"
         end_token = "\x1b[0m"
-        for k in range(model.order, len(st)):
-            score = model.log_likelihood(st[k - model.order:k + 1])
-            if score < threshold:
-                res += begin_token + st[k] + end_token
-            else:
-                res += st[k]
-        res = res.replace(end_token + begin_token, "")
-        return res
+        unusual = log_probabilities < threshold
+        if not unusual.any():
+            return st
+        # Bounds of the runs of consecutive unusual letters
+        unusual = np.concatenate(([False], unusual, [False]))
+        bounds = np.flatnonzero(unusual[1:] != unusual[:-1]).tolist()
+        res = []
+        previous_end = 0
+        for (start, end) in zip(bounds[::2], bounds[1::2]):
+            res.append(st[previous_end:start] + begin_token + st[start:end] + end_token)
+            previous_end = end
+        res.append(st[previous_end:])
+        return "".join(res)
 
     @staticmethod
-    def execute_on_df(df: pd.DataFrame, model: MarkovModel, col_name, score_col_name=MARKOV_SCORE):
+    def explained_results(st: str, model: MarkovModel, threshold: float, log_probabilities=None, nb_letters=5):
+        """
+        Describe the nb_letters most unusual letters of st whose log probability is below the threshold, with the
+        letters preceding them and their log probability.
+        :param log_probabilities: log probabilities of the letters of st, computed if not given
+        """
+        if log_probabilities is None:
+            log_probabilities = MarkovModelHandler.transition_log_probabilities([st], model)[0]
+        padded = "~" * model.order + st
+        unusual = np.flatnonzero(log_probabilities < threshold)
+        unusual = unusual[np.argsort(log_probabilities[unusual], kind="stable")[:nb_letters]]
+        return " - ".join("{!r} after {!r} at {}: {:.2f}".format(st[i], padded[i:i + model.order], i,
+                                                                log_probabilities[i]) for i in unusual)
+
+    @staticmethod
+    def execute_on_df(df: pd.DataFrame, model: MarkovModel, col_name, score_col_name=MARKOV_SCORE, memo=None,
+                      pool=None, max_values=None, sort=True, metrics=None):
+        """
+        Score a dataframe and aggregate it by distinct value of col_name, see aggregate_by_value.
+        :param max_values: if given, only the first max_values distinct values of each other column are kept per value
+        :param sort: whether to sort the results by score
+        :param metrics: optional Metrics measuring the scoring and groupby stages
+        """
         print("Applying model to dataframe")
 
-        def apply_likelihood(col):
-            st = "~" * int(model.order) + str(col)
-            return model.log_likelihood(st)
-        df[score_col_name] = df[col_name].apply(str).progress_apply(apply_likelihood)
+        with measure(metrics, "scoring", len(df)):
+            df[score_col_name] = MarkovModelHandler.score_series(df[col_name], model, memo, pool)
 
-        df_cols = [col for col in list(df.columns) if col != col_name and col != score_col_name]
-        grouped_cols = {col: lambda x: ' - '.join(np.unique([str(_) for _ in x]))
-                        for col in df_cols}
-        grouped_cols.update({score_col_name: min})
-        result_grouped = df.groupby(col_name) \
-            .agg(grouped_cols) \
-            .reset_index().sort_values(score_col_name) \
-            .rename({_: 'List of all ' + str(_) for _ in df_cols}, axis=1)
+        with measure(metrics, "groupby", len(df)):
+            result_grouped = aggregate_by_value(df, col_name, score_col_name, max_values=max_values)
+            if sort:
+                result_grouped = result_grouped.sort_values(score_col_name)
 
+        print("Scored {} distinct values out of {} lines".format(len(result_grouped), len(df)))
+        if memo is not None:
+            print("Score memo: {}".format(memo.report()))
         return result_grouped
 
+    @staticmethod
+    def score_series(series: pd.Series, model: MarkovModel, memo=None, pool=None, field=None):
+        """
+        Compute the log likelihood of each value of a Series, padded at the beginning as during training.
+        Each distinct value is scored once, and the scores are broadcast back to the lines.
+        :param memo: optional LRUCache of the scores of values already seen, which must only be used with this model
+        :param pool: optional WorkerPool sharing the model, to score in parallel
+        :param field: if the pool shares a dict of models by field, the field whose model scores the values
+        :return: np.ndarray of scores
+        """
+        codes, values = pd.factorize(np.array([str(value) for value in series], dtype=object))
+        if memo is None:
+            return MarkovModelHandler.score_values(values, model, pool, field)[codes]
+
+        scores = np.array([memo.get(value, np.nan) for value in values], dtype=np.float64)
+        missing = np.flatnonzero(np.isnan(scores))
+        scores[missing] = MarkovModelHandler.score_values(values[missing], model, pool, field)
+        for i in missing:
+            memo.put(values[i], scores[i])
+        return scores[codes]
+
+    @staticmethod
+    def score_values(values, model: MarkovModel, pool=None, field=None):
+        """
+        Compute the log likelihood of each value, in the workers of the pool if one is given.
+        :param field: if the pool shares a dict of models by field, the field whose model scores the values
+        """
+        if pool is None:
+            return _score_values(model, values)
+        function = _score_values if field is None else partial(_score_field_values, field=field)
+        return np.concatenate(pool.map(function, values) + [np.array([], dtype=np.float64)])
+
     @staticmethod
     def compute_threshold(model, percent):
         """
@@ -116,13 +537,15 @@ class MarkovModelHandler:
     def display_top(df: pd.DataFrame, model: MarkovModel, col_name, threshold, nb_lines, color, show_percentage):
         print('_______')
         print("Displaying top {}".format(nb_lines))
-        df_slice = df.sort_values(MARKOV_SCORE)[:nb_lines]
+        df_slice = top_rows(df, MARKOV_SCORE, nb_lines)
 
-        for ind in df_slice.index:
+        log_probabilities = MarkovModelHandler.transition_log_probabilities(df_slice[col_name], model) if color \
+            else [None] * len(df_slice)
+        for (ind, elt_log_probabilities) in zip(df_slice.index, log_probabilities):
             print('_______')
             elt = df_slice.loc[ind, col_name]
             if color:
-                print(MarkovModelHandler.colored_results(elt, model, threshold))
+                print(MarkovModelHandler.colored_results(elt, model, threshold, elt_log_probabilities))
             else:
                 print(elt)
 
@@ -134,11 +557,65 @@ class MarkovModelHandler:
         print('_______')
 
     @staticmethod
-    def add_color_column(df: pd.DataFrame, model: MarkovModel, threshold: float, col_name):
+    def display_top_fields(df: pd.DataFrame, models, thresholds, score_col_name, nb_lines, color):
+        """ Display the lines with the lowest scores of run_multi, with the value and score of each column. """
+        print('_______')
+        print("Displaying top {}".format(nb_lines))
+        df_slice = top_rows(df, score_col_name, nb_lines)
+        for (_, row) in df_slice.iterrows():
+            print('_______')
+            print("{}: {:.4f}".format(score_col_name, row[score_col_name]))
+            for (column, model) in models.items():
+                value = row[column]
+                if color:
+                    value = MarkovModelHandler.colored_results(value, model, thresholds[column])
+                print("{} ({:.4f}): {}".format(column, row[field_score_column(column)], value))
+        print('_______')
+
+    @staticmethod
+    def add_color_column(df: pd.DataFrame, model: MarkovModel, threshold: float, col_name, log_probabilities=None):
+        """
+        :param log_probabilities: log probabilities of the letters of each value (see transition_log_probabilities),
+        computed if not given
+        """
         print("Adding color column")
+        if log_probabilities is None:
+            log_probabilities = MarkovModelHandler.transition_log_probabilities(df[col_name], model)
         # Adding a column with color in results
-        df["Colored {}".format(col_name)] = df[col_name] \
-            .progress_apply(lambda x: MarkovModelHandler.colored_results(x, model, threshold))
+        df["Colored {}".format(col_name)] = [
+            MarkovModelHandler.colored_results(value, model, threshold, value_log_probabilities)
+            for (value, value_log_probabilities) in zip(df[col_name], log_probabilities)]
+        return df
+
+    @staticmethod
+    def add_explanation_column(df: pd.DataFrame, model: MarkovModel, threshold: float, col_name,
+                               log_probabilities=None):
+        """
+        :param log_probabilities: log probabilities of the letters of each value (see transition_log_probabilities),
+        computed if not given
+        """
+        print("Adding explanation column")
+        if log_probabilities is None:
+            log_probabilities = MarkovModelHandler.transition_log_probabilities(df[col_name], model)
+        # Adding a column describing the most unusual letters in results
+        df["Explanation of {}".format(col_name)] = [
+            MarkovModelHandler.explained_results(value, model, threshold, value_log_probabilities)
+            for (value, value_log_probabilities) in zip(df[col_name], log_probabilities)]
+        return df
+
+    @staticmethod
+    def add_letter_columns(df: pd.DataFrame, model: MarkovModel, threshold: float, col_name, color=False,
+                           explain=False):
+        """
+        Add the color and explanation columns requested, computed from a single scoring pass over the letters.
+        """
+        if not (color or explain):
+            return df
+        log_probabilities = MarkovModelHandler.transition_log_probabilities(df[col_name], model)
+        if color:
+            df = MarkovModelHandler.add_color_column(df, model, threshold, col_name, log_probabilities)
+        if explain:
+            df = MarkovModelHandler.add_explanation_column(df, model, threshold, col_name, log_probabilities)
         return df
 
     @staticmethod
@@ -152,24 +629,36 @@ class MarkovModelHandler:
     @staticmethod
     def save_execution_results(df: pd.DataFrame, output: str = ""):
         print("Saving results...")
-        now = datetime.datetime.fromtimestamp(time.time())
-        if output:
-            output_path = output
-        else:
-            output_path = sys.path[0] + '/results/' + now.strftime("%Y%m%d_%Hh%M_") + 'export.csv'
+        output_path = MarkovModelHandler.results_path(output)
         # save the model to disk
         df.to_csv(output_path, index=False)
         print("Successfully saved results in: {}".format(output_path))
 
+    @staticmethod
+    def results_path(output: str = ""):
+        if output:
+            return output
+        now = datetime.datetime.fromtimestamp(time.time())
+        return sys.path[0] + '/results/' + now.strftime("%Y%m%d_%Hh%M_") + 'export.csv'
+
     @staticmethod
     def train_from_df(df: pd.DataFrame, model_order, train_col_name, count_col_name=None, save_model=True,
-                      save_path=None, model=None):
-        # Preprocessing text data by adding padding to get a complete scan
-        df[train_col_name] = df[train_col_name].apply(lambda x: '~' * model_order + str(x) + '~' * model_order)
-        # If there is no count column then each occurrence is set to 1
-        if not count_col_name:
-            count_col_name = "count_col"
-            df[count_col_name] = 1
+                      save_path=None, model=None, workers=1, pruning=None, holdout=None, metrics=None):
+        """
+        Train a model on the lines of a dataframe.
+        :param pruning: dict of the arguments of MarkovModel.prune applied after training. Its max_transitions is
+        also enforced during training, see enforce_budget
+        :param holdout: values left out of training, to report how pruning changes their scores. Not used with
+        max_transitions, whose budget prunes the model before the scores could be compared
+        :param metrics: optional Metrics measuring each stage of the training
+        """
+        with measure(metrics, "preprocessing", len(df)):
+            # Preprocessing text data by adding padding to get a complete scan
+            df[train_col_name] = df[train_col_name].apply(lambda x: '~' * model_order + str(x) + '~' * model_order)
+            # If there is no count column then each occurrence is set to 1
+            if not count_col_name:
+                count_col_name = "count_col"
+                df[count_col_name] = 1
 
         if not model:
             # Initiating model if none given
@@ -177,42 +666,297 @@ class MarkovModelHandler:
 
         # Training phase
         t0 = time.time()
-        df.progress_apply(lambda x: model.train(training_data=x[train_col_name], count=x[count_col_name]), axis=1)
+        max_transitions = (pruning or {}).get("max_transitions")
+        with MarkovModelHandler.worker_pool(_new_model(model), workers) as pool, \
+                measure(metrics, "training", len(df)):
+            MarkovModelHandler.update_from_df(model, df, train_col_name, count_col_name, pool=pool,
+                                              max_transitions=max_transitions)
+        print("Training took {:.2f} minutes".format((time.time() - t0) / 60))
+
+        if pruning:
+            with measure(metrics, "pruning"):
+                MarkovModelHandler.prune_model(model, pruning, holdout)
+
+        # Saving model if asked to
+        if save_model:
+            with measure(metrics, "save"):
+                MarkovModelHandler.save_model(model=model, save_path=save_path)
+
+        return model
+
+    @staticmethod
+    def train_from_txt(training_data, model_order, save_model=True, save_path=None, model=None, workers=1,
+                       pruning=None, holdout=None, metrics=None):
+        """
+        Train a model on a text.
+        :param pruning: dict of the arguments of MarkovModel.prune, see train_from_df
+        :param holdout: values left out of training, to report how pruning changes their scores. Not used with
+        max_transitions, whose budget prunes the model before the scores could be compared
+        :param metrics: optional Metrics measuring each stage of the training, in lines of the text
+        """
+        if not model:
+            # Initiating model if no model given
+            model = MarkovModel(model_order)
+
+        # Training phase
+        t0 = time.time()
+        max_transitions = (pruning or {}).get("max_transitions")
+        with MarkovModelHandler.worker_pool(_new_model(model), workers) as pool, \
+                measure(metrics, "training", training_data.count("\n") + 1):
+            MarkovModelHandler.update_from_txt(model, training_data, pool=pool, max_transitions=max_transitions)
         print("Training took {:.2f} minutes".format((time.time() - t0) / 60))
 
+        if pruning:
+            with measure(metrics, "pruning"):
+                MarkovModelHandler.prune_model(model, pruning, holdout)
+
+        # Saving model if asked to
+        if save_model:
+            with measure(metrics, "save"):
+                MarkovModelHandler.save_model(model=model, save_path=save_path)
+
+        return model
+
+    @staticmethod
+    def train_from_csv_chunks(path, model_order, train_col_name, count_col_name=None, chunksize=100000, n_lines=None,
+                              apply_placeholder=False, apply_filepath_placeholder=False, save_model=True,
+                              save_path=None, model=None, workers=1, placeholder_cache=None, pruning=None,
+                              holdout=None, metrics=None):
+        """
+        Train a model on a CSV (or TXT) file read by chunks of lines, so that memory scales with the model and not
+        with the data. The model is the same as the one train_from_df builds on the whole file.
+        :param chunksize: number of lines read, processed and counted at once
+        :param n_lines: only train on the first n_lines lines of the file
+        :param placeholder_cache: LRUCache of normalized lines, see load_placeholder_cache
+        :param pruning: dict of the arguments of MarkovModel.prune, see train_from_df
+        :param holdout: values left out of training, to report how pruning changes their scores. Not used with
+        max_transitions, whose budget prunes the model before the scores could be compared
+        :param metrics: optional Metrics measuring each stage of the training, summed over the chunks
+        """
+        if not model:
+            # Initiating model if none given
+            model = MarkovModel(model_order)
+        if not count_col_name:
+            count_col_name = "count_col"
+        _add_cache_stats(metrics, placeholder_cache=placeholder_cache)
+
+        # Training phase
+        t0 = time.time()
+        max_transitions = (pruning or {}).get("max_transitions")
+        nb_lines = 0
+        with MarkovModelHandler.worker_pool(_new_model(model), workers) as pool:
+            chunks = _measure_chunks(MarkovModelHandler.load_data_chunks(path, train_col_name, chunksize), metrics)
+            for df in tqdm(chunks, unit="chunk"):
+                if n_lines is not None:
+                    df = df.iloc[:int(n_lines) - nb_lines]
+                    if df.empty:
+                        break
+                nb_lines += len(df)
+                df[train_col_name] = df[train_col_name].astype(str)
+                if apply_placeholder:
+                    df = MarkovModelHandler.apply_placeholders(df, train_col_name, apply_filepath_placeholder, pool,
+                                                               placeholder_cache, metrics)
+                with measure(metrics, "preprocessing", len(df)):
+                    # Preprocessing text data by adding padding to get a complete scan
+                    padding = '~' * model.order
+                    df[train_col_name] = df[train_col_name].apply(lambda x: padding + str(x) + padding)
+                    if count_col_name not in df:
+                        df[count_col_name] = 1
+                with measure(metrics, "training", len(df)):
+                    MarkovModelHandler.update_from_df(model, df, train_col_name, count_col_name, pool=pool,
+                                                      max_transitions=max_transitions)
+        print("Training on {} lines took {:.2f} minutes".format(nb_lines, (time.time() - t0) / 60))
+
+        if pruning:
+            with measure(metrics, "pruning"):
+                MarkovModelHandler.prune_model(model, pruning, holdout)
+
         # Saving model if asked to
         if save_model:
-            MarkovModelHandler.save_model(model=model, save_path=save_path)
+            with measure(metrics, "save"):
+                MarkovModelHandler.save_model(model=model, save_path=save_path)
 
         return model
 
     @staticmethod
-    def train_from_txt(training_data, model_order, save_model=True, save_path=None, model=None):
+    def train_from_txt_chunks(path, model_order, chunksize=2 ** 24, apply_placeholder=False,
+                              apply_filepath_placeholder=False, save_model=True, save_path=None, model=None,
+                              workers=1, pruning=None, holdout=None, metrics=None):
+        """
+        Train a model on a text file read by blocks of lines, so that memory scales with the model and not with the
+        data. The last model_order letters of each block are carried over to the next one, so that the model is the
+        same as the one train_from_txt builds on the whole text.
+        :param chunksize: number of characters read at once, rounded up to the end of the line
+        :param pruning: dict of the arguments of MarkovModel.prune, see train_from_df
+        :param holdout: values left out of training, to report how pruning changes their scores. Not used with
+        max_transitions, whose budget prunes the model before the scores could be compared
+        :param metrics: optional Metrics measuring each stage of the training in lines, summed over the blocks
+        """
         if not model:
             # Initiating model if no model given
             model = MarkovModel(model_order)
 
         # Training phase
         t0 = time.time()
-        model.train(training_data=training_data)
+        max_transitions = (pruning or {}).get("max_transitions")
+        context = ""
+        with MarkovModelHandler.worker_pool(_new_model(model), workers) as pool, open(path, 'r') as f, \
+                tqdm(unit="char", unit_scale=True) as progress:
+            while True:
+                with measure(metrics, "load_data") as record:
+                    # Blocks end on a line break so that the placeholders only ever see whole lines
+                    block = f.read(chunksize)
+                    if block:
+                        block += f.readline()
+                    record["rows"] = block.count("\n") + (not block.endswith("\n") and bool(block))
+                if not block:
+                    break
+                progress.update(len(block))
+                if apply_placeholder:
+                    with measure(metrics, "placeholder", record["rows"]):
+                        block = apply_modules_to_str(text=block,
+                                                     apply_filepath_placeholder=apply_filepath_placeholder)
+                block = context + block
+                with measure(metrics, "training", record["rows"]):
+                    MarkovModelHandler.update_from_txt(model, block, pool=pool, max_transitions=max_transitions)
+                context = block[len(block) - model.order:]
         print("Training took {:.2f} minutes".format((time.time() - t0) / 60))
 
+        if pruning:
+            with measure(metrics, "pruning"):
+                MarkovModelHandler.prune_model(model, pruning, holdout)
+
         # Saving model if asked to
         if save_model:
-            MarkovModelHandler.save_model(model=model, save_path=save_path)
+            with measure(metrics, "save"):
+                MarkovModelHandler.save_model(model=model, save_path=save_path)
 
         return model
 
+    @staticmethod
+    def update_from_df(model: MarkovModel, df: pd.DataFrame, train_col_name, count_col_name, pool=None,
+                       max_transitions=None):
+        """
+        Count the transitions of the padded lines of a dataframe into the model.
+        :param pool: WorkerPool whose workers count shards of the lines, merged in order into the model
+        :param max_transitions: memory budget of the model, see enforce_budget
+        """
+        if pool is not None:
+            # Each worker trains a model on a shard of the lines, and the shards are merged in order
+            for shard in pool.map(_train_on_rows, zip(df[train_col_name], df[count_col_name])):
+                model.merge(shard)
+                MarkovModelHandler.enforce_budget(model, max_transitions)
+        else:
+            for start in tqdm(range(0, len(df), TRAINING_BATCH_SIZE), unit="batch",
+                              disable=len(df) <= TRAINING_BATCH_SIZE):
+                batch = df.iloc[start:start + TRAINING_BATCH_SIZE]
+                model.train_batch(training_data=batch[train_col_name], counts=batch[count_col_name].to_numpy())
+                MarkovModelHandler.enforce_budget(model, max_transitions)
+        return model
+
+    @staticmethod
+    def update_from_txt(model: MarkovModel, training_data, pool=None, max_transitions=None):
+        """
+        Count the transitions of a text into the model.
+        :param pool: WorkerPool whose workers count shards of the text, merged in order into the model
+        :param max_transitions: memory budget of the model, see enforce_budget
+        """
+        if pool is not None:
+            # Each worker trains a model on a shard of the text, shards overlapping by model_order letters so that
+            # every transition is counted exactly once, and the shards are merged in order
+            nb_transitions = max(len(training_data) - model.order, 0)
+            bounds = [nb_transitions * i // pool.workers for i in range(pool.workers + 1)]
+            shards = [training_data[start:end + model.order] for (start, end) in zip(bounds, bounds[1:])]
+            for shard in pool.map_parts(_train_on_text, shards):
+                model.merge(shard)
+                MarkovModelHandler.enforce_budget(model, max_transitions)
+        elif max_transitions is not None:
+            # Counting the text by blocks overlapping by model_order letters, to check the budget in between
+            for start in range(0, max(len(training_data) - model.order, 0), TRAINING_BLOCK_SIZE):
+                model.train(training_data=training_data[start:start + TRAINING_BLOCK_SIZE + model.order])
+                MarkovModelHandler.enforce_budget(model, max_transitions)
+        else:
+            model.train(training_data=training_data)
+        return model
+
+    @staticmethod
+    def enforce_budget(model: MarkovModel, max_transitions=None):
+        """
+        Keep the number of transitions of a model under a budget while it is trained: once over budget, the least
+        frequent transitions are pruned down to PRUNING_TARGET of it. Counts of the pruned transitions are lost, so
+        transitions seen again later start over from zero.
+        :param max_transitions: maximum number of transitions, or None for no budget
+        :return: the number of removed transitions
+        """
+        if max_transitions is None or model.nb_transitions <= max_transitions:
+            return 0
+        removed = model.prune(max_transitions=int(max_transitions * PRUNING_TARGET))
+        tqdm.write("Model over its budget of {} transitions, pruned {} transitions".format(max_transitions, removed))
+        return removed
+
+    @staticmethod
+    def prune_model(model: MarkovModel, pruning, holdout=None):
+        """
+        Prune a model, and report how its scores change on held-out values.
+        :param pruning: dict of the arguments of MarkovModel.prune
+        :param holdout: values left out of training, scored before and after pruning
+        :return: the score changes, see score_changes, or None without held-out values
+        """
+        reference_scores = None
+        if holdout is not None:
+            holdout = [str(value) for value in holdout]
+            reference_scores = MarkovModelHandler.score_values(holdout, model)
+        nb_contexts, nb_transitions = len(model.markov_chain), model.nb_transitions
+        removed = model.prune(**pruning)
+        print("Pruning removed {} of {} transitions ({:.1%}) and {} of {} contexts".format(
+            removed, nb_transitions, removed / nb_transitions if nb_transitions else 0.,
+            nb_contexts - len(model.markov_chain), nb_contexts))
+        if reference_scores is None:
+            return None
+        changes = MarkovModelHandler.score_changes(reference_scores, MarkovModelHandler.score_values(holdout, model))
+        print("Score changes on {} held-out values: mean absolute difference {:.4f}, maximum {:.4f}, rank "
+              "correlation {:.4f}, overlap of the {} most anomalous values {:.1%}".format(
+                len(holdout), changes["mean_abs_diff"], changes["max_abs_diff"], changes["rank_correlation"],
+                changes["nb_top"], changes["top_overlap"]))
+        return changes
+
+    @staticmethod
+    def score_changes(reference_scores, scores, top_fraction=.01):
+        """
+        Compare the scores of the same values by two models.
+        :param top_fraction: fraction of the values considered the most anomalous
+        :return: dict of the mean and maximum absolute differences, the Spearman correlation of the scores, and the
+        fraction of the nb_top most anomalous values by reference_scores also among the nb_top lowest scores
+        """
+        reference_scores, scores = np.asarray(reference_scores), np.asarray(scores)
+        if not len(scores):
+            return {"mean_abs_diff": 0., "max_abs_diff": 0., "rank_correlation": 1., "nb_top": 0, "top_overlap": 1.}
+        differences = np.abs(scores - reference_scores)
+        # Spearman correlation, as the correlation of the ranks
+        rank_correlation = pd.Series(reference_scores).rank().corr(pd.Series(scores).rank()) if len(scores) > 1 \
+            else np.nan
+        nb_top = max(int(len(scores) * top_fraction), 1)
+        top_reference = np.argsort(reference_scores, kind="stable")[:nb_top]
+        top = np.argsort(scores, kind="stable")[:nb_top]
+        return {"mean_abs_diff": float(differences.mean()), "max_abs_diff": float(differences.max()),
+                "rank_correlation": 1. if np.isnan(rank_correlation) else float(rank_correlation), "nb_top": nb_top,
+                "top_overlap": len(np.intersect1d(top_reference, top)) / nb_top}
+
     @staticmethod
     def save_model(model: MarkovModel, save_path=None):
-        # Saving model in pickle format
+        # Saving model in pickle format, or in the binary model format for frozen models
         print("Saving model...")
         now = datetime.datetime.fromtimestamp(time.time())
 
         if not save_path:
+            extension = MODEL_FILE_EXTENSION if isinstance(model, FrozenMarkovModel) else '.dump'
             save_path = sys.path[0] + '/models/' + now.strftime("%Y%m%d_%Hh%M_") + \
-                          'modelLetters_{}grams.dump'.format(model.order)
+                          'modelLetters_{}grams{}'.format(model.order, extension)
 
-        with open(save_path, "wb") as output:
-            pickle.dump(model, output, protocol=4)
+        if isinstance(model, FrozenMarkovModel):
+            model.save(save_path)
+        else:
+            # Replaced atomically, as the binary models, for processes loading the previous version
+            with atomic_write(save_path) as output:
+                pickle.dump(model, output, protocol=4)
         print("Successfully saved model in: {}".format(save_path))
@@ -0,0 +1,283 @@
+import json
+import os
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Queue
+from urllib.parse import parse_qs, urlparse
+
+from anomark.model_handler import MarkovModelHandler as mmh
+from anomark.utils.data_handler import apply_modules_to_str
+
+# Maximum number of values scored at once by a scoring thread
+MAX_BATCH_SIZE = 10000
+# Time a scoring thread waits for more requests to fill its batch, in seconds. With 0, a batch is made of the
+# requests already waiting, so batches only grow under load and a lone request is scored right away.
+MAX_BATCH_DELAY = 0.
+# Minimum time between two checks of the modification time of a model file, in seconds
+RELOAD_INTERVAL = 1.
+
+
+def model_name(path):
+    """ Default name of a served model: the name of its file without extension. """
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class ModelRegistry:
+    """
+    Models served by name, loaded once and reloaded when their file changes. If a new version of a file cannot be
+    loaded (e.g. while it is being written), the previous version of the model keeps being served.
+    """
+
+    def __init__(self, model_paths, threshold_percent=95, reload_interval=RELOAD_INTERVAL):
+        """
+        :param model_paths: dict of the paths of the models by name
+        :param threshold_percent: percentage of the log prior under which a score is flagged, see compute_threshold
+        :param reload_interval: minimum time between two checks of a model file, in seconds
+        """
+        self.model_paths = dict(model_paths)
+        self.threshold_percent = threshold_percent
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        # Loaded models by name, with the modification time of their file and their threshold
+        self.models = {}
+        self.last_checks = {}
+        for name in self.model_paths:
+            self.get(name)
+
+    def get(self, name):
+        """
+        Return a model and its threshold, reloading the model if its file changed.
+        :raise KeyError: if no model is served under this name
+        """
+        path = self.model_paths[name]
+        entry = self.models.get(name)
+        if entry is not None and time.monotonic() - self.last_checks[name] < self.reload_interval:
+            return entry[1], entry[2]
+
+        with self.lock:
+            self.last_checks[name] = time.monotonic()
+            entry = self.models.get(name)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                if entry is None or entry[0] != mtime:
+                    model = mmh.load_model(path)
+                    entry = (mtime, model, float(mmh.compute_threshold(model, self.threshold_percent)))
+                    self.models[name] = entry
+            except Exception:
+                if entry is None:
+                    raise
+        return entry[1], entry[2]
+
+    def describe(self):
+        return {name: {"path": self.model_paths[name], "order": model.order, "threshold": threshold}
+                for name in self.model_paths for (model, threshold) in [self.get(name)]}
+
+
+class MicroBatcher:
+    """
+    Score the values of concurrent requests together. Requests are queued, and each scoring thread takes the
+    requests waiting in the queue, up to max_batch_size values, and scores them with one call per model.
+    """
+
+    def __init__(self, registry: ModelRegistry, concurrency=1, max_batch_size=MAX_BATCH_SIZE,
+                 max_delay=MAX_BATCH_DELAY):
+        """
+        :param concurrency: number of scoring threads
+        :param max_batch_size: maximum number of values scored at once by a thread
+        :param max_delay: time a thread waits for more requests to fill its batch, in seconds
+        """
+        self.registry = registry
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue = Queue()
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(concurrency)]
+        for thread in self.threads:
+            thread.start()
+
+    def score(self, name, values):
+        """
+        Queue values to be scored by a model.
+        :return: Future of the np.ndarray of scores and the threshold of the model
+        """
+        future = Future()
+        self.queue.put((name, values, future))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            request = self.queue.get()
+            if request is None:
+                # Letting the other threads stop too
+                self.queue.put(None)
+                return
+            batch = [request]
+            size = len(request[1])
+            deadline = time.monotonic() + self.max_delay
+            while size < self.max_batch_size:
+                try:
+                    request = self.queue.get(timeout=max(deadline - time.monotonic(), 0)) if self.max_delay \
+                        else self.queue.get_nowait()
+                except Empty:
+                    break
+                if request is None:
+                    self.queue.put(None)
+                    break
+                batch.append(request)
+                size += len(request[1])
+            self._score(batch)
+
+    def _score(self, batch):
+        requests_by_model = {}
+        for (name, values, future) in batch:
+            requests_by_model.setdefault(name, []).append((values, future))
+
+        for (name, requests) in requests_by_model.items():
+            try:
+                model, threshold = self.registry.get(name)
+                scores = model.score_batch("~" * model.order + value for (values, _) in requests for value in values)
+            except Exception as e:
+                for (_, future) in requests:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for (values, future) in requests:
+                future.set_result((scores[start:start + len(values)], threshold))
+                start += len(values)
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP API of the scoring service:
+    - POST /score?model=<name>[&placeholder=1][&filepath_placeholder=1] with newline-delimited JSON strings as body
+    returns one JSON object per line, {"score": <average log likelihood>, "anomalous": <score below threshold>}.
+    The model can be omitted when a single model is served.
+    - GET /models returns the served models, and GET /health returns {"status": "ok"}.
+    """
+    protocol_version = "HTTP/1.1"
+    # Sending small responses right away in a single packet, instead of waiting for the client to acknowledge the
+    # headers before sending the body
+    disable_nagle_algorithm = True
+    wbufsize = 1 << 16
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif path == "/models":
+            self._send_json(200, self.server.registry.describe())
+        else:
+            self._send_json(404, {"error": "Unknown path {}".format(path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if url.path != "/score":
+            self._send_json(404, {"error": "Unknown path {}".format(url.path)})
+            return
+
+        query = parse_qs(url.query)
+        model_paths = self.server.registry.model_paths
+        name = query.get("model", [None])[0]
+        if name is None and len(model_paths) == 1:
+            name = next(iter(model_paths))
+        if name not in model_paths:
+            self._send_json(404, {"error": "Unknown model {}, served models: {}".format(name, list(model_paths))})
+            return
+        try:
+            values = [str(json.loads(line)) for line in body.decode("utf-8").splitlines() if line.strip()]
+        except ValueError as e:
+            self._send_json(400, {"error": "Body must be newline-delimited JSON strings: {}".format(e)})
+            return
+
+        if query.get("placeholder", ["0"])[0] not in ("0", "false"):
+            apply_filepath_placeholder = query.get("filepath_placeholder", ["0"])[0] not in ("0", "false")
+            values = [apply_modules_to_str(value, apply_filepath_placeholder) for value in values]
+        try:
+            scores, threshold = self.server.batcher.score(name, values).result()
+        except Exception as e:
+            self._send_json(500, {"error": "Scoring failed: {}".format(e)})
+            return
+        lines = [json.dumps({"score": score, "anomalous": score < threshold}) for score in scores.tolist()]
+        self._send(200, "".join(line + "\n" for line in lines).encode("utf-8"), "application/x-ndjson")
+
+    def _send_json(self, status, content):
+        self._send(status, json.dumps(content).encode("utf-8"), "application/json")
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def setup(self):
+        # Unix sockets have no Nagle algorithm to disable
+        self.disable_nagle_algorithm = isinstance(self.client_address, tuple)
+        super().setup()
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ScoringHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, registry, batcher, verbose=False):
+        self.registry = registry
+        self.batcher = batcher
+        self.verbose = verbose
+        super().__init__(address, ScoringRequestHandler)
+
+
+class ScoringUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, registry, batcher, verbose=False):
+        self.registry = registry
+        self.batcher = batcher
+        self.verbose = verbose
+        # Replacing the socket of a previous run
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, ScoringRequestHandler)
+
+
+def make_server(model_paths, host="127.0.0.1", port=8000, unix_socket=None, concurrency=1,
+                max_batch_size=MAX_BATCH_SIZE, max_delay=MAX_BATCH_DELAY, threshold_percent=95,
+                reload_interval=RELOAD_INTERVAL, verbose=False):
+    """
+    Load the models and create the scoring server, listening on a Unix socket if a path is given, or on host:port.
+    :param model_paths: dict of the paths of the models to serve by name
+    :return: the server, whose batcher must be closed after the server
+    """
+    registry = ModelRegistry(model_paths, threshold_percent=threshold_percent, reload_interval=reload_interval)
+    batcher = MicroBatcher(registry, concurrency=concurrency, max_batch_size=max_batch_size, max_delay=max_delay)
+    if unix_socket:
+        return ScoringUnixServer(unix_socket, registry, batcher, verbose=verbose)
+    return ScoringHTTPServer((host, port), registry, batcher, verbose=verbose)
+
+
+def serve(model_paths, **kwargs):
+    """ Run the scoring server until interrupted, see make_server. """
+    server = make_server(model_paths, **kwargs)
+    print("Serving models {} on {}".format(", ".join(model_paths), server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
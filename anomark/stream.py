@@ -0,0 +1,275 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+
+from anomark.model_handler import MARKOV_SCORE, MarkovModelHandler as mmh
+from anomark.utils.cache import LRUCache
+from anomark.utils.data_handler import PlaceholderEngine
+
+# Number of records scored at once
+BATCH_SIZE = 1000
+# Time spent waiting for more records to fill a batch, in seconds
+MAX_BATCH_DELAY = 0.05
+# Number of records waiting to be scored, and of scored records waiting to be written, before reading stops
+QUEUE_SIZE = 10000
+# Size of the blocks read from the input
+READ_SIZE = 1 << 16
+
+
+def get_field(record, field):
+    """ Return the value of a dotted field (e.g. "event.CommandLine") of a record, or None if it is missing. """
+    for key in field.split("."):
+        if not isinstance(record, dict) or key not in record:
+            return None
+        record = record[key]
+    return record
+
+
+class FileReader:
+    """
+    Reader of a regular file, which the event loop cannot watch, read by a thread. The thread reads blocks into a
+    bounded queue, so that it pauses when the blocks are not consumed.
+    """
+
+    def __init__(self, file, loop, queue_size=4):
+        self.blocks = asyncio.Queue(queue_size)
+        self.at_eof = False
+        thread = threading.Thread(target=self._read_blocks, args=(file, loop), daemon=True)
+        thread.start()
+
+    def _read_blocks(self, file, loop):
+        with file:
+            for block in iter(lambda: file.read(READ_SIZE), b""):
+                asyncio.run_coroutine_threadsafe(self.blocks.put(block), loop).result()
+        asyncio.run_coroutine_threadsafe(self.blocks.put(b""), loop).result()
+
+    async def read(self, _=-1):
+        """ Return the next block of the file, or b"" at its end. """
+        if self.at_eof:
+            return b""
+        block = await self.blocks.get()
+        self.at_eof = not block
+        return block
+
+
+async def open_reader(path=None):
+    """
+    Return a reader of a file, a named pipe, or stdin if no path is given, whose read coroutine returns the data
+    available, up to a given size, and b"" at the end of the input.
+    """
+    loop = asyncio.get_running_loop()
+    file = sys.stdin.buffer if path is None else open(path, "rb")
+    reader = asyncio.StreamReader(limit=READ_SIZE)
+    try:
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), file)
+    except ValueError:
+        # Regular files, e.g. stdin redirected from a file, cannot be read through a pipe transport
+        return FileReader(file, loop)
+    return reader
+
+
+class StreamScorer:
+    """
+    Score the records of a log stream in micro-batches, and write them enriched with their score.
+
+    The stream goes through bounded queues between a reading, a scoring and a writing task: when scoring or writing
+    falls behind, the queues fill up and reading pauses, which pushes back on the producer of the stream.
+    """
+
+    def __init__(self, model, field=None, input_format="ndjson", score_field=MARKOV_SCORE,
+                 anomalous_field="markovAnomalous", threshold_percent=95, batch_size=BATCH_SIZE,
+                 max_delay=MAX_BATCH_DELAY, queue_size=QUEUE_SIZE, memo=None, placeholder_engine=None,
+                 report_interval=10., output=None, log=None):
+        """
+        :param model: model scoring the values
+        :param field: dotted field holding the value to score in NDJSON records, or name of the field holding the
+        line in the output records for raw lines
+        :param input_format: "ndjson" for one JSON record per line, or "raw" for one value per line
+        :param score_field: field of the output records holding the score
+        :param anomalous_field: field of the output records telling if the score is below the threshold (None to
+        leave it out)
+        :param threshold_percent: percentage of the log prior under which a score is anomalous, see compute_threshold
+        :param batch_size: maximum number of records scored at once
+        :param max_delay: time spent waiting for more records to fill a batch, in seconds
+        :param queue_size: maximum number of records waiting in each queue
+        :param memo: optional LRUCache of the scores of values already seen
+        :param placeholder_engine: optional PlaceholderEngine applied to the values before scoring
+        :param report_interval: time between two reports of the throughput and queue depths, in seconds (0 disables)
+        :param output: text stream the records are written to, stdout by default
+        :param log: text stream the reports and errors are written to, stderr by default
+        """
+        if input_format not in ("ndjson", "raw"):
+            raise ValueError("Unknown input format {}, expected ndjson or raw".format(input_format))
+        if input_format == "ndjson" and not field:
+            raise ValueError("A field to score is needed for NDJSON records")
+        self.model = model
+        self.field = field or "value"
+        self.input_format = input_format
+        self.score_field = score_field
+        self.anomalous_field = anomalous_field
+        self.threshold = float(mmh.compute_threshold(model, threshold_percent))
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue_size = queue_size
+        self.memo = memo
+        self.placeholder_engine = placeholder_engine
+        self.report_interval = report_interval
+        self.output = output if output is not None else sys.stdout
+        self.log = log if log is not None else sys.stderr
+        self.nb_read = 0
+        self.nb_scored = 0
+        self.nb_written = 0
+        self.nb_errors = 0
+
+    async def run(self, path=None):
+        """ Score the records read from a file or named pipe, or from stdin if no path is given, until its end. """
+        self.start = time.monotonic()
+        reader = await open_reader(path)
+        # Queues hold batches, their size is counted in records
+        records = asyncio.Queue(max(self.queue_size // self.batch_size, 1))
+        scored = asyncio.Queue(max(self.queue_size // self.batch_size, 1))
+        reporter = asyncio.ensure_future(self._report()) if self.report_interval else None
+        try:
+            await asyncio.gather(self._read(reader, records), self._score(records, scored), self._write(scored))
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+        self._print_report(time.monotonic() - self.start)
+
+    def parse(self, line):
+        """ Return the record of a line and the value to score, or None if the line is not a valid record. """
+        line = line.decode("utf-8", errors="replace").rstrip("\r\n")
+        if self.input_format == "raw":
+            return {self.field: line}, line
+        if not line.strip():
+            return None
+        try:
+            record = json.loads(line)
+        except ValueError:
+            self.nb_errors += 1
+            print("Skipping invalid JSON record: {}".format(line[:200]), file=self.log)
+            return None
+        value = get_field(record, self.field)
+        return record, None if value is None else str(value)
+
+    def score_values(self, values):
+        """ Score a batch of values, None for missing values. """
+        present = [value for value in values if value is not None]
+        if self.placeholder_engine is not None:
+            present = self.placeholder_engine.apply_to_list(present)
+        distinct = list(dict.fromkeys(present))
+        scores = {}
+        missing = []
+        for value in distinct:
+            score = self.memo.get(value) if self.memo is not None else None
+            if score is None:
+                missing.append(value)
+            else:
+                scores[value] = score
+        order = self.model.order
+        for (value, score) in zip(missing, self.model.score_batch("~" * order + value for value in missing).tolist()):
+            scores[value] = score
+            if self.memo is not None:
+                self.memo.put(value, score)
+        present = iter(present)
+        return [None if value is None else scores[next(present)] for value in values]
+
+    async def _read(self, reader, records):
+        batch = []
+        deadline = None
+        # Beginning of a line whose end has not been read yet
+        pending = b""
+        while True:
+            try:
+                if batch:
+                    data = await asyncio.wait_for(reader.read(READ_SIZE), max(deadline - time.monotonic(), 0))
+                else:
+                    data = await reader.read(READ_SIZE)
+            except asyncio.TimeoutError:
+                # Sending a partial batch when records come slowly
+                await records.put(batch)
+                batch, deadline = [], None
+                continue
+            if not data:
+                break
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                parsed = self.parse(line)
+                if parsed is None:
+                    continue
+                self.nb_read += 1
+                batch.append(parsed)
+                if len(batch) >= self.batch_size:
+                    await records.put(batch)
+                    batch = []
+            if not batch:
+                deadline = None
+            elif deadline is None:
+                deadline = time.monotonic() + self.max_delay
+        parsed = self.parse(pending) if pending else None
+        if parsed is not None:
+            self.nb_read += 1
+            batch.append(parsed)
+        if batch:
+            await records.put(batch)
+        await records.put(None)
+
+    async def _score(self, records, scored):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await records.get()
+            if batch is None:
+                await scored.put(None)
+                return
+            # Scoring in a thread keeps reading and writing going meanwhile
+            scores = await loop.run_in_executor(None, self.score_values, [value for (_, value) in batch])
+            self.nb_scored += len(batch)
+            await scored.put([(record, score) for ((record, _), score) in zip(batch, scores)])
+
+    async def _write(self, scored):
+        while True:
+            batch = await scored.get()
+            if batch is None:
+                self.output.flush()
+                return
+            for (record, score) in batch:
+                record[self.score_field] = score
+                if self.anomalous_field:
+                    record[self.anomalous_field] = None if score is None else score < self.threshold
+                self.output.write(json.dumps(record) + "\n")
+            self.nb_written += len(batch)
+            if scored.empty():
+                self.output.flush()
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self._print_report(time.monotonic() - self.start)
+
+    def _print_report(self, duration):
+        report = "{} records read, {} written ({:.0f} records/s), {} invalid, {} waiting to be scored, {} waiting to " \
+                 "be written".format(self.nb_read, self.nb_written, self.nb_written / duration if duration else 0.,
+                                     self.nb_errors, self.nb_read - self.nb_scored, self.nb_scored - self.nb_written)
+        if self.memo is not None:
+            report += ", score memo: {}".format(self.memo.report())
+        print(report, file=self.log, flush=True)
+
+
+def stream(model, path=None, memo_size=100000, apply_placeholder=False, apply_filepath_placeholder=False,
+           placeholder_cache_size=100000, **kwargs):
+    """
+    Score a stream of records read from a file or named pipe, or from stdin, see StreamScorer.
+    :param memo_size: number of scores of distinct values kept in memory (0 to disable)
+    :param placeholder_cache_size: number of normalized values kept in memory (0 to disable)
+    """
+    memo = LRUCache(memo_size) if memo_size > 0 else None
+    placeholder_engine = None
+    if apply_placeholder:
+        cache = LRUCache(placeholder_cache_size) if placeholder_cache_size > 0 else None
+        placeholder_engine = PlaceholderEngine(apply_filepath_placeholder, cache=cache)
+    scorer = StreamScorer(model, memo=memo, placeholder_engine=placeholder_engine, **kwargs)
+    asyncio.run(scorer.run(path))
+    return scorer
@@ -0,0 +1,174 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+def list_column_name(column):
+    return 'List of all ' + str(column)
+
+
+def top_rows(df: pd.DataFrame, score_col_name, nb_rows):
+    """
+    Return the nb_rows rows with the lowest scores, sorted by score, selecting them with a partial sort instead of
+    sorting the whole dataframe.
+    """
+    scores = df[score_col_name].to_numpy()
+    if nb_rows < len(scores):
+        selected = np.argpartition(scores, nb_rows)[:nb_rows] if nb_rows > 0 else np.array([], dtype=np.int64)
+    else:
+        selected = np.arange(len(scores))
+    return df.iloc[selected[np.argsort(scores[selected], kind="stable")]]
+
+
+class StreamingAggregator:
+    """
+    Running aggregation of scored chunks by distinct value of a column, keeping the minimum score and the set of
+    values of the other columns, as MarkovModelHandler.execute_on_df does on a whole dataframe.
+
+    Memory is bounded: at most max_groups distinct values are aggregated at once, the least recently seen groups
+    being emitted when the limit is reached, and at most max_values values are kept per group and column.
+    A value seen again after its group was emitted starts a new group, so it may be emitted several times.
+    The nb_top groups with the lowest scores among all emitted groups are kept aside.
+    """
+
+    def __init__(self, col_name, score_col_name, max_groups=100000, max_values=100, nb_top=50, on_emit=None):
+        """
+        :param col_name: column to group by
+        :param score_col_name: column holding the scores
+        :param max_groups: maximum number of groups aggregated at once
+        :param max_values: maximum number of distinct values kept per group for each other column
+        :param nb_top: number of groups with the lowest scores to keep
+        :param on_emit: function called with a dataframe of the groups leaving the aggregation
+        """
+        self.col_name = col_name
+        self.score_col_name = score_col_name
+        self.max_groups = max_groups
+        self.max_values = max_values
+        self.nb_top = nb_top
+        self.on_emit = on_emit
+        self.other_cols = None
+        self.groups = OrderedDict()
+        self.top = {}
+        self.top_threshold = float("inf")
+
+    def update(self, df: pd.DataFrame):
+        """ Aggregate a scored chunk. """
+        if self.other_cols is None:
+            self.other_cols = [col for col in df.columns if col != self.col_name and col != self.score_col_name]
+
+        for (value, score) in df.groupby(self.col_name)[self.score_col_name].min().items():
+            entry = self.groups.get(value)
+            if entry is None:
+                self.groups[value] = [score, [set() for _ in self.other_cols]]
+            else:
+                entry[0] = min(entry[0], score)
+                self.groups.move_to_end(value)
+
+        for (i, col) in enumerate(self.other_cols):
+            pairs = df[[self.col_name, col]].drop_duplicates()
+            # Missing values have no group, as in groupby and aggregate_by_value
+            pairs = pairs[pairs[self.col_name].notna()]
+            for (value, other_value) in zip(pairs[self.col_name], pairs[col]):
+                values = self.groups[value][1][i]
+                if len(values) < self.max_values:
+                    values.add(str(other_value))
+
+        evicted = []
+        while len(self.groups) > self.max_groups:
+            evicted.append(self.groups.popitem(last=False))
+        self._emit(evicted)
+
+    def flush(self):
+        """ Emit all the groups still aggregated. """
+        evicted = list(self.groups.items())
+        self.groups.clear()
+        self._emit(evicted)
+
+    def top_frame(self):
+        """ Return the nb_top emitted groups with the lowest scores, sorted by score. """
+        return self._to_frame(self.top.items()).sort_values(self.score_col_name)
+
+    def _emit(self, groups):
+        if not groups:
+            return
+        for (value, (score, values)) in groups:
+            top_entry = self.top.get(value)
+            if top_entry is not None:
+                top_entry[0] = min(top_entry[0], score)
+                for (top_values, col_values) in zip(top_entry[1], values):
+                    top_values.update(list(col_values)[:max(self.max_values - len(top_values), 0)])
+            elif len(self.top) < self.nb_top or score < self.top_threshold:
+                self.top[value] = [score, [set(col_values) for col_values in values]]
+        if len(self.top) >= self.nb_top:
+            kept = sorted(self.top, key=lambda value: self.top[value][0])[:self.nb_top]
+            self.top = {value: self.top[value] for value in kept}
+            # Groups with a higher score can no longer enter the top
+            self.top_threshold = self.top[kept[-1]][0] if kept else float("-inf")
+
+        if self.on_emit is not None:
+            self.on_emit(self._to_frame(groups))
+
+    def _to_frame(self, groups):
+        groups = list(groups)
+        data = {self.col_name: [value for (value, _) in groups]}
+        for (i, col) in enumerate(self.other_cols or []):
+            data[list_column_name(col)] = [' - '.join(sorted(values[i])) for (_, (_, values)) in groups]
+        data[self.score_col_name] = [score for (_, (score, _)) in groups]
+        return pd.DataFrame(data)
+
+
+def string_codes(values):
+    """
+    Encode values by their string representation.
+    :return: (np.ndarray, np.ndarray) the code of each value, and the distinct strings in sorted order
+    """
+    # Converting only the distinct values to strings
+    codes, uniques = pd.factorize(values)
+    labels = [str(value) for value in uniques]
+    missing = codes < 0
+    if missing.any():
+        # Missing values (None, NaN) share a code but not a string
+        missing_labels, missing_codes = np.unique([str(value) for value in values[missing]], return_inverse=True)
+        codes[missing] = len(labels) + missing_codes
+        labels.extend(missing_labels.tolist())
+    label_codes, strings = pd.factorize(np.array(labels, dtype=object), sort=True)
+    return label_codes[codes], np.asarray(strings, dtype=object)
+
+
+def aggregate_by_value(df: pd.DataFrame, col_name, score_col_name, max_values=None):
+    """
+    Group a scored dataframe by distinct value of a column, keeping the minimum score and joining the sorted distinct
+    values of each other column in a 'List of all' column, with vectorized operations on integer codes instead of a
+    Python function per group and column.
+    :param max_values: if given, only the first max_values distinct values of each other column are kept per group
+    :return: dataframe with one line per distinct value, sorted by value
+    """
+    other_cols = [col for col in df.columns if col != col_name and col != score_col_name]
+    # Codes of the groups in the sorted order of their values, as groupby does
+    groups, uniques = pd.factorize(df[col_name], sort=True)
+    valid = groups >= 0
+    groups = groups[valid].astype(np.int64)
+
+    result = {col_name: uniques}
+    for col in other_cols:
+        codes, strings = string_codes(df[col].to_numpy(dtype=object)[valid])
+        # Distinct (group, value) pairs, sorted by group then value
+        pairs, first_rows = np.unique(groups * len(strings) + codes, return_index=True)
+        if max_values is not None:
+            # Keeping the pairs seen first in each group
+            order = np.lexsort((first_rows, pairs // len(strings)))
+            ordered_groups = pairs[order] // len(strings)
+            group_starts = np.flatnonzero(np.concatenate(([True], ordered_groups[1:] != ordered_groups[:-1])))
+            ranks = np.arange(len(order)) - np.repeat(group_starts, np.diff(np.append(group_starts, len(order))))
+            pairs = pairs[np.sort(order[ranks < max_values])]
+        pair_groups = pairs // len(strings)
+        values = strings[pairs % len(strings)].tolist()
+
+        starts = np.flatnonzero(np.concatenate(([True], pair_groups[1:] != pair_groups[:-1])))
+        ends = np.append(starts[1:], len(pairs))
+        # Only groups with several distinct values need a join
+        result[list_column_name(col)] = [values[start] if end - start == 1 else ' - '.join(values[start:end])
+                                         for (start, end) in zip(starts.tolist(), ends.tolist())]
+    result[score_col_name] = pd.Series(df[score_col_name].to_numpy()[valid]).groupby(groups).min().to_numpy()
+    return pd.DataFrame(result)
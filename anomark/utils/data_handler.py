@@ -1,38 +1,146 @@
 import random
 import re
+import time
 
 import pandas as pd
+from anomark.utils.cache import LRUCache
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
+REGEX_FLAGS = re.MULTILINE | re.IGNORECASE
+
+SID_REGEX = re.compile(r"S[-–]1[-–]([0-9]+[-–])+[0-9]+", flags=REGEX_FLAGS)
+GUID_REGEX = re.compile(r"\{?[0-9A-Fa-f]{8}[-–]([0-9A-Fa-f]{4}[-–]){3}[0-9A-Fa-f]{12}\}?", flags=REGEX_FLAGS)
+USER_REGEX = re.compile(r'(C:\\Users)\\[^\\]*\\', flags=REGEX_FLAGS)
+# Hexadecimal words of the lengths of SHA256, SHA1, MD5, and of a common truncation of hash in file name. Matching any
+# length and checking it afterwards is equivalent to an alternation of the four lengths, and scans the text only once
+HASH_REGEX = re.compile(r'\b[A-Fa-f0-9]{20,64}\b', flags=REGEX_FLAGS)
+HASH_LENGTHS = {64, 40, 32, 20}
+# This applies to Windows file paths
+# From https://regex101.com/r/zWGLMP/25, adapted to Python
+# We need to cover NTFS standard: https://learn.microsoft.com/en-ca/windows/win32/fileio/naming-a-file?redirectedfrom=MSDN
+FILEPATH_REGEX = re.compile(
+    r"(?P<opening>\b(?P<montage>[a-zA-Z]:[\/\\])|[\/\\][\/\\](?<!http:\/\/)(?<!https:\/\/)(?:>[?.][\/\\](?:[^\/\\<>:\"|?\n\r ]+[\/\\])?(?P=montage)?|(?!(?P=montage)))|%\w+%[\/\\]?)(?:[^\/\\<>:\"|?\n\r ,'][^\/\\<>:\"|?\n\r]*(?<![ ,'])[\/\\])*(?:(?=[^\/\\<>:\"'|?\n\r;, ])(?:(?:[^\/\\<>:\"|?\n\r;, .](?: (?=[\w\-]))?(?:\*(?!= ))?(?!(?P=montage)))+)?(?:\.\w+)*)|(?:'(?P=opening)(?=.*'\W|.*'$)(?:[^\/\\<>:'\"|?\n\r]+(?:'(?=\w))?[\/\\]?)*')|\"(?P=opening)(?=.*\")(?:[^\/\\<>:\"|?\n\r]+[\/\\]?)*\"",
+    flags=REGEX_FLAGS)
+
+
 def replace_sid_in_str(some_string, placeholder="<SID>"):
-    regex = r"S[-–]1[-–]([0-9]+[-–])+[0-9]+"
-    return re.sub(regex, placeholder, some_string, 0, flags=re.MULTILINE | re.IGNORECASE)
+    return SID_REGEX.sub(placeholder, some_string)
 
 
 def replace_guid_in_str(some_string, placeholder="<GUID>"):
-    regex = r"\{?[0-9A-Fa-f]{8}[-–]([0-9A-Fa-f]{4}[-–]){3}[0-9A-Fa-f]{12}\}?"
-    return re.sub(regex, placeholder, some_string, 0, flags=re.MULTILINE | re.IGNORECASE)
+    return GUID_REGEX.sub(placeholder, some_string)
 
 
 def replace_user_in_str(some_string, placeholder="<USER>"):
-    regex = r'(C:\\Users)\\[^\\]*\\'
-    return re.sub(regex, r"\g<1>\\{}\\".format(placeholder), some_string, flags=re.MULTILINE | re.IGNORECASE)
+    return USER_REGEX.sub(r"\g<1>\\{}\\".format(placeholder), some_string)
 
 
 def replace_hash_in_str(some_string, placeholder="<HASH>"):
-    # regex consists of SHA256, SHA1, MD5, common truncation of hash in file name
-    regex = r'\b(?:[A-Fa-f0-9]{64}|[A-Fa-f0-9]{40}|[A-Fa-f0-9]{32}|[A-Fa-f0-9]{20})\b'
-    return re.sub(regex, placeholder, some_string, flags=re.MULTILINE | re.IGNORECASE)
+    return HASH_REGEX.sub(lambda match: placeholder if len(match.group()) in HASH_LENGTHS else match.group(),
+                          some_string)
 
 
-# This applies to Windows file paths
 def replace_filepath_in_str(some_string, placeholder="<FILEPATH>"):
-    # From https://regex101.com/r/zWGLMP/25, adapted to Python
-    # We need to cover NTFS standard: https://learn.microsoft.com/en-ca/windows/win32/fileio/naming-a-file?redirectedfrom=MSDN
-    regex = r"(?P<opening>\b(?P<montage>[a-zA-Z]:[\/\\])|[\/\\][\/\\](?<!http:\/\/)(?<!https:\/\/)(?:>[?.][\/\\](?:[^\/\\<>:\"|?\n\r ]+[\/\\])?(?P=montage)?|(?!(?P=montage)))|%\w+%[\/\\]?)(?:[^\/\\<>:\"|?\n\r ,'][^\/\\<>:\"|?\n\r]*(?<![ ,'])[\/\\])*(?:(?=[^\/\\<>:\"'|?\n\r;, ])(?:(?:[^\/\\<>:\"|?\n\r;, .](?: (?=[\w\-]))?(?:\*(?!= ))?(?!(?P=montage)))+)?(?:\.\w+)*)|(?:'(?P=opening)(?=.*'\W|.*'$)(?:[^\/\\<>:'\"|?\n\r]+(?:'(?=\w))?[\/\\]?)*')|\"(?P=opening)(?=.*\")(?:[^\/\\<>:\"|?\n\r]+[\/\\]?)*\""
-    return re.sub(regex, r"\g<1>{}".format(placeholder), some_string, flags=re.MULTILINE | re.IGNORECASE)
+    return FILEPATH_REGEX.sub(r"\g<1>{}".format(placeholder), some_string)
+
+
+# Placeholder modules in the order they are applied, each with a cheap test that is true for every string its regex
+# can match, so that the regex is only run on strings that may contain something to replace
+PLACEHOLDER_MODULES = (
+    ("filepath", replace_filepath_in_str, lambda text: "/" in text or "\\" in text or "%" in text),
+    ("hash", replace_hash_in_str, lambda text: len(text) >= 20),
+    ("guid", replace_guid_in_str, lambda text: text.count("-") + text.count("–") >= 4),
+    ("sid", replace_sid_in_str, lambda text: "-1" in text or "–1" in text),
+    ("user", replace_user_in_str, lambda text: ":\\" in text),
+)
+
+
+class PlaceholderEngine:
+    """
+    Apply the placeholder modules to strings, in the same order and with the same output as the replace_*_in_str
+    functions chained by hand. Lists of strings are processed module by module, and the time spent in each module is
+    accumulated in timings. Each distinct string of a list is only normalized once, and not at all if it is in the
+    cache (an LRUCache of normalized strings keyed by raw string) given to the engine.
+    """
+
+    def __init__(self, apply_filepath_placeholder=False, cache=None):
+        """
+        :param apply_filepath_placeholder: Flag indicating if we want to apply the filepath placeholder
+        :param cache: LRUCache of normalized strings, only to be shared by engines applying the same modules
+        """
+        self.modules = [module for module in PLACEHOLDER_MODULES
+                        if apply_filepath_placeholder or module[0] != "filepath"]
+        self.cache = cache
+        self.timings = {name: 0. for (name, _, _) in self.modules}
+        self.nb_strings = 0
+        self.nb_normalized = 0
+
+    @property
+    def tag(self):
+        """ Names of the modules applied, used to check that a cache saved on disk was built with the same ones. """
+        return tuple(name for (name, _, _) in self.modules)
+
+    def apply(self, text):
+        """
+        Apply all modules to a string.
+        """
+        for (_, replace, may_match) in self.modules:
+            if may_match(text):
+                text = replace(text)
+        return text
+
+    def apply_to_list(self, texts, apply_modules=None):
+        """
+        Apply all modules to a list of strings.
+        :param apply_modules: function normalizing a list of distinct strings, apply_modules_to_list by default
+        :return: list of strings with placeholders
+        """
+        texts = list(texts)
+        normalized = dict.fromkeys(texts)
+        if self.cache is not None:
+            for text in normalized:
+                normalized[text] = self.cache.get(text)
+        misses = [text for (text, value) in normalized.items() if value is None]
+        for text, value in zip(misses, (apply_modules or self.apply_modules_to_list)(misses)):
+            normalized[text] = value
+            if self.cache is not None:
+                self.cache.put(text, value)
+        self.nb_strings += len(texts)
+        self.nb_normalized += len(misses)
+        return [normalized[text] for text in texts]
+
+    def apply_modules_to_list(self, texts):
+        """
+        Apply all modules to a list of strings, one module at a time.
+        :return: list of strings with placeholders
+        """
+        for (name, replace, may_match) in self.modules:
+            t0 = time.perf_counter()
+            texts = [replace(text) if may_match(text) else text for text in texts]
+            self.timings[name] += time.perf_counter() - t0
+        return texts
+
+    def add_timings(self, timings):
+        """
+        Accumulate timings measured by another engine, e.g. in a worker process.
+        """
+        for name, duration in timings.items():
+            self.timings[name] = self.timings.get(name, 0.) + duration
+
+    def report(self):
+        total = sum(self.timings.values())
+        report = "Placeholders took {:.2f}s ({}), {} of {} strings normalized".format(
+            total, ", ".join("{}: {:.2f}s".format(name, duration) for name, duration in self.timings.items()),
+            self.nb_normalized, self.nb_strings)
+        if self.cache is not None:
+            report += ", cache: {}".format(self.cache.report())
+        return report
+
+
+# Engines used for single strings, whose timings are not measured
+PLACEHOLDER_ENGINES = {flag: PlaceholderEngine(flag) for flag in (False, True)}
 
 
 def apply_modules_to_str(text, apply_filepath_placeholder=False):
@@ -42,37 +150,53 @@ def apply_modules_to_str(text, apply_filepath_placeholder=False):
     :param apply_filepath_placeholder: Flag indicating if we want to apply the filepath placeholder
     :return: dataframe with placeholders
     """
-    if apply_filepath_placeholder:
-        return replace_user_in_str(replace_sid_in_str(replace_guid_in_str(replace_hash_in_str(replace_filepath_in_str(text)))))
-    else:
-        return replace_user_in_str(replace_sid_in_str(replace_guid_in_str(replace_hash_in_str(text))))
+    return PLACEHOLDER_ENGINES[bool(apply_filepath_placeholder)].apply(text)
+
+
+def load_placeholder_cache(path=None, apply_filepath_placeholder=False, max_size=100000):
+    """
+    Return a cache for the normalized strings of a PlaceholderEngine, loaded from a file saved by
+    save_placeholder_cache if there is one built with the same modules.
+    :param path: path of the file persisting the cache, or None to keep it in memory only
+    """
+    if path is None:
+        return LRUCache(max_size)
+    return LRUCache.load(path, max_size=max_size, tag=PlaceholderEngine(apply_filepath_placeholder).tag)
+
+
+def save_placeholder_cache(cache, path, apply_filepath_placeholder=False):
+    cache.save(path, tag=PlaceholderEngine(apply_filepath_placeholder).tag)
 
 
-def apply_modules_to_pd_series(pd_series, apply_filepath_placeholder=False):
+def apply_modules_to_pd_series(pd_series, apply_filepath_placeholder=False, engine=None):
     """
     Apply all modules to pd Series.
     :param pd_series: pandas Series
     :param apply_filepath_placeholder: Flag indicating if we want to apply the filepath placeholder
+    :param engine: PlaceholderEngine accumulating the timings, a new one is used if not given
     :return: Series with placeholders
     """
-    pd_series = pd_series.apply(lambda x: apply_modules_to_str(x, apply_filepath_placeholder))
-    return pd_series
+    if engine is None:
+        engine = PlaceholderEngine(apply_filepath_placeholder)
+    return pd.Series(engine.apply_to_list(pd_series), index=pd_series.index, name=pd_series.name)
 
 
-def apply_modules_to_df(df, column, apply_filepath_placeholder=False):
+def apply_modules_to_df(df, column, apply_filepath_placeholder=False, engine=None):
     """
     Apply all modules to df column.
     :param df: pandas DataFrame
     :param column: column to apply the operation on
     :param apply_filepath_placeholder: Flag indicating if we want to apply the filepath placeholder
+    :param engine: PlaceholderEngine accumulating the timings, a new one is used if not given
     :return: dataframe with placeholders
     """
-    df[column] = apply_modules_to_pd_series(df[column], apply_filepath_placeholder)
+    df[column] = apply_modules_to_pd_series(df[column], apply_filepath_placeholder, engine)
     return df
 
 
 def process_dataframe(data: pd.DataFrame, column: str, n_lines, percentage, from_end: bool,
-                      randomize: bool, apply_placeholder: bool, apply_filepath_placeholder: bool = False):
+                      randomize: bool, apply_placeholder: bool, apply_filepath_placeholder: bool = False,
+                      placeholder_cache=None):
     data[column] = data[column].astype(str)
     if n_lines:
         n_lines = int(n_lines)
@@ -95,6 +219,8 @@ def process_dataframe(data: pd.DataFrame, column: str, n_lines, percentage, from
 
     if apply_placeholder:
         print("Applying placeholder transformation...")
-        data = apply_modules_to_df(data, column, apply_filepath_placeholder)
+        engine = PlaceholderEngine(apply_filepath_placeholder, cache=placeholder_cache)
+        data = apply_modules_to_df(data, column, apply_filepath_placeholder, engine)
+        print(engine.report())
 
     return data
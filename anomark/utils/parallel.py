@@ -0,0 +1,77 @@
+import multiprocessing
+
+# Read-only object shared with the workers, set once per worker process by the pool initializer
+_shared = None
+
+
+def _initialize_worker(shared):
+    global _shared
+    _shared = shared
+
+
+def _call(task):
+    function, part = task
+    return function(_shared, part)
+
+
+def split(items, nb_parts):
+    """ Split a list into nb_parts contiguous parts of similar sizes. """
+    size, remainder = divmod(len(items), nb_parts)
+    parts = []
+    start = 0
+    for i in range(nb_parts):
+        end = start + size + (i < remainder)
+        parts.append(items[start:end])
+        start = end
+    return parts
+
+
+class WorkerPool:
+    """
+    Process pool whose workers all get a read-only shared object (typically the model) once, when they start.
+    Workers are forked when the platform allows it, so the shared object is inherited copy-on-write instead of
+    being pickled. Otherwise it is pickled once per worker, which for a memory-mapped FrozenMarkovModel only
+    transfers the path of its file.
+    """
+
+    def __init__(self, workers, shared=None, parts_per_worker=4):
+        """
+        :param workers: number of worker processes
+        :param shared: object given to the functions applied by the workers
+        :param parts_per_worker: number of tasks per worker each input is split into, to balance the load
+        """
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        self.workers = workers
+        self.parts_per_worker = parts_per_worker
+        self.pool = context.Pool(workers, initializer=_initialize_worker, initargs=(shared,))
+
+    def map(self, function, items):
+        """
+        Apply function(shared, part) to contiguous parts of a list of items in the workers.
+        :param function: module-level function, so that it can be sent to the workers
+        :return: list of the results of each part, in the order of the items
+        """
+        items = list(items)
+        nb_parts = max(min(len(items), self.workers * self.parts_per_worker), 1)
+        return self.map_parts(function, split(items, nb_parts))
+
+    def map_parts(self, function, parts):
+        """
+        Apply function(shared, part) to each part in the workers.
+        :return: list of the results of each part, in order
+        """
+        return self.pool.map(_call, [(function, part) for part in parts])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+        else:
+            self.pool.terminate()
@@ -1,14 +1,27 @@
 import argparse
 
-from anomark.model_handler import MarkovModelHandler as mmh
+from anomark.model_handler import SCORE_COMBINATIONS, MarkovModelHandler as mmh
+from anomark.utils.cache import LRUCache
+from anomark.utils.data_handler import load_placeholder_cache, save_placeholder_cache
+from anomark.utils.metrics import instrument
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-d", "--data", required=True, help="Path of the data to work on (csv file)")
-    parser.add_argument("-m", "--model", required=True, help="Path to the model to use")
-    parser.add_argument("-c", "--column", required=True,
+    parser.add_argument("-m", "--model", action="append",
+                        help="Path to the model to use. Several columns are scored in one pass over the data with "
+                             "one column=path argument per column, the option being repeated")
+    parser.add_argument("-c", "--column", required=False,
                         help="The column name on which we want to execute the model.")
+    parser.add_argument("--config", required=False,
+                        help="Path of a JSON file mapping each column to score to the path of its model, e.g. "
+                             "{\"CommandLine\": \"cmdline.amk\", \"ParentImage\": \"parent.amk\"}, relative to the "
+                             "file. Can be combined with column=path models")
+    parser.add_argument("--combine", required=False, choices=sorted(SCORE_COMBINATIONS),
+                        help="Several columns: add the score of each line combining the scores of its columns, the "
+                             "min being the score of its most unusual column. Lines are sorted by this score instead "
+                             "of the score of the first column")
 
     # These two options, "store" and "output" should be used exclusively of one another
     parser.add_argument("-s", "--store", required=False, action="store_true",
@@ -17,6 +30,9 @@ if __name__ == "__main__":
 
     parser.add_argument("--color", action="store_true", required=False,
                         help="Color the least likely letters in the output, according to the model")
+    parser.add_argument("--explain", action="store_true", required=False,
+                        help="Add a column to the stored results describing the least likely letters of each line, "
+                             "with the letters preceding them and their log probability")
     parser.add_argument("-n", "--nLines", default=50, required=False, help="The number of lines you want to display")
     parser.add_argument("--silent", required=False, action="store_true", help="Silent mode")
     parser.add_argument("--placeholder", action="store_true", required=False,
@@ -28,6 +44,41 @@ if __name__ == "__main__":
     parser.add_argument("--show-percentage", required=False, action="store_true",
                         help="Add human-readable percentage to reflect proximity of Markov score to threshold where threshold is the expected value.")
 
+    parser.add_argument("--chunksize", required=False, type=int,
+                        help="Streaming mode: read, score and aggregate the data by chunks of this number of lines, "
+                             "to keep memory constant whatever the size of the input")
+    parser.add_argument("--max-groups", required=False, type=int,
+                        help="Streaming mode: maximum number of distinct values aggregated at once. Least recently "
+                             "seen values are written to the output when the limit is reached (default: 100000)")
+    parser.add_argument("--max-values", required=False, type=int,
+                        help="Maximum number of distinct values kept for each other column, the first ones seen being "
+                             "kept (default: 100 in streaming mode, all values otherwise)")
+
+    parser.add_argument("--top", required=False, type=int,
+                        help="Only keep the given number of values with the lowest scores: only those are colored, "
+                             "formatted and stored, and the results are not fully sorted")
+
+    parser.add_argument("--memo-size", required=False, type=int, default=100000,
+                        help="Number of scores of distinct values kept in memory to avoid scoring them again "
+                             "(0 to disable)")
+
+    parser.add_argument("--placeholder-cache-size", required=False, type=int, default=100000,
+                        help="Number of normalized distinct lines kept in memory to avoid applying the placeholders "
+                             "to them again (0 to disable)")
+    parser.add_argument("--placeholder-cache", required=False,
+                        help="Path of a file persisting the normalized lines across runs: loaded if it exists and "
+                             "was built with the same placeholders, and saved at the end")
+
+    parser.add_argument("--workers", required=False, type=int, default=1,
+                        help="Number of processes applying the placeholders and scoring the data")
+
+    parser.add_argument("--metrics", required=False,
+                        help="Path of a JSON file where the time, rows per second and memory change of each stage, "
+                             "and the statistics of the caches, are saved")
+    parser.add_argument("--profile", required=False,
+                        help="Path where cProfile statistics are dumped, with the largest memory allocations in "
+                             "<path>.memory.txt (slows the run down)")
+
     args = parser.parse_args()
 
     try:
@@ -35,11 +86,74 @@ if __name__ == "__main__":
     except ValueError:
         parser.error("nLines must be an int")
 
+    model_paths = {}
+    if args.column:
+        if args.config or not args.model or len(args.model) != 1:
+            parser.error("--column is scored with a single --model, without --config")
+    else:
+        for model in args.model or []:
+            column, separator, path = model.partition("=")
+            if not separator:
+                parser.error("Give the --column of the --model, or models as column=path")
+            model_paths[column] = path
+        if args.config:
+            # Models given on the command line take precedence
+            try:
+                for (column, path) in mmh.load_model_paths(args.config).items():
+                    model_paths.setdefault(column, path)
+            except (OSError, ValueError) as e:
+                parser.error(str(e))
+        if not model_paths:
+            parser.error("--model and --column, or the model of each column with --model column=path or --config, "
+                         "are required")
+        if args.show_percentage:
+            parser.error("--show-percentage is only available with a single --column")
+        if args.max_groups is not None or args.max_values is not None:
+            # Lines are not aggregated by value when several columns are scored
+            parser.error("--max-groups and --max-values are only available with a single --column")
+    if args.combine and not model_paths:
+        parser.error("--combine is used with models given by column, with --model column=path or --config")
+
     if args.store and args.output:
         parser.error("'--store' and '--output' flags cannot be used at the same time.")
+    if args.top is not None and args.top < 1:
+        parser.error("--top must be a positive number of values")
+
+    memo = LRUCache(args.memo_size) if args.memo_size > 0 else None
+    placeholder_cache = None
+    if args.placeholder and args.placeholder_cache_size > 0:
+        placeholder_cache = load_placeholder_cache(args.placeholder_cache, args.filepath_placeholder,
+                                                   args.placeholder_cache_size)
+
+    with instrument(args.metrics, args.profile) as metrics:
+        if model_paths:
+            # Each column has its own memo of --memo-size scores
+            mmh.run_multi(
+                model_paths=model_paths, data_path=args.data, chunksize=args.chunksize, store_bool=args.store,
+                output=args.output, nb_lines=args.nLines, color_output=args.color, verbose=not args.silent,
+                apply_placeholder=args.placeholder, apply_filepath_placeholder=args.filepath_placeholder,
+                combine=args.combine, memo_size=args.memo_size, workers=args.workers,
+                placeholder_cache=placeholder_cache, explain=args.explain, top=args.top, metrics=metrics
+            )
+        elif args.chunksize:
+            mmh.run_streaming(
+                model_path=args.model[0], data_path=args.data, col_name=args.column, chunksize=args.chunksize,
+                store_bool=args.store, output=args.output, nb_lines=args.nLines, color_output=args.color,
+                verbose=not args.silent, apply_placeholder=args.placeholder, show_percentage=args.show_percentage,
+                apply_filepath_placeholder=args.filepath_placeholder,
+                max_groups=args.max_groups if args.max_groups is not None else 100000,
+                max_values=args.max_values if args.max_values is not None else 100, memo=memo, workers=args.workers,
+                placeholder_cache=placeholder_cache, explain=args.explain, top=args.top, metrics=metrics
+            )
+        else:
+            mmh.run(
+                model_path=args.model[0], data_path=args.data, col_name=args.column, store_bool=args.store,
+                output=args.output, nb_lines=args.nLines, color_output=args.color, verbose=not args.silent,
+                apply_placeholder=args.placeholder, show_percentage=args.show_percentage,
+                apply_filepath_placeholder=args.filepath_placeholder, memo=memo, workers=args.workers,
+                placeholder_cache=placeholder_cache, explain=args.explain, max_values=args.max_values, top=args.top,
+                metrics=metrics
+            )
 
-    mmh.run(
-        model_path=args.model, data_path=args.data, col_name=args.column, store_bool=args.store, output=args.output,
-        nb_lines=args.nLines, color_output=args.color, verbose=not args.silent, apply_placeholder=args.placeholder,
-        show_percentage=args.show_percentage
-    )
+        if args.placeholder_cache and placeholder_cache is not None:
+            save_placeholder_cache(placeholder_cache, args.placeholder_cache, args.filepath_placeholder)
@@ -0,0 +1,306 @@
+"""
+Benchmarks of training, scoring, placeholders and model I/O on synthetic command lines.
+
+    python -m benchmarks.benchmark run --sizes 1000 10000 --orders 3 4 --output new.json
+    python -m benchmarks.benchmark compare old.json new.json --threshold 10
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from anomark.model import FrozenMarkovModel, MarkovModel
+from anomark.model_handler import MarkovModelHandler as mmh
+from anomark.utils.data_handler import (PlaceholderEngine, replace_filepath_in_str, replace_guid_in_str,
+                                        replace_hash_in_str, replace_sid_in_str, replace_user_in_str)
+from benchmarks.synthetic import generate_command_lines
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+COLUMN = "CommandLine"
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def bench_train(data):
+    model = MarkovModel(data.order)
+    return timed(lambda: [model.train(line) for line in data.padded])
+
+
+def bench_train_batch(data):
+    return timed(MarkovModel(data.order).train_batch, data.padded)
+
+
+def bench_log_likelihood(data):
+    return timed(lambda: [data.model.log_likelihood(line) for line in data.padded])
+
+
+def bench_score_batch(data):
+    return timed(data.frozen.score_batch, data.padded)
+
+
+def bench_sample(data):
+    return timed(data.frozen.sample, data.size, 100, "~" * data.order, 0)
+
+
+def bench_execute_on_df(data):
+    df = pd.DataFrame({COLUMN: data.lines})
+    with contextlib.redirect_stdout(io.StringIO()):
+        return timed(mmh.execute_on_df, df, data.frozen, COLUMN)
+
+
+def bench_replace(function):
+    return lambda data: timed(lambda: [function(line) for line in data.lines])
+
+
+def bench_placeholder_engine(data):
+    return timed(PlaceholderEngine(True).apply_to_list, data.lines)
+
+
+def bench_colored_results(data):
+    threshold = mmh.compute_threshold(data.frozen, 95)
+    return timed(lambda: [mmh.colored_results(line, data.frozen, threshold) for line in data.lines])
+
+
+def bench_pickle_save(data):
+    with open(data.pickle_path, "wb") as output:
+        return timed(pickle.dump, data.model, output, 4)
+
+
+def bench_pickle_load(data):
+    with open(data.pickle_path, "rb") as f:
+        return timed(pickle.load, f)
+
+
+def bench_amk_save(data):
+    return timed(data.frozen.save, data.amk_path)
+
+
+def bench_amk_load(data):
+    return timed(FrozenMarkovModel.load, data.amk_path, False)
+
+
+# Name of each benchmark, its function returning the duration of one run, and what its events are: the lines
+# processed or sampled, or the transitions of the model saved or loaded
+CASES = [
+    ("train", bench_train, "lines"),
+    ("train_batch", bench_train_batch, "lines"),
+    ("log_likelihood", bench_log_likelihood, "lines"),
+    ("score_batch", bench_score_batch, "lines"),
+    ("execute_on_df", bench_execute_on_df, "lines"),
+    ("sample", bench_sample, "lines"),
+    ("replace_sid_in_str", bench_replace(replace_sid_in_str), "lines"),
+    ("replace_guid_in_str", bench_replace(replace_guid_in_str), "lines"),
+    ("replace_user_in_str", bench_replace(replace_user_in_str), "lines"),
+    ("replace_hash_in_str", bench_replace(replace_hash_in_str), "lines"),
+    ("replace_filepath_in_str", bench_replace(replace_filepath_in_str), "lines"),
+    ("placeholder_engine", bench_placeholder_engine, "lines"),
+    ("colored_results", bench_colored_results, "lines"),
+    ("pickle_save", bench_pickle_save, "transitions"),
+    ("pickle_load", bench_pickle_load, "transitions"),
+    ("amk_save", bench_amk_save, "transitions"),
+    ("amk_load", bench_amk_load, "transitions"),
+]
+CASE_NAMES = [name for (name, _, _) in CASES]
+
+# Metrics compared between two runs, and whether a higher value is better
+METRICS = [("events_per_second", True), ("peak_rss_mb", False), ("model_bytes", False)]
+
+
+def peak_rss_mb():
+    """ Return the peak resident memory of the current process in MB, or None if it is not available. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def _run_case(function, data, repeat):
+    return min(function(data) for _ in range(repeat)), peak_rss_mb()
+
+
+def _send_case(connection, function, data, repeat):
+    try:
+        connection.send(_run_case(function, data, repeat))
+    except Exception as e:
+        connection.send(e)
+    finally:
+        connection.close()
+
+
+def run_case(function, data, repeat):
+    """
+    Return the best duration of repeat runs of a benchmark, and the peak memory of the process running it. Each
+    benchmark runs in a forked process when possible, so that its peak memory is not the one of a previous benchmark,
+    and the forked process shares the data instead of receiving a copy.
+    """
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return _run_case(function, data, repeat)
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_send_case, args=(sender, function, data, repeat))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        raise RuntimeError("The benchmark process exited with code {}".format(process.exitcode))
+    finally:
+        process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def prepare(nb_lines, order, seed, directory):
+    """ Generate the lines of a benchmark and train the models scoring them. """
+    lines = generate_command_lines(nb_lines, seed=seed)
+    padded = ["~" * order + line for line in lines]
+    model = MarkovModel(order)
+    model.train_batch(padded)
+    model.normalize_model_and_compute_prior()
+    data = SimpleNamespace(lines=lines, padded=padded, size=nb_lines, order=order, model=model, frozen=model.freeze(),
+                           pickle_path=os.path.join(directory, "model.dump"),
+                           amk_path=os.path.join(directory, "model.amk"))
+    with open(data.pickle_path, "wb") as output:
+        pickle.dump(model, output, protocol=4)
+    data.frozen.save(data.amk_path)
+    return data
+
+
+def run_benchmarks(sizes, orders, cases=None, repeat=3, seed=0, log=sys.stdout):
+    """
+    Run the benchmarks on synthetic command lines of each size, with models of each order.
+    :param cases: names of the benchmarks to run, all of them by default
+    :param repeat: number of runs of each benchmark, the fastest one is kept
+    :param seed: seed of the synthetic data
+    :return: the list of results, one dict per benchmark, size and order
+    """
+    cases = [case for case in CASES if cases is None or case[0] in cases]
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for order in orders:
+            for size in sizes:
+                data = prepare(size, order, seed, directory)
+                nb_transitions = data.model.nb_transitions
+                for (name, function, unit) in cases:
+                    seconds, peak = run_case(function, data, repeat)
+                    nb_events = nb_transitions if unit == "transitions" else size
+                    model_bytes = os.path.getsize(data.amk_path if name.startswith("amk") else data.pickle_path)
+                    result = {"name": name, "order": order, "size": size, "unit": unit, "events": nb_events,
+                              "seconds": seconds, "events_per_second": nb_events / seconds if seconds else None,
+                              "peak_rss_mb": peak, "model_bytes": model_bytes}
+                    results.append(result)
+                    print("{name:<24} order {order:<2} {size:>8} lines {events_per_second:>14,.0f} {unit}/s "
+                          "{peak_rss_mb:>8.1f} MB".format(**dict(result, peak_rss_mb=peak or 0.)), file=log)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def metadata(seed, repeat):
+    return {"date": datetime.datetime.now().isoformat(timespec="seconds"), "commit": git_commit(),
+            "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "platform": platform.platform(), "processor": platform.processor() or platform.machine(),
+            "seed": seed, "repeat": repeat}
+
+
+def compare_results(old_results, new_results, threshold=10.):
+    """
+    Compare the benchmarks run in both lists of results.
+    :param threshold: change of a metric in percent, in the bad direction, flagged as a regression
+    :return: a list of (name, order, size, metric, old value, new value, change in percent, is a regression)
+    """
+    old_by_key = {(result["name"], result["order"], result["size"]): result for result in old_results}
+    comparison = []
+    for result in new_results:
+        key = (result["name"], result["order"], result["size"])
+        if key not in old_by_key:
+            continue
+        for (metric, higher_is_better) in METRICS:
+            old, new = old_by_key[key].get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            regression = (-change if higher_is_better else change) > threshold
+            comparison.append(key + (metric, old, new, change, regression))
+    return comparison
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark AnoMark on synthetic command lines, and compare runs to "
+                                                 "find regressions")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks and save their results to a JSON file")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000],
+                            help="Numbers of synthetic lines (default: 1000 10000)")
+    run_parser.add_argument("--orders", type=int, nargs="+", default=[4], help="Orders of the models (default: 4)")
+    run_parser.add_argument("--cases", nargs="+", choices=CASE_NAMES, help="Benchmarks to run (default: all)")
+    run_parser.add_argument("--repeat", type=int, default=3,
+                            help="Number of runs of each benchmark, the fastest is kept (default: 3)")
+    run_parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data (default: 0)")
+    run_parser.add_argument("-o", "--output", help="Path of the JSON results (default: benchmark_<date>.json)")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two runs, exits with 1 if there is a regression")
+    compare_parser.add_argument("old", help="JSON results of the reference run")
+    compare_parser.add_argument("new", help="JSON results of the new run")
+    compare_parser.add_argument("--threshold", type=float, default=10.,
+                                help="Slowdown, or memory or model size increase, in percent flagged as a regression "
+                                     "(default: 10)")
+
+    args = parser.parse_args(args)
+
+    if args.command == "run":
+        if args.repeat < 1 or min(args.sizes) < 1 or min(args.orders) < 1:
+            parser.error("--sizes, --orders and --repeat must be positive")
+        output = args.output or "benchmark_{}.json".format(datetime.datetime.now().strftime("%Y%m%d_%Hh%M"))
+        results = run_benchmarks(args.sizes, args.orders, args.cases, args.repeat, args.seed)
+        with open(output, "w") as f:
+            json.dump({"metadata": metadata(args.seed, args.repeat), "results": results}, f, indent=2)
+        print("Saved results in: {}".format(output))
+        return 0
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    comparison = compare_results(old["results"], new["results"], args.threshold)
+    for (name, order, size, metric, old_value, new_value, change, regression) in comparison:
+        print("{:<24} order {:<2} {:>8} lines {:<18} {:>16,.1f} -> {:>16,.1f} {:>+8.1f}%{}".format(
+            name, order, size, metric, old_value, new_value, change, "  REGRESSION" if regression else ""))
+    nb_regressions = sum(regression for (*_, regression) in comparison)
+    print("{} regressions out of {} compared metrics (threshold: {}%)".format(nb_regressions, len(comparison),
+                                                                               args.threshold))
+    return 1 if nb_regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+import random
+
+from anomark.model import MarkovModel
+
+EXECUTABLES = ["cmd.exe", "powershell.exe", "rundll32.exe", "reg.exe", "schtasks.exe", "certutil.exe", "wmic.exe",
+               "msiexec.exe", "svchost.exe", "conhost.exe", "taskkill.exe", "net.exe"]
+FOLDERS = ["Windows\\System32", "Windows\\SysWOW64", "Program Files\\Common Files", "ProgramData\\Microsoft",
+           "Program Files (x86)\\Google\\Chrome\\Application", "Windows\\Temp"]
+FILES = ["setup", "update", "install", "report", "backup", "config", "service", "agent", "helper", "launcher"]
+EXTENSIONS = [".exe", ".dll", ".ps1", ".bat", ".log", ".tmp", ".xml"]
+USERS = ["alice", "bob", "svc_backup", "administrator", "j.doe", "adm-sql", "helpdesk"]
+WORDS = ["start", "stop", "query", "delete", "add", "create", "list", "run", "update", "config"]
+HEX = "0123456789abcdef"
+
+TEMPLATES = [
+    "\"C:\\{folder}\\{exe}\" /c {word} {file}{ext}",
+    "C:\\{folder}\\{exe} -{word} \"C:\\Users\\{user}\\AppData\\Local\\Temp\\{guid}\\{file}{ext}\"",
+    "C:\\Windows\\System32\\reg.exe {word} HKU\\{sid}\\Software\\Microsoft\\Windows\\CurrentVersion\\Run",
+    "certutil.exe -hashfile C:\\ProgramData\\{file}{ext} SHA256 {hash}",
+    "C:\\Windows\\System32\\schtasks.exe /{word} /tn \"{file} {number}\" /ru {user}",
+    "powershell.exe -NoProfile -ExecutionPolicy Bypass -File C:\\Users\\{user}\\Documents\\{file}.ps1 -Id {guid}",
+    "/usr/bin/python3 /home/{user}/scripts/{file}.py --{word} {number}",
+    "C:\\{folder}\\svchost.exe -k netsvcs -p -s {file}",
+]
+
+
+def random_hex(rng, length):
+    return "".join(rng.choice(HEX) for _ in range(length))
+
+
+def random_guid(rng):
+    return "{{{}-{}-{}-{}-{}}}".format(*(random_hex(rng, length) for length in (8, 4, 4, 4, 12)))
+
+
+def random_sid(rng):
+    return "S-1-5-21-{}-{}-{}-{}".format(*(rng.randint(10 ** 8, 10 ** 10 - 1) for _ in range(3)),
+                                         rng.randint(1000, 9999))
+
+
+def generate_command_line(rng):
+    """ Return a random command line built from a template, with paths, users, GUIDs, SIDs and hashes. """
+    return rng.choice(TEMPLATES).format(
+        folder=rng.choice(FOLDERS), exe=rng.choice(EXECUTABLES), file=rng.choice(FILES), ext=rng.choice(EXTENSIONS),
+        user=rng.choice(USERS), word=rng.choice(WORDS), number=rng.randint(0, 100000), guid=random_guid(rng),
+        sid=random_sid(rng), hash=random_hex(rng, rng.choice((32, 40, 64))))
+
+
+def generate_command_lines(nb_lines, seed=0, noise=.05, noise_order=3):
+    """
+    Generate a reproducible list of synthetic command lines.
+    :param nb_lines: number of lines
+    :param seed: seed of the random generators, the same seed always gives the same lines
+    :param noise: fraction of the lines sampled with MarkovModel.simulate from a model trained on the other lines,
+    which look like command lines without following any template
+    :param noise_order: order of the model sampling the noisy lines
+    """
+    rng = random.Random(seed)
+    nb_noisy = int(nb_lines * noise)
+    lines = [generate_command_line(rng) for _ in range(nb_lines - nb_noisy)]
+    if nb_noisy and lines:
+        model = MarkovModel(noise_order)
+        model.train_batch(["~" * noise_order + line for line in lines])
+        model.normalize_model_and_compute_prior()
+        # simulate draws from the global random generator
+        state = random.getstate()
+        random.seed(seed)
+        try:
+            noisy = [model.simulate(rng.randint(20, 120), "~" * noise_order) for _ in range(nb_noisy)]
+        finally:
+            random.setstate(state)
+        lines.extend(line[noise_order:] for line in noisy)
+        rng.shuffle(lines)
+    return lines
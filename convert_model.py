@@ -0,0 +1,33 @@
+import argparse
+
+from anomark.model import MODEL_FILE_EXTENSION, MarkovModel
+from anomark.model_handler import MarkovModelHandler as mmh
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a pickled model (.dump) into the binary model format, "
+                                                 "which is memory-mapped instead of unpickled when loaded")
+
+    parser.add_argument("-m", "--model", required=True, help="Path to the pickled model to convert")
+    parser.add_argument("--output", required=False,
+                        help="The path of the converted model (default: model path with {} extension)"
+                        .format(MODEL_FILE_EXTENSION))
+    parser.add_argument("--max-symbols", required=False, type=int,
+                        help="Only keep the N most frequent letters in the symbol table, the other ones sharing a "
+                             "single out-of-vocabulary symbol. The converted model cannot be trained again")
+
+    args = parser.parse_args()
+    if args.max_symbols is not None and args.max_symbols < 1:
+        parser.error("--max-symbols must be positive")
+
+    model = mmh.load_model(args.model, trainable=True)
+    if not isinstance(model, MarkovModel):
+        parser.error("only MarkovModel dumps can be converted")
+    try:
+        frozen_model = model.freeze(max_symbols=args.max_symbols)
+    except ValueError as e:
+        parser.error(str(e))
+
+    output = args.output
+    if not output:
+        output = (args.model[:-5] if args.model.endswith(".dump") else args.model) + MODEL_FILE_EXTENSION
+    mmh.save_model(model=frozen_model, save_path=output)
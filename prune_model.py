@@ -0,0 +1,56 @@
+import argparse
+
+from anomark.model import MarkovModel
+from anomark.model_handler import MarkovModelHandler as mmh
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prune the rare transitions of a trained model to reduce its size, "
+                                                 "and report how the scores change on held-out data")
+
+    parser.add_argument("-m", "--model", required=True, help="Path to the model to prune")
+    parser.add_argument("--output", required=False,
+                        help="The path of the pruned model (default: not saved, only the report is printed)")
+    parser.add_argument("--min-count", required=False, type=float,
+                        help="Prune the transitions seen less than this number of times")
+    parser.add_argument("--top-n", required=False, type=int,
+                        help="Only keep the N most frequent next letters of each ngram")
+    parser.add_argument("--max-contexts", required=False, type=int, help="Only keep the N most frequent ngrams")
+    parser.add_argument("--max-transitions", required=False, type=int,
+                        help="Only keep the N most frequent transitions")
+    parser.add_argument("--holdout", required=False,
+                        help="Path of held-out data (CSV file with --column, or TXT file with one value per line), "
+                             "scored before and after pruning to report how the scores change")
+    parser.add_argument("-c", "--column", required=False, default="line",
+                        help="The column of the held-out CSV data")
+    parser.add_argument("--placeholder", action="store_true", required=False,
+                        help="Apply GUID, SID, username, and hash replacement by placeholder to the held-out data")
+    parser.add_argument("--filepath-placeholder", action="store_true", required=False,
+                        help="Apply filepath replacement by placeholder to the held-out data")
+
+    args = parser.parse_args(argv)
+
+    pruning = {name: value for (name, value) in [("min_count", args.min_count), ("top_n", args.top_n),
+                                                 ("max_contexts", args.max_contexts),
+                                                 ("max_transitions", args.max_transitions)] if value is not None}
+    if not pruning:
+        parser.error("At least one of --min-count, --top-n, --max-contexts and --max-transitions is needed")
+    if any(value < 1 for (name, value) in pruning.items() if name != "min_count"):
+        parser.error("--top-n, --max-contexts and --max-transitions must be positive")
+
+    holdout = None
+    if args.holdout:
+        holdout = mmh.load_holdout(args.holdout, args.column, args.placeholder, args.filepath_placeholder)
+    try:
+        model = mmh.load_model(args.model, trainable=True)
+    except ValueError as e:
+        parser.error(str(e))
+    if not isinstance(model, MarkovModel):
+        parser.error("only MarkovModel dumps can be pruned")
+    mmh.prune_model(model, pruning, holdout)
+    if args.output:
+        mmh.save_model(model=model, save_path=args.output)
+
+
+if __name__ == "__main__":
+    main()
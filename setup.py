@@ -46,6 +46,11 @@ setup(
     ],
     extra_requires={
     },
+    entry_points={
+        "console_scripts": [
+            "anomark=anomark.__main__:main",
+        ],
+    },
     package_data={
         '': [
             "*.xml",
@@ -0,0 +1,28 @@
+import io
+from unittest import TestCase
+
+from benchmarks.benchmark import compare_results, run_benchmarks
+from benchmarks.synthetic import generate_command_lines
+
+
+class Test(TestCase):
+    def test_generate_command_lines(self):
+        lines = generate_command_lines(200, seed=1)
+        self.assertEqual(len(lines), 200)
+        self.assertEqual(lines, generate_command_lines(200, seed=1))
+        self.assertNotEqual(lines, generate_command_lines(200, seed=2))
+
+    def test_run_and_compare(self):
+        results = run_benchmarks([50], [2], cases=["train_batch", "score_batch", "pickle_load"], repeat=1,
+                                 log=io.StringIO())
+        self.assertEqual([(result["name"], result["order"], result["size"]) for result in results],
+                         [("train_batch", 2, 50), ("score_batch", 2, 50), ("pickle_load", 2, 50)])
+        for result in results:
+            self.assertGreater(result["events_per_second"], 0)
+            self.assertGreater(result["model_bytes"], 0)
+
+        slower = [dict(result, events_per_second=result["events_per_second"] * .8) for result in results[:2]]
+        regressions = [(name, metric) for (name, _, _, metric, *_, regression)
+                       in compare_results(results, slower, threshold=10) if regression]
+        self.assertEqual(regressions, [("train_batch", "events_per_second"), ("score_batch", "events_per_second")])
+        self.assertFalse(any(comparison[-1] for comparison in compare_results(results, slower, threshold=25)))
@@ -1,13 +1,18 @@
+import os
+import tempfile
 from unittest import TestCase
 
 import pandas as pd
 from anomark.utils.data_handler import (
+    PlaceholderEngine,
+    load_placeholder_cache,
     process_dataframe,
     replace_filepath_in_str,
     replace_guid_in_str,
     replace_hash_in_str,
     replace_sid_in_str,
     replace_user_in_str,
+    save_placeholder_cache,
 )
 
 
@@ -179,3 +184,41 @@ class Test(TestCase):
         self.assertEqual(expected_res2.to_dict(), res2.to_dict())
         self.assertEqual(expected_res3.to_dict(), res3.to_dict())
         self.assertEqual(expected_res4.to_dict(), res4.to_dict())
+
+    def test_placeholder_engine(self):
+        texts = ["Data", r"C:\Users\some_user\{12345678-1234-1234-1234-123456789012}\S-1-5-21-42-42-4242.exe",
+                 "hash d41d8cd98f00b204e9800998ecf8427e and not a hash d41d8cd98f00b204e9800998ecf8427e0",
+                 "%APPDATA%\\some_folder\\some_file.txt /c \\\\server\\share", ""]
+        for apply_filepath_placeholder in [False, True]:
+            engine = PlaceholderEngine(apply_filepath_placeholder)
+            expected_res = []
+            for text in texts:
+                if apply_filepath_placeholder:
+                    text = replace_filepath_in_str(text)
+                expected_res.append(replace_user_in_str(replace_sid_in_str(replace_guid_in_str(
+                    replace_hash_in_str(text)))))
+            res = engine.apply_to_list(texts)
+
+            self.assertEqual(expected_res, res)
+            self.assertEqual(expected_res, [engine.apply(text) for text in texts])
+            self.assertEqual(apply_filepath_placeholder, "filepath" in engine.timings)
+            self.assertEqual(len(texts), engine.nb_strings)
+
+    def test_placeholder_cache(self):
+        texts = [r"C:\Users\some_user\some_folder", "Data", r"C:\Users\some_user\some_folder", "S-1-0-0"]
+        expected_res = [r"C:\Users\<USER>\some_folder", "Data", r"C:\Users\<USER>\some_folder", "<SID>"]
+        cache = load_placeholder_cache(max_size=10)
+        engine = PlaceholderEngine(cache=cache)
+
+        self.assertEqual(expected_res, engine.apply_to_list(texts))
+        self.assertEqual(expected_res, engine.apply_to_list(texts))
+        # Distinct strings are normalized once, and then found in the cache
+        self.assertEqual(3, engine.nb_normalized)
+        self.assertEqual((3, 3), (cache.hits, cache.misses))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "placeholders.pkl")
+            save_placeholder_cache(cache, path)
+            self.assertEqual(dict(cache.entries), dict(load_placeholder_cache(path).entries))
+            # A cache built with other modules is not reused
+            self.assertEqual(0, len(load_placeholder_cache(path, apply_filepath_placeholder=True)))
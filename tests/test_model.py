@@ -0,0 +1,242 @@
+import os
+import random
+import tempfile
+from unittest import TestCase, mock
+
+import numpy as np
+import pandas as pd
+from anomark.model import BackoffMarkovModel, FrozenMarkovModel, MarkovModel, load_model
+from anomark.model_handler import MarkovModelHandler as mmh
+
+
+class Test(TestCase):
+    def setUp(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        self.model = mmh.train_from_df(df=df, model_order=4, train_col_name="column1", count_col_name="count",
+                                       save_model=False)
+        self.sequences = ["~~~~" + line for line in pd.read_csv("tests/sample_data/test_data.csv")["column1"]]
+        self.sequences += ["~~~~This is some data", "", "abc", "~~~~Unknown letters: é€😀"]
+
+    def test_score_batch(self):
+        expected_scores = [self.model.log_likelihood(sequence) for sequence in self.sequences]
+        scores = self.model.score_batch(self.sequences)
+
+        self.assertIsInstance(scores, np.ndarray)
+        np.testing.assert_allclose(expected_scores, scores, rtol=1e-12)
+
+    def test_score_batch_without_numpy(self):
+        expected_scores = [self.model.log_likelihood(sequence) for sequence in self.sequences]
+        with mock.patch("anomark.model.np", None):
+            self.assertRaises(ValueError, self.model.freeze)
+            scores = self.model.score_batch(self.sequences)
+
+        self.assertEqual(expected_scores, scores)
+
+    def test_freeze(self):
+        frozen = self.model.freeze()
+
+        self.assertEqual(self.model.order, frozen.order)
+        self.assertEqual(self.model.prior, frozen.prior)
+        self.assertEqual(sorted(self.model.alphabet), frozen.alphabet)
+        self.assertEqual(len(self.model.normed_chain), len(frozen.context_keys))
+        for sequence in self.sequences:
+            self.assertAlmostEqual(self.model.log_likelihood(sequence), frozen.log_likelihood(sequence))
+        self.assertIn(frozen.generate_letter("~~~~"), ["T", "S", "w", "D"])
+        self.assertTrue(frozen.simulate(20, start="~~~~This").startswith("~~~~This is"))
+
+    def test_sample(self):
+        sequences = self.model.sample(2000, 12, start="~~~~", seed=1)
+        self.assertEqual(sequences, self.model.sample(2000, 12, start="~~~~", seed=1))
+        self.assertNotEqual(sequences, self.model.sample(2000, 12, start="~~~~", seed=2))
+        self.assertTrue(all(len(sequence) == 12 and sequence.startswith("~~~~") for sequence in sequences))
+        # The first letters are drawn with the probabilities of the model
+        for (letter, probability) in self.model.normed_chain["~~~~"].items():
+            frequency = sum(sequence[4] == letter for sequence in sequences) / len(sequences)
+            self.assertAlmostEqual(probability, frequency, delta=.05)
+        # Each sequence follows the transitions of the model, or starts from one of its ngrams
+        self.assertTrue(all(self.model.log_likelihood(sequence) > np.log(self.model.prior) for sequence in sequences))
+        self.assertTrue(all(sequence[:4] in self.model.normed_chain for sequence in self.model.sample(50, 8, seed=0)))
+        # Unseen ngrams are followed by letters of the alphabet
+        sequences = self.model.sample(10, 20, start="~~~€", seed=0)
+        self.assertTrue(all(set(sequence[4:]) <= set(self.model.alphabet) for sequence in sequences))
+        self.assertEqual(["abc"] * 3, self.model.sample(3, 2, start="abc", seed=0))
+
+        random.seed(0)
+        simulation = self.model.simulate(30, start="~~~~")
+        random.seed(0)
+        self.assertEqual(simulation, self.model.simulate(30, start="~~~~"))
+        self.assertEqual(30, len(simulation))
+
+    def test_model_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "model.amk")
+            self.model.freeze().save(path)
+            frozen = load_model(path)
+
+            self.assertIsInstance(frozen, FrozenMarkovModel)
+            self.assertIsInstance(frozen.log_probabilities, np.memmap)
+            np.testing.assert_allclose(self.model.score_batch(self.sequences), frozen.score_batch(self.sequences))
+            self.assertEqual(self.model.markov_chain, frozen.thaw().markov_chain)
+
+            # Saving again replaces the file, the mapped model keeps reading the previous one
+            other_model = MarkovModel(2)
+            other_model.train_batch(["~~abc"])
+            other_model.freeze().save(path)
+            np.testing.assert_allclose(self.model.score_batch(self.sequences), frozen.score_batch(self.sequences))
+            self.assertEqual(2, load_model(path).order)
+            self.assertEqual(["model.amk"], os.listdir(directory))
+            del frozen
+
+    def test_bounded_symbols(self):
+        model = MarkovModel(1)
+        model.train_batch(["~aaab", "~aac", "~ad"])
+        frozen = model.freeze(max_symbols=2)
+
+        # The rare letters, and the unknown ones, share the out-of-vocabulary code
+        self.assertEqual("a~", frozen.symbols)
+        self.assertTrue(frozen.oov)
+        self.assertEqual(np.uint8, frozen.next_symbols.dtype)
+        self.assertAlmostEqual(np.log(.5), frozen.log_likelihood("ab"))
+        self.assertAlmostEqual(np.log(.5), frozen.log_likelihood("a€"))
+        self.assertAlmostEqual(np.log(model.prior), frozen.log_likelihood("b~"))
+        self.assertEqual(model.freeze().log_likelihood("~aa"), frozen.log_likelihood("~aa"))
+        self.assertLessEqual(set("".join(frozen.sample(20, 6, start="~", seed=0))), set("~a\ufffd"))
+        with self.assertRaises(ValueError):
+            frozen.thaw()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "model.amk")
+            frozen.save(path)
+            loaded = load_model(path, memory_map=False)
+            with open(path, "rb") as f:
+                self.assertEqual(b"\x02\x00\x00\x00", f.read(12)[8:])
+        self.assertTrue(loaded.oov)
+        np.testing.assert_array_equal(frozen.score_batch(self.sequences), loaded.score_batch(self.sequences))
+
+    def test_merge(self):
+        model = MarkovModel(2)
+        model.train("~~abc~~")
+        other_model = MarkovModel(2)
+        other_model.train("~~abd~~", count=2)
+
+        model.merge(other_model)
+        self.assertEqual({'~~': {'a': 3}, '~a': {'b': 3}, 'ab': {'c': 1, 'd': 2}, 'bc': {'~': 1}, 'c~': {'~': 1},
+                          'bd': {'~': 2}, 'd~': {'~': 2}}, model.markov_chain)
+        self.assertEqual(['a', 'b', 'c', '~', 'd'], model.alphabet)
+        self.assertRaises(ValueError, model.merge, MarkovModel(3))
+
+    def test_train_batch(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        expected = MarkovModel(4)
+        for line, count in zip(df["column1"], df["count"]):
+            expected.train(training_data=line, count=count)
+        model = MarkovModel(4)
+        model.train_batch(training_data=df["column1"], counts=df["count"].to_numpy())
+
+        self.assertEqual(expected.markov_chain, model.markov_chain)
+        self.assertEqual(list(expected.markov_chain), list(model.markov_chain))
+        self.assertEqual(expected.alphabet, model.alphabet)
+
+    def test_update(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        new_lines = ["~~~~This is new data", "~~~~Data: S-1-5-21-42"]
+        expected = MarkovModel(4)
+        expected.train_batch(training_data=df["column1"], counts=df["count"].to_numpy() * .5)
+        expected.train_batch(training_data=new_lines)
+        expected.normalize_model_and_compute_prior()
+
+        model = MarkovModel(4)
+        model.update(training_data=df["column1"], counts=df["count"].to_numpy(), half_life=60, timestamp=0)
+        frozen = model.freeze()
+        model.update(training_data=new_lines, half_life=60, timestamp=60)
+
+        self.assertEqual(2., model.count_weight)
+        self.assertAlmostEqual(expected.prior, model.prior)
+        for (ngram, distribution) in expected.normed_chain.items():
+            for (letter, probability) in distribution.items():
+                self.assertAlmostEqual(probability, model.normed_chain[ngram][letter])
+        np.testing.assert_allclose(expected.score_batch(self.sequences), model.score_batch(self.sequences))
+        self.assertIsNot(frozen, model.freeze())
+        np.testing.assert_allclose(expected.freeze().counts, model.freeze().counts)
+
+        # Updates which add no transition keep the frozen model, with updated rows
+        frozen = model.freeze()
+        model.update(training_data=["~~~~This is some data"], decay=.5)
+        self.assertIs(frozen, model.freeze(exact_counts=False))
+        expected.update(training_data=["~~~~This is some data"], counts=[2])
+        self.assertAlmostEqual(expected.prior, model.prior)
+        np.testing.assert_allclose(expected.score_batch(self.sequences), model.score_batch(self.sequences))
+        self.assertRaises(ValueError, model.update, training_data=[], decay=0)
+
+        # Models trained but never normalized are decayed too
+        model = MarkovModel(4)
+        model.train_batch(training_data=df["column1"], counts=df["count"].to_numpy())
+        model.update(training_data=new_lines, decay=.5)
+        expected = MarkovModel(4)
+        expected.train_batch(training_data=df["column1"], counts=df["count"].to_numpy() * .5)
+        expected.train_batch(training_data=new_lines)
+        expected.normalize_model_and_compute_prior()
+        self.assertAlmostEqual(expected.prior, model.prior)
+        np.testing.assert_allclose(expected.score_batch(self.sequences), model.score_batch(self.sequences))
+
+    def test_prune(self):
+        model = MarkovModel(2)
+        model.train("~~abc~~")
+        model.train("~~abd~~", count=3)
+        model.train("~~aeb~~", count=2)
+        model.check_if_trained()
+
+        self.assertEqual(3, model.prune(min_count=2))
+        self.assertEqual({'~~': {'a': 6}, '~a': {'b': 4, 'e': 2}, 'ab': {'d': 3}, 'bd': {'~': 3}, 'd~': {'~': 3},
+                          'ae': {'b': 2}, 'eb': {'~': 2}, 'b~': {'~': 2}}, model.markov_chain)
+        self.assertFalse(model.normed_chain)
+        self.assertEqual(1, model.prune(top_n=1))
+        self.assertEqual({'b': 4}, model.markov_chain['~a'])
+        self.assertEqual(4, model.prune(max_contexts=4))
+        self.assertEqual(['~~', '~a', 'ab', 'bd'], list(model.markov_chain))
+        self.assertEqual(2, model.prune(max_transitions=2))
+        self.assertEqual({'~~': {'a': 6}, '~a': {'b': 4}}, model.markov_chain)
+        self.assertAlmostEqual(np.log(.01), model.log_likelihood("~~x"))
+
+    def test_backoff(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        lines = ["~~~~" + line + "~~~~" for line in df["column1"]]
+        model = BackoffMarkovModel(4)
+        model.train_batch(training_data=lines, counts=df["count"].to_numpy())
+        fixed_models = []
+        for order in range(1, 5):
+            fixed_model = MarkovModel(order)
+            fixed_model.train_batch(training_data=[line[4 - order:] for line in lines],
+                                    counts=df["count"].to_numpy())
+            fixed_models.append(fixed_model)
+
+        # Each order scores the transitions after the first 4 letters, with the prior of the variable-order model
+        model.check_if_trained()
+        fixed_model = fixed_models[-1]
+        fixed_model.check_if_trained()
+        fixed_model.prior = model.prior
+        scores = model.score_orders(self.sequences)
+        self.assertEqual((len(self.sequences), 4), scores.shape)
+        np.testing.assert_allclose(fixed_model.score_batch(self.sequences), scores[:, 3])
+        fixed_models[0].check_if_trained()
+        fixed_models[0].prior = model.prior
+        np.testing.assert_allclose(fixed_models[0].score_batch([sequence[3:] for sequence in self.sequences]),
+                                   scores[:, 0])
+
+        # Unseen contexts back off to shorter ones
+        self.assertAlmostEqual(fixed_model.log_likelihood("~~~~This"), model.log_likelihood("~~~~This"))
+        probabilities, _ = model.transition_probabilities("Xis d")
+        fixed_models[2].check_if_trained()
+        self.assertAlmostEqual(fixed_models[2].normed_chain["is "]["d"] * .4, probabilities[0])
+        self.assertEqual(model.prior, model.transition_probabilities("~~~~€")[0][0])
+        np.testing.assert_allclose(model.score_batch(self.sequences),
+                                   [model.log_likelihood(sequence) for sequence in self.sequences])
+
+        other_model = BackoffMarkovModel(4)
+        for (line, count) in zip(lines, df["count"]):
+            (other_model if count > 2 else model).train(line, count=count)
+        self.assertNotEqual(model.root, other_model.root)
+        expected = BackoffMarkovModel(4)
+        expected.train_batch(training_data=lines * 2, counts=np.tile(df["count"].to_numpy(), 2))
+        self.assertEqual(expected.root, model.merge(other_model).root)
+        self.assertTrue(model.simulate(12, start="~~~~").startswith("~~~~"))
@@ -1,7 +1,15 @@
+import json
+import os
+import tempfile
 from unittest import TestCase
 
+import numpy as np
 import pandas as pd
+from anomark.model import BackoffMarkovModel
 from anomark.model_handler import MarkovModelHandler as mmh
+from anomark.utils.aggregation import StreamingAggregator, aggregate_by_value
+from anomark.utils.cache import LRUCache
+from anomark.utils.metrics import Metrics
 
 
 class Test(TestCase):
@@ -44,3 +52,266 @@ class Test(TestCase):
         self.assertEqual(expected_markov_chain, model.markov_chain)
         self.assertEqual(4, model.order)
         self.assertEqual(0.001, model.prior)
+
+    def test_run_streaming(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        model = mmh.train_from_df(df=df, model_order=4, train_col_name="column1", count_col_name="count",
+                                  save_model=False)
+        with tempfile.TemporaryDirectory() as directory:
+            model_path = os.path.join(directory, "model.dump")
+            output_path = os.path.join(directory, "export.csv")
+            mmh.save_model(model, save_path=model_path)
+
+            expected_result = mmh.run(model_path=model_path, data_path="tests/sample_data/test_data.csv",
+                                      col_name="column1", verbose=False).reset_index(drop=True)
+            result = mmh.run_streaming(model_path=model_path, data_path="tests/sample_data/test_data.csv",
+                                       col_name="column1", chunksize=2, max_groups=1, nb_lines=2, output=output_path,
+                                       verbose=False).reset_index(drop=True)
+            output = pd.read_csv(output_path).sort_values("markovScore").reset_index(drop=True)
+
+        self.assertEqual(expected_result.iloc[:2].to_dict(), result.to_dict())
+        self.assertEqual(expected_result.to_dict(), output.to_dict())
+
+    def test_streaming_aggregator(self):
+        df = pd.DataFrame({"column1": ["word", np.nan, "data", "word", None],
+                           "user": ["a", "b", "c", "d", "e"],
+                           "markovScore": [-1.5, -3., -2., -2.5, -4.]})
+        aggregator = StreamingAggregator("column1", "markovScore")
+        aggregator.update(df.iloc[:3])
+        aggregator.update(df.iloc[3:])
+        aggregator.flush()
+
+        expected_result = aggregate_by_value(df, "column1", "markovScore").sort_values("markovScore")
+        self.assertEqual(expected_result.to_dict("list"), aggregator.top_frame().to_dict("list"))
+
+    def test_run_multi(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        model = mmh.train_from_df(df=df, model_order=4, train_col_name="column1", save_model=False)
+        process_model = mmh.train_from_df(df=pd.DataFrame({"process": ["cmd.exe", "cmd.exe", "word.exe"]}),
+                                          model_order=2, train_col_name="process", save_model=False)
+        data = pd.read_csv("tests/sample_data/test_data.csv")
+        with tempfile.TemporaryDirectory() as directory:
+            model_paths = {"column1": os.path.join(directory, "model.dump"),
+                           "process": os.path.join(directory, "process.amk")}
+            mmh.save_model(model, save_path=model_paths["column1"])
+            mmh.save_model(process_model.freeze(), save_path=model_paths["process"])
+            with open(os.path.join(directory, "fields.json"), "w") as f:
+                json.dump({"column1": "model.dump", "process": "process.amk"}, f)
+            self.assertEqual(model_paths, mmh.load_model_paths(os.path.join(directory, "fields.json")))
+
+            output_path = os.path.join(directory, "export.csv")
+            result = mmh.run_multi(model_paths, "tests/sample_data/test_data.csv", output=output_path,
+                                   combine="min", verbose=False)
+            output = pd.read_csv(output_path)
+            chunked_result = mmh.run_multi(model_paths, "tests/sample_data/test_data.csv", chunksize=2, combine="min",
+                                           verbose=False, top=2, workers=2)
+
+        # Each line is saved in order with the score of each column, scored by its model
+        self.assertEqual(data["column1"].tolist(), output["column1"].tolist())
+        np.testing.assert_allclose(mmh.score_series(data["column1"], model), output["markovScore_column1"])
+        np.testing.assert_allclose(mmh.score_series(data["process"], process_model), output["markovScore_process"])
+        np.testing.assert_allclose(output[["markovScore_column1", "markovScore_process"]].min(axis=1),
+                                   output["markovScore"])
+        np.testing.assert_allclose(sorted(output["markovScore"]), result["markovScore"])
+        self.assertEqual(result.iloc[:2].to_dict("list"), chunked_result.to_dict("list"))
+
+    def test_score_series(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        model = mmh.train_from_df(df=df, model_order=4, train_col_name="column1", save_model=False)
+        series = pd.Series(["Hello world !", "This is some data", "Hello world !", "Hello world !"])
+        expected_scores = [model.log_likelihood("~~~~" + value) for value in series]
+
+        memo = LRUCache(max_size=10)
+        np.testing.assert_allclose(expected_scores, mmh.score_series(series, model, memo))
+        np.testing.assert_allclose(expected_scores, mmh.score_series(series, model, memo))
+        self.assertEqual({"size": 2, "max_size": 10, "hits": 2, "misses": 2, "hit_ratio": .5}, memo.stats())
+
+    def test_run_parallel(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        model = mmh.train_from_df(df=df, model_order=4, train_col_name="column1", save_model=False)
+        with tempfile.TemporaryDirectory() as directory:
+            model_path = os.path.join(directory, "model.dump")
+            mmh.save_model(model, save_path=model_path)
+
+            expected_result = mmh.run(model_path=model_path, data_path="tests/sample_data/train_data.csv",
+                                      col_name="column1", apply_placeholder=True, verbose=False)
+            result = mmh.run(model_path=model_path, data_path="tests/sample_data/train_data.csv",
+                             col_name="column1", apply_placeholder=True, verbose=False, workers=2)
+
+        self.assertEqual(expected_result.to_dict(), result.to_dict())
+
+    def test_train_parallel(self):
+        with open("tests/sample_data/train_data.txt", "r") as f:
+            text_data = f.read()
+        expected_model = mmh.train_from_txt(training_data=text_data, model_order=4, save_model=False)
+        model = mmh.train_from_txt(training_data=text_data, model_order=4, save_model=False, workers=3)
+        self.assertEqual(expected_model.markov_chain, model.markov_chain)
+        self.assertEqual(expected_model.alphabet, model.alphabet)
+
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        expected_model = mmh.train_from_df(df=df.copy(), model_order=4, train_col_name="column1",
+                                           count_col_name="count", save_model=False)
+        model = mmh.train_from_df(df=df.copy(), model_order=4, train_col_name="column1", count_col_name="count",
+                                  save_model=False, workers=2)
+        self.assertEqual(expected_model.markov_chain, model.markov_chain)
+        self.assertEqual(expected_model.alphabet, model.alphabet)
+
+    def test_train_chunks(self):
+        with open("tests/sample_data/train_data.txt", "r") as f:
+            text_data = f.read()
+        expected_model = mmh.train_from_txt(training_data=text_data, model_order=4, save_model=False)
+        model = mmh.train_from_txt_chunks(path="tests/sample_data/train_data.txt", model_order=4, chunksize=50,
+                                          save_model=False)
+        self.assertEqual(expected_model.markov_chain, model.markov_chain)
+        self.assertEqual(expected_model.alphabet, model.alphabet)
+
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        expected_model = mmh.train_from_df(df=df.copy(), model_order=4, train_col_name="column1",
+                                           count_col_name="count", save_model=False)
+        model = mmh.train_from_csv_chunks(path="tests/sample_data/train_data.csv", model_order=4,
+                                          train_col_name="column1", count_col_name="count", chunksize=3,
+                                          save_model=False)
+        self.assertEqual(expected_model.markov_chain, model.markov_chain)
+        self.assertEqual(expected_model.alphabet, model.alphabet)
+
+        model = mmh.train_from_csv_chunks(path="tests/sample_data/train_data.csv", model_order=4,
+                                          train_col_name="column1", count_col_name="count", chunksize=3, n_lines=5,
+                                          save_model=False, workers=2)
+        expected_model = mmh.train_from_df(df=df.iloc[:5].copy(), model_order=4, train_col_name="column1",
+                                           count_col_name="count", save_model=False)
+        self.assertEqual(expected_model.markov_chain, model.markov_chain)
+
+        with tempfile.TemporaryDirectory() as directory:
+            # Empty cells are read as NaN
+            path = os.path.join(directory, "train_data.csv")
+            with open(path, "w") as f:
+                f.write("column1,count\nThis is some data,2\n,3\nword,1\n")
+            expected_model = mmh.train_from_df(df=pd.read_csv(path), model_order=4, train_col_name="column1",
+                                               count_col_name="count", save_model=False)
+            model = mmh.train_from_csv_chunks(path=path, model_order=4, train_col_name="column1",
+                                              count_col_name="count", chunksize=2, save_model=False)
+        self.assertEqual(expected_model.markov_chain, model.markov_chain)
+
+    def test_load_backoff_model(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        with tempfile.TemporaryDirectory() as directory:
+            model_path = os.path.join(directory, "model.dump")
+            model = mmh.train_from_df(df=df, model_order=4, train_col_name="column1", count_col_name="count",
+                                      save_path=model_path, model=BackoffMarkovModel(4))
+            loaded_model = mmh.load_model(model_path)
+
+        model.normalize_model_and_compute_prior()
+        self.assertEqual(mmh.compute_threshold(model, 95), mmh.compute_threshold(loaded_model, 95))
+
+    def test_letter_columns(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        model = mmh.train_from_df(df=df, model_order=4, train_col_name="column1", save_model=False)
+        values = ["This is some data", "This is sOme data", "", "zzzz"]
+        log_probabilities = mmh.transition_log_probabilities(values, model)
+        for (value, value_log_probabilities) in zip(values, log_probabilities):
+            padded = "~~~~" + value
+            np.testing.assert_allclose([model.log_likelihood(padded[i:i + 5]) for i in range(len(value))],
+                                       value_log_probabilities)
+
+        threshold = mmh.compute_threshold(model, percent=95)
+        result = mmh.add_letter_columns(pd.DataFrame({"column1": values}), model, threshold, "column1", color=True,
+                                        explain=True)
+        self.assertEqual("This is some data", result.loc[0, "Colored column1"])
+        self.assertEqual("This is s\x1b[91mOme d\x1b[0mata", result.loc[1, "Colored column1"])
+        self.assertEqual("", result.loc[0, "Explanation of column1"])
+        self.assertTrue(result.loc[1, "Explanation of column1"].startswith("'O' after 'is s' at 9: "))
+
+    def test_execute_on_df(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        model = mmh.train_from_df(df=df, model_order=4, train_col_name="column1", save_model=False)
+        df = pd.DataFrame({"column1": ["word", "This is some data", "word", "word", "data"],
+                           "user": ["b", "a", "a", None, 3],
+                           "host": [1.5, 2, 1.5, np.nan, 2]})
+        expected_result = pd.DataFrame({"column1": ["This is some data", "data", "word"],
+                                        "List of all user": ["a", "3", "None - a - b"],
+                                        "List of all host": ["2.0", "2.0", "1.5 - nan"]})
+
+        result = mmh.execute_on_df(df.copy(), model, "column1").sort_values("column1")
+        self.assertEqual(expected_result.to_dict("list"), result.drop(columns="markovScore").to_dict("list"))
+        self.assertEqual(model.log_likelihood("~~~~word"), result.loc[result["column1"] == "word",
+                                                                       "markovScore"].iloc[0])
+
+        result = mmh.execute_on_df(df.copy(), model, "column1", max_values=2).sort_values("column1")
+        self.assertEqual(["a", "3", "a - b"], result["List of all user"].tolist())
+
+    def test_run_top(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        model = mmh.train_from_df(df=df, model_order=4, train_col_name="column1", save_model=False)
+        with tempfile.TemporaryDirectory() as directory:
+            model_path = os.path.join(directory, "model.dump")
+            output_path = os.path.join(directory, "export.csv")
+            mmh.save_model(model, save_path=model_path)
+
+            expected_result = mmh.run(model_path=model_path, data_path="tests/sample_data/test_data.csv",
+                                      col_name="column1", verbose=False).reset_index(drop=True)
+            result = mmh.run(model_path=model_path, data_path="tests/sample_data/test_data.csv", col_name="column1",
+                             output=output_path, color_output=True, verbose=False, top=1).reset_index(drop=True)
+            output = pd.read_csv(output_path)
+            streaming_result = mmh.run_streaming(model_path=model_path, data_path="tests/sample_data/test_data.csv",
+                                                 col_name="column1", chunksize=2, output=output_path, verbose=False,
+                                                 top=1).reset_index(drop=True)
+            streaming_output = pd.read_csv(output_path)
+
+        self.assertEqual(expected_result.iloc[:1].to_dict(), result.drop(columns="Colored column1").to_dict())
+        self.assertEqual(1, len(output))
+        self.assertEqual(expected_result.iloc[:1].to_dict(), streaming_result.to_dict())
+        self.assertEqual(expected_result.iloc[:1].to_dict(), streaming_output.to_dict())
+
+    def test_train_pruning(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        holdout = pd.read_csv("tests/sample_data/test_data.csv")["column1"].tolist()
+        model = mmh.train_from_df(df=df.copy(), model_order=4, train_col_name="column1", count_col_name="count",
+                                  save_model=False, pruning={"min_count": 2})
+        self.assertTrue(all(count >= 2 for distribution in model.markov_chain.values()
+                            for count in distribution.values()))
+
+        reference = mmh.train_from_df(df=df.copy(), model_order=4, train_col_name="column1",
+                                      count_col_name="count", save_model=False)
+        changes = mmh.prune_model(reference, {"max_transitions": 10}, holdout=holdout)
+        self.assertEqual(10, reference.nb_transitions)
+        self.assertGreater(changes["mean_abs_diff"], 0)
+        self.assertEqual(1, changes["nb_top"])
+        changes = mmh.score_changes([-1., -2., -3.], [-1.5, -2., -1.])
+        self.assertAlmostEqual(2.5 / 3, changes["mean_abs_diff"])
+        self.assertAlmostEqual(-.5, changes["rank_correlation"])
+        self.assertEqual(0, changes["top_overlap"])
+
+        # Budget enforced while training
+        self.assertEqual(0, mmh.enforce_budget(model, max_transitions=1000))
+        nb_transitions = model.nb_transitions
+        self.assertEqual(nb_transitions - 7, mmh.enforce_budget(model, max_transitions=10))
+
+    def test_metrics(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        training_metrics = Metrics()
+        model = mmh.train_from_df(df=df, model_order=4, train_col_name="column1", save_model=False,
+                                  metrics=training_metrics)
+        self.assertEqual(["preprocessing", "training"], list(training_metrics.stages))
+        self.assertEqual(len(df), training_metrics.stages["training"]["rows"])
+
+        metrics = Metrics()
+        memo = LRUCache()
+        with tempfile.TemporaryDirectory() as directory:
+            model_path = os.path.join(directory, "model.dump")
+            mmh.save_model(model, save_path=model_path)
+            mmh.run_streaming(model_path=model_path, data_path="tests/sample_data/test_data.csv", col_name="column1",
+                              chunksize=2, output=os.path.join(directory, "export.csv"), color_output=True,
+                              verbose=False, apply_placeholder=True, memo=memo, metrics=metrics)
+            metrics.save(os.path.join(directory, "metrics.json"))
+            with open(os.path.join(directory, "metrics.json")) as f:
+                saved = json.load(f)
+
+        stages = {stage["name"]: stage for stage in saved["stages"]}
+        self.assertEqual(["load_model", "load_data", "placeholder", "scoring", "groupby", "colouring", "save"],
+                         list(stages))
+        # Two chunks of the three lines, and the end of the data
+        self.assertEqual((3, 3), (stages["load_data"]["calls"], stages["load_data"]["rows"]))
+        self.assertEqual((2, 3), (stages["scoring"]["calls"], stages["scoring"]["rows"]))
+        self.assertGreater(stages["scoring"]["rows_per_second"], 0)
+        self.assertEqual(memo.stats(), saved["stats"]["score_memo"])
+        self.assertEqual(3, saved["stats"]["placeholder_strings"]["strings"])
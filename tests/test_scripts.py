@@ -0,0 +1,52 @@
+import io
+import os
+import tempfile
+from contextlib import redirect_stderr
+from unittest import TestCase
+
+import pandas as pd
+import prune_model
+import train_from_csv
+import train_from_txt
+from anomark.model import BackoffMarkovModel
+from anomark.model_handler import MarkovModelHandler as mmh
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        self.backoff_path = os.path.join(self.directory.name, "backoff.dump")
+        mmh.train_from_df(df=df.copy(), model_order=4, train_col_name="column1", count_col_name="count",
+                          save_path=self.backoff_path, model=BackoffMarkovModel(4))
+        model = mmh.train_from_df(df=df, model_order=4, train_col_name="column1", count_col_name="count",
+                                  save_model=False)
+        self.bounded_path = os.path.join(self.directory.name, "bounded.amk")
+        mmh.save_model(model=model.freeze(max_symbols=8), save_path=self.bounded_path)
+
+    def assertUsageError(self, main, argv, message):
+        stderr = io.StringIO()
+        with redirect_stderr(stderr), self.assertRaises(SystemExit) as context:
+            main(argv)
+        self.assertEqual(2, context.exception.code)
+        self.assertIn(message, stderr.getvalue())
+
+    def test_prune_model(self):
+        self.assertUsageError(prune_model.main, ["-m", self.backoff_path, "--min-count", "2"],
+                              "only MarkovModel dumps can be pruned")
+        self.assertUsageError(prune_model.main, ["-m", self.bounded_path, "--min-count", "2"],
+                              "cannot be trained again")
+
+    def test_resume_bounded_model(self):
+        output = os.path.join(self.directory.name, "model.dump")
+        for chunksize in ([], ["--chunksize", "2"]):
+            self.assertUsageError(train_from_csv.main, ["-d", "tests/sample_data/train_data.csv", "-c", "column1",
+                                                        "-o", "4", "--resume", "-m", self.bounded_path,
+                                                        "--output", output] + chunksize,
+                                  "cannot be trained again")
+            self.assertUsageError(train_from_txt.main, ["-d", "tests/sample_data/train_data.txt", "-o", "4",
+                                                        "--resume", "-m", self.bounded_path,
+                                                        "--output", output] + chunksize,
+                                  "cannot be trained again")
+        self.assertFalse(os.path.exists(output))
@@ -0,0 +1,95 @@
+import http.client
+import json
+import os
+import socket
+import tempfile
+import threading
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+from anomark.model_handler import MarkovModelHandler as mmh
+from anomark.service import make_server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__("localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class Test(TestCase):
+    def setUp(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        self.model = mmh.train_from_df(df=df, model_order=4, train_col_name="column1", count_col_name="count",
+                                       save_model=False)
+        self.values = ["This is some data", "This is sOme data", "", "Data for placeholder: S-1-5-21-42-42"]
+        self.directory = tempfile.TemporaryDirectory()
+        self.model_path = os.path.join(self.directory.name, "model.dump")
+        mmh.save_model(self.model, save_path=self.model_path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def score(self, connection, query=""):
+        body = "\n".join(json.dumps(value) for value in self.values)
+        connection.request("POST", "/score" + query, body=body.encode("utf-8"))
+        response = connection.getresponse()
+        return response.status, [json.loads(line) for line in response.read().decode("utf-8").splitlines()]
+
+    def check_scores(self, results, values):
+        threshold = mmh.compute_threshold(self.model, percent=95)
+        expected_scores = self.model.score_batch("~~~~" + value for value in values)
+        np.testing.assert_allclose(expected_scores, [result["score"] for result in results])
+        self.assertEqual([score < threshold for score in expected_scores],
+                         [result["anomalous"] for result in results])
+
+    def run_server(self, **kwargs):
+        server = make_server({"cmdline": self.model_path}, concurrency=2, **kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.batcher.close)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_http(self):
+        server = self.run_server(port=0)
+        connection = http.client.HTTPConnection(*server.server_address)
+
+        status, results = self.score(connection)
+        self.assertEqual(200, status)
+        self.check_scores(results, self.values)
+
+        # Same connection, with placeholders
+        status, results = self.score(connection, "?model=cmdline&placeholder=1")
+        self.assertEqual(200, status)
+        self.check_scores(results, ["This is some data", "This is sOme data", "", "Data for placeholder: <SID>"])
+
+        status, _ = self.score(connection, "?model=other")
+        self.assertEqual(404, status)
+        connection.request("GET", "/models")
+        self.assertEqual(4, json.loads(connection.getresponse().read())["cmdline"]["order"])
+
+    def test_unix_socket_and_reload(self):
+        socket_path = os.path.join(self.directory.name, "anomark.sock")
+        self.run_server(unix_socket=socket_path, reload_interval=0)
+        connection = UnixHTTPConnection(socket_path)
+
+        status, results = self.score(connection)
+        self.assertEqual(200, status)
+        self.check_scores(results, self.values)
+
+        # Replacing the model file
+        self.model = mmh.train_from_df(df=pd.DataFrame({"column1": ["This is sOme data"]}), model_order=2,
+                                       train_col_name="column1", save_model=False)
+        mmh.save_model(self.model, save_path=self.model_path)
+        os.utime(self.model_path, ns=(0, os.stat(self.model_path).st_mtime_ns + 10 ** 9))
+        status, results = self.score(UnixHTTPConnection(socket_path))
+        self.assertEqual(200, status)
+        np.testing.assert_allclose(self.model.score_batch("~~" + value for value in self.values),
+                                   [result["score"] for result in results])
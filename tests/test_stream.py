@@ -0,0 +1,69 @@
+import io
+import json
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+from anomark.model_handler import MarkovModelHandler as mmh
+from anomark.stream import stream
+
+
+class Test(TestCase):
+    def setUp(self):
+        df = pd.read_csv("tests/sample_data/train_data.csv")
+        self.model = mmh.train_from_df(df=df, model_order=4, train_col_name="column1", count_col_name="count",
+                                       save_model=False)
+        self.values = ["This is some data", "This is sOme data", "", "This is some data"]
+        self.expected = mmh.score_values(self.values, self.model)
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_input(self, lines):
+        path = os.path.join(self.directory.name, "input")
+        with open(path, "w") as f:
+            f.write("".join(line + "\n" for line in lines))
+        return path
+
+    def test_ndjson(self):
+        lines = [json.dumps({"event": {"CommandLine": value}, "id": i}) for (i, value) in enumerate(self.values)]
+        lines.insert(1, "not json")
+        lines.append(json.dumps({"id": 4}))
+        output, log = io.StringIO(), io.StringIO()
+        scorer = stream(self.model, self.write_input(lines), field="event.CommandLine", batch_size=2,
+                        output=output, log=log)
+
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([record["id"] for record in records], [0, 1, 2, 3, 4])
+        np.testing.assert_allclose([record["markovScore"] for record in records[:4]], self.expected)
+        self.assertIsNone(records[4]["markovScore"])
+        self.assertEqual([record["markovAnomalous"] for record in records],
+                         [score < scorer.threshold for score in self.expected] + [None])
+        self.assertEqual((scorer.nb_read, scorer.nb_written, scorer.nb_errors), (5, 5, 1))
+        self.assertIn("5 records read, 5 written", log.getvalue())
+        self.assertEqual(scorer.memo.hits, 1)
+
+    def test_raw_named_pipe(self):
+        path = os.path.join(self.directory.name, "pipe")
+        os.mkfifo(path)
+
+        def write():
+            with open(path, "w") as f:
+                for value in self.values:
+                    f.write(value + "\n")
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        output = io.StringIO()
+        stream(self.model, path, input_format="raw", field="line", anomalous_field=None, report_interval=0,
+               output=output, log=io.StringIO())
+        writer.join()
+
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([record["line"] for record in records], self.values)
+        np.testing.assert_allclose([record["markovScore"] for record in records], self.expected)
+        self.assertNotIn("markovAnomalous", records[0])
@@ -1,10 +1,12 @@
 import argparse
-import pickle
 
+from anomark.model import BackoffMarkovModel
 from anomark.model_handler import MarkovModelHandler as mmh
-from anomark.utils.data_handler import process_dataframe
+from anomark.utils.data_handler import load_placeholder_cache, process_dataframe, save_placeholder_cache
+from anomark.utils.metrics import instrument, measure
 
-if __name__ == "__main__":
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-d", "--data", required=True,
@@ -32,28 +34,138 @@ if __name__ == "__main__":
                         help="Apply filepath replacement by placeholder. See documentation for more "
                              "details about how it is performed. This is a separate because you may want other placeholders applied but not this one.")
 
+    parser.add_argument("--placeholder-cache-size", required=False, type=int, default=100000,
+                        help="Number of normalized distinct lines kept in memory to avoid applying the placeholders "
+                             "to them again (0 to disable)")
+    parser.add_argument("--placeholder-cache", required=False,
+                        help="Path of a file persisting the normalized lines across runs: loaded if it exists and "
+                             "was built with the same placeholders, and saved at the end")
+
+    parser.add_argument("--workers", required=False, type=int, default=1,
+                        help="Number of processes training on shards of the data, merged into one model")
+
+    parser.add_argument("--chunksize", required=False, type=int,
+                        help="Stream the data by chunks of this many lines instead of loading it in memory. Only "
+                             "--nLines can be used to select the lines in this mode")
+
+    parser.add_argument("--backoff", required=False, type=float, nargs="?", const=.4,
+                        help="Train a variable-order model, counting every order up to --order in a single trie and "
+                             "backing off to shorter contexts when the longest one was never seen. The optional "
+                             "value is the discount applied for each order backed off (default: 0.4)")
+
+    parser.add_argument("--min-count", required=False, type=float,
+                        help="Prune the transitions seen less than this number of times")
+    parser.add_argument("--top-n", required=False, type=int,
+                        help="Only keep the N most frequent next letters of each ngram")
+    parser.add_argument("--max-contexts", required=False, type=int, help="Only keep the N most frequent ngrams")
+    parser.add_argument("--max-transitions", required=False, type=int,
+                        help="Memory budget of the model: maximum number of transitions, enforced during training by "
+                             "pruning the least frequent ones")
+    parser.add_argument("--holdout", required=False,
+                        help="Path of held-out data (same format and column as --data), scored before and after "
+                             "pruning to report how the scores change")
+
     parser.add_argument("--resume", action="store_true", help="Continue training mode for the model")
     parser.add_argument("-m", "--model", help="Path to the model to use (resume training mode)")
 
-    args = parser.parse_args()
-
-    data = mmh.load_data(path=args.data, col_name=args.column)
-    data = process_dataframe(data=data, column=args.column, n_lines=args.nLines, percentage=args.percentage,
-                             from_end=args.fromEnd, randomize=args.randomize, apply_placeholder=args.placeholder, apply_filepath_placeholder=args.filepath_placeholder)
-
-    print("Training on data...")
-
-    if args.resume:
-        if args.model is None:
-            parser.error("You did not provide model path with --model")
-        with open(args.model, "rb") as f:
-            model = pickle.load(f)
-        mmh.train_from_df(df=data, model_order=model.order, train_col_name=args.column,
-                          count_col_name=args.count_column, save_model=True, save_path=args.output, model=model)
-    else:
-        try:
-            args.order = int(args.order)
-        except ValueError:
-            parser.error("Order must be an int")
-        mmh.train_from_df(df=data, model_order=args.order, train_col_name=args.column,
-                          count_col_name=args.count_column, save_model=True, save_path=args.output)
+    parser.add_argument("--metrics", required=False,
+                        help="Path of a JSON file where the time, rows per second and memory change of each stage, "
+                             "and the statistics of the caches, are saved")
+    parser.add_argument("--profile", required=False,
+                        help="Path where cProfile statistics are dumped, with the largest memory allocations in "
+                             "<path>.memory.txt (slows the training down)")
+
+    args = parser.parse_args(argv)
+
+    pruning = {name: value for (name, value) in [("min_count", args.min_count), ("top_n", args.top_n),
+                                                 ("max_contexts", args.max_contexts),
+                                                 ("max_transitions", args.max_transitions)] if value is not None}
+    if any(value < 1 for (name, value) in pruning.items() if name != "min_count"):
+        parser.error("--top-n, --max-contexts and --max-transitions must be positive")
+    if args.backoff is not None and (pruning or args.resume):
+        parser.error("--backoff cannot be used with pruning options or --resume")
+    holdout = None
+    if args.holdout:
+        if not pruning:
+            parser.error("--holdout reports how pruning changes the scores, it needs a pruning option")
+        if args.max_transitions is not None:
+            # The budget prunes the model during training: there are no scores before pruning to compare with
+            parser.error("--holdout cannot be used with --max-transitions, the model is already pruned while training")
+        holdout = mmh.load_holdout(args.holdout, args.column, args.placeholder, args.filepath_placeholder)
+
+    with instrument(args.metrics, args.profile) as metrics:
+        placeholder_cache = None
+        if args.placeholder and args.placeholder_cache_size > 0:
+            placeholder_cache = load_placeholder_cache(args.placeholder_cache, args.filepath_placeholder,
+                                                       args.placeholder_cache_size)
+
+        if args.chunksize is not None:
+            if args.percentage or args.fromEnd or args.randomize:
+                parser.error("--percentage, --fromEnd and --randomize need the whole data, they cannot be used with "
+                             "--chunksize")
+            if args.chunksize < 1:
+                parser.error("--chunksize must be a positive number of lines")
+            model, order = None, args.order
+            if args.resume:
+                if args.model is None:
+                    parser.error("You did not provide model path with --model")
+                try:
+                    model = mmh.load_model(args.model, trainable=True)
+                except ValueError as e:
+                    parser.error(str(e))
+                order = model.order
+            try:
+                order = int(order)
+            except ValueError:
+                parser.error("Order must be an int")
+            if args.backoff is not None:
+                model = BackoffMarkovModel(order, backoff=args.backoff)
+            print("Training on data...")
+            mmh.train_from_csv_chunks(path=args.data, model_order=order, train_col_name=args.column,
+                                      count_col_name=args.count_column, chunksize=args.chunksize, n_lines=args.nLines,
+                                      apply_placeholder=args.placeholder,
+                                      apply_filepath_placeholder=args.filepath_placeholder, save_model=True,
+                                      save_path=args.output, model=model, workers=args.workers,
+                                      placeholder_cache=placeholder_cache, pruning=pruning, holdout=holdout,
+                                      metrics=metrics)
+            if args.placeholder_cache and placeholder_cache is not None:
+                save_placeholder_cache(placeholder_cache, args.placeholder_cache, args.filepath_placeholder)
+            return
+
+        with measure(metrics, "load_data") as record:
+            data = mmh.load_data(path=args.data, col_name=args.column)
+            record["rows"] = len(data)
+        with measure(metrics, "process_dataframe", len(data)):
+            data = process_dataframe(data=data, column=args.column, n_lines=args.nLines, percentage=args.percentage,
+                                     from_end=args.fromEnd, randomize=args.randomize,
+                                     apply_placeholder=args.placeholder,
+                                     apply_filepath_placeholder=args.filepath_placeholder,
+                                     placeholder_cache=placeholder_cache)
+        if args.placeholder_cache and placeholder_cache is not None:
+            save_placeholder_cache(placeholder_cache, args.placeholder_cache, args.filepath_placeholder)
+
+        print("Training on data...")
+
+        if args.resume:
+            if args.model is None:
+                parser.error("You did not provide model path with --model")
+            try:
+                model = mmh.load_model(args.model, trainable=True)
+            except ValueError as e:
+                parser.error(str(e))
+            mmh.train_from_df(df=data, model_order=model.order, train_col_name=args.column,
+                              count_col_name=args.count_column, save_model=True, save_path=args.output, model=model,
+                              workers=args.workers, pruning=pruning, holdout=holdout, metrics=metrics)
+        else:
+            try:
+                args.order = int(args.order)
+            except ValueError:
+                parser.error("Order must be an int")
+            model = BackoffMarkovModel(args.order, backoff=args.backoff) if args.backoff is not None else None
+            mmh.train_from_df(df=data, model_order=args.order, train_col_name=args.column,
+                              count_col_name=args.count_column, save_model=True, save_path=args.output, model=model,
+                              workers=args.workers, pruning=pruning, holdout=holdout, metrics=metrics)
+
+
+if __name__ == "__main__":
+    main()